@@ -39,11 +39,11 @@ class TicketAdmin(admin.ModelAdmin):
         extra_context['add_ack_form'] = AddAckForm()
         return super(TicketAdmin, self).change_view(request, object_id, extra_context=extra_context)
 
-    exclude = ('updated', 'cluster', 'payment_status', 'imported')
+    exclude = ('updated', 'cluster', 'payment_status', 'state', 'imported')
     readonly_fields = ('state_str', 'requested_user_details')
     list_display = ('event_date', 'id', 'summary', 'admin_topic', 'requested_by', 'state_str')
     list_display_links = ('summary',)
-    list_filter = ('topic', 'payment_status')
+    list_filter = ('topic', 'state', 'payment_status')
     date_hierarchy = 'event_date'
     search_fields = ['id', 'requested_user__username', 'requested_text', 'summary']
     inlines = [MediaInfoAdmin, PreexpeditureAdmin, ExpeditureAdmin]
@@ -25,7 +25,7 @@ class SubmittedTicketsFeed(LatestTicketsFeed):
     description = _('Recently changed submitted tickets')
     
     def items(self):
-        return [t for t in Ticket.objects.order_by('-updated')[:40] if t.has_ack('user_content')]
+        return Ticket.objects.filter(ticketack__ack_type='user_content').distinct().order_by('-updated')[:40]
 
 class TopicTicketsFeed(Feed):
     description_template = 'feeds/ticket_description.html'
@@ -47,7 +47,7 @@ class TopicTicketsFeed(Feed):
 
 class TopicSubmittedTicketsFeed(TopicTicketsFeed):
     def items(self, topic):
-        return [t for t in topic.ticket_set.order_by('-updated')[:40] if t.has_ack('user_content')]
+        return topic.ticket_set.filter(ticketack__ack_type='user_content').distinct().order_by('-updated')[:40]
 
 class TransactionsFeed(Feed):
     description_template = 'feeds/transaction_description.html'
@@ -17,13 +17,11 @@ class GrantDumper(object):
         self.zipname = target_filename
     
     def grant_finance(self):
-        topics = []
-        grant_finance = FinanceStatus()
-        for topic in self.grant.topic_set.all():
-            topic_finance = topic.payment_summary()
-            grant_finance.add_finance(topic_finance)
-            topics.append({'topic':topic, 'finance':topic_finance})
-        return {'topics':topics, 'finance':grant_finance}
+        topics = [{'topic':topic, 'finance':topic.payment_summary()} for topic in self.grant.topic_set.with_totals()]
+        finance = FinanceStatus()
+        for titem in topics:
+            finance.add_finance(titem['finance'])
+        return {'topics':topics, 'finance':finance}
     
     def dump_index(self):
         """ Dumps index page of the archive """
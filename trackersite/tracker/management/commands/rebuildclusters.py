@@ -0,0 +1,8 @@
+from django.core.management.base import NoArgsCommand
+from tracker.models import rebuild_clusters
+
+class Command(NoArgsCommand):
+    help = 'Recompute ticket/transaction clusters from scratch'
+    
+    def handle_noargs(self, **options):
+        rebuild_clusters()
@@ -0,0 +1,8 @@
+from django.core.management.base import NoArgsCommand
+from tracker.models import update_topic_summaries
+
+class Command(NoArgsCommand):
+    help = 'Recompute per ticket, topic and subtopic ticket totals from scratch'
+
+    def handle_noargs(self, **options):
+        update_topic_summaries()
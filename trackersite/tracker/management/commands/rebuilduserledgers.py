@@ -0,0 +1,8 @@
+from django.core.management.base import NoArgsCommand
+from tracker.models import update_user_ledgers
+
+class Command(NoArgsCommand):
+    help = 'Recompute per user totals of the user list from scratch'
+
+    def handle_noargs(self, **options):
+        update_user_ledgers()
@@ -1,35 +1,126 @@
-from django.core.management.base import NoArgsCommand
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db.models import Q
 from tracker.models import Notification
-from django.contrib.auth.models import User
 from django.template.loader import get_template
 from django.template import Context
-from django.conf import settings
 from django.utils import translation
 from django.utils.html import strip_tags
 from datetime import date
 
-class Command(NoArgsCommand):
+# digest template variable -> notification types listed there
+DIGEST_SECTIONS = (
+    ('ack_notifs', ('ack_add', 'ack_remove')),
+    ('ticket_change_notifs', ('ticket_change', 'ticket_change_all')),
+    ('preexpeditures_notifs', ('preexpeditures_change',)),
+    ('expeditures_notifs', ('expeditures_change',)),
+    ('media_notifs', ('media_change',)),
+    ('ticket_new_notifs', ('ticket_new',)),
+    ('comment_notifs', ('comment',)),
+    ('supervisor_notes_notifs', ('supervisor_notes',)),
+)
+
+def digest_context(notifications):
+    """ Template context of digest for given notifications of one user. """
+    section_of = dict((t, name) for name, types in DIGEST_SECTIONS for t in types)
+    out = dict((name, []) for name, types in DIGEST_SECTIONS)
+    for notification in notifications:
+        if notification.notification_type in section_of:
+            out[section_of[notification.notification_type]].append(notification)
+    return out
+
+def pending_digests(batch_size):
+    """
+    Yields (user, notifications) for all users with pending notifications.
+    Notifications are read in batches ordered by user and id, each continuing
+    after the last (user, id) read, so besides one batch only notifications of
+    the digest being collected are held at once.
+    """
+    pending = Notification.objects.exclude(target_user=None).select_related('target_user').order_by('target_user', 'id')
+    notifications = []
+    while True:
+        if notifications:
+            last = notifications[-1]
+            queryset = pending.filter(Q(target_user_id__gt=last.target_user_id) | Q(target_user_id=last.target_user_id, id__gt=last.id))
+        else:
+            queryset = pending
+        batch = list(queryset[:batch_size])
+        for notification in batch:
+            if notifications and notification.target_user_id != notifications[0].target_user_id:
+                yield notifications[0].target_user, notifications
+                notifications = []
+            notifications.append(notification)
+        if len(batch) < batch_size:
+            break
+    if notifications:
+        yield notifications[0].target_user, notifications
+
+class Command(BaseCommand):
     help = 'Process pending notifications'
-    
-    def handle_noargs(self, **options):
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, dest='batch_size', help='Number of notifications read (and deleted) at once')
+        parser.add_argument('--workers', type=int, default=0, help='Number of threads rendering digests (renders in the main thread by default)')
+
+    def render(self, digest):
+        """ Renders digest of one user into an e-mail message. """
+        user, notifications = digest
+        with translation.override('cs_CZ'):
+            html = self.html_template.render(Context(digest_context(notifications)))
+        message = EmailMultiAlternatives(self.subject_text, strip_tags(html), to=[user.email], connection=self.connection)
+        message.attach_alternative(html, 'text/html')
+        return message
+
+    def deliver(self, digests):
+        """ Sends digests through the open connection and deletes notifications of those sent. """
+        with_email = [d for d in digests if d[0].email]
+        messages = self.map(self.render, with_email)
+        # users without e-mail are discarded anyway, the rest is kept for next run unless sent
+        done = [d for d in digests if not d[0].email]
+        for digest, message in zip(with_email, messages):
+            try:
+                sent = self.connection.send_messages([message])
+            except Exception as e:
+                self.stderr.write('Sending digest to %s failed: %s' % (message.to[0], e))
+                sent = 0
+            if sent:
+                self.sent += 1
+                done.append(digest)
+            else:
+                self.failed += 1
+        Notification.objects.filter(id__in=[n.id for user, notifications in done for n in notifications]).delete()
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
         translation.activate('cs_CZ')
         subject_c = Context({"date":date.today()})
-        subject_text = get_template('notification/notification_subject.txt').render(subject_c)
-        html_template = get_template('notification/notification_html.html')
-        for user in User.objects.all():
-            if user.email:
-                if len(Notification.objects.filter(target_user=user)) > 0:
-                    c_dict = {
-                        "ack_notifs": Notification.objects.filter(target_user=user, notification_type__in=["ack_add", "ack_remove"]),
-                        "ticket_change_notifs": Notification.objects.filter(target_user=user, notification_type__in=["ticket_change", "ticket_change_all"]),
-                        "preexpeditures_notifs": Notification.objects.filter(target_user=user, notification_type="preexpeditures_change"),
-                        "expeditures_notifs": Notification.objects.filter(target_user=user, notification_type="expeditures_change"),
-                        "media_notifs": Notification.objects.filter(target_user=user, notification_type="media_change"),
-                        "ticket_new_notifs": Notification.objects.filter(target_user=user, notification_type="ticket_new"),
-                        "comment_notifs": Notification.objects.filter(target_user=user, notification_type="comment"),
-                        "supervisor_notes_notifs": Notification.objects.filter(target_user=user, notification_type="supervisor_notes"),
-                    }
-                    c = Context(c_dict)
-                    user.email_user(subject_text, strip_tags(html_template.render(c)), html_message=html_template.render(c))
-            for notification in Notification.objects.filter(target_user=user):
-                notification.delete()
+        self.subject_text = get_template('notification/notification_subject.txt').render(subject_c)
+        self.html_template = get_template('notification/notification_html.html')
+
+        pool = ThreadPool(options['workers']) if options['workers'] > 0 else None
+        self.map = pool.map if pool else map
+        self.sent = self.failed = 0
+        started = time.time()
+
+        self.connection = get_connection()
+        self.connection.open()
+        try:
+            digests, pending = [], 0
+            for digest in pending_digests(batch_size):
+                digests.append(digest)
+                pending += len(digest[1])
+                if pending >= batch_size:
+                    self.deliver(digests)
+                    digests, pending = [], 0
+            if digests:
+                self.deliver(digests)
+        finally:
+            self.connection.close()
+            if pool:
+                pool.close()
+
+        elapsed = time.time() - started
+        self.stdout.write('Sent %d digests, %d failed, in %.1f s (%.1f digests/s)' % (self.sent, self.failed, elapsed, self.sent / elapsed if elapsed else 0))
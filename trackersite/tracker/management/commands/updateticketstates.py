@@ -0,0 +1,25 @@
+from django.core.management.base import NoArgsCommand
+from tracker.models import Ticket, TicketAck, update_ticket_list
+
+class Command(NoArgsCommand):
+    help = 'Recompute stored ticket states from ticket acks'
+    
+    def handle_noargs(self, **options):
+        acks = {}
+        for ticket_id, ack_type in TicketAck.objects.order_by().values_list('ticket_id', 'ack_type').distinct():
+            acks.setdefault(ticket_id, set()).add(ack_type)
+
+        tickets_per_state = {}
+        for ticket_id, imported, rating_percentage, state in Ticket.objects.order_by().values_list('id', 'imported', 'rating_percentage', 'state'):
+            new_state = Ticket.compute_state(imported, rating_percentage, acks.get(ticket_id, set()))
+            if new_state != state:
+                tickets_per_state.setdefault(new_state, []).append(ticket_id)
+
+        changed = []
+        for state, ticket_ids in tickets_per_state.items():
+            # plain update, ticket save side effects are not wanted here
+            Ticket.objects.filter(id__in=ticket_ids).update(state=state)
+            changed += ticket_ids
+
+        if changed:
+            update_ticket_list(changed)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0032_auto_20180830_1112'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketListRow',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('ticket_id', models.IntegerField()),
+                ('language', models.CharField(max_length=10)),
+                ('data', models.TextField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='ticketlistrow',
+            unique_together=set([('ticket_id', 'language')]),
+        ),
+    ]
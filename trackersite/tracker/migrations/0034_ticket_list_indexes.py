@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0033_ticketlistrow'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='ticket',
+            name='event_date',
+            field=models.DateField(help_text='Date of the event this ticket is about', null=True, verbose_name='event date', db_index=True, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='ticket',
+            name='updated',
+            field=models.DateTimeField(verbose_name='updated', db_index=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0034_ticket_list_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='state',
+            field=models.CharField(default=b'draft', max_length=20, verbose_name='state', db_index=True, choices=[(b'draft', 'draft'), (b'wfpreapproval', 'waiting for preapproval'), (b'wfsubmiting', 'waiting for submitting'), (b'wfapproval', 'waiting for approval'), (b'wfcontentrating', 'waiting for content rating'), (b'wfdocssub', 'waiting for document submission'), (b'wffill', 'waiting for filing of documents'), (b'complete', 'complete'), (b'archived', 'archived'), (b'closed', 'closed'), (b'historical', 'historical')]),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0035_ticket_state'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='ticketwatcher',
+            index_together=set([('ticket', 'user', 'notification_type')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='topicwatcher',
+            index_together=set([('topic', 'user', 'notification_type')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_ledgers(apps, schema_editor):
+    # computed by the current code from tables older than this migration
+    from tracker.models import update_user_ledgers
+    update_user_ledgers()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0036_watcher_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserLedger',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('user_id', models.IntegerField(unique=True, null=True)),
+                ('ticket_count', models.IntegerField(default=0)),
+                ('media_objects', models.IntegerField(default=0)),
+                ('media_files', models.IntegerField(default=0)),
+                ('accepted_expeditures', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('paid_expeditures', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('transactions', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+            ],
+        ),
+        migrations.RunPython(fill_ledgers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_summaries(apps, schema_editor):
+    # computed by the current code, the summary tables are as created here
+    from tracker.models import update_topic_summaries
+    update_topic_summaries()
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tracker', '0037_userledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TicketSummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('tickets_count', models.IntegerField(default=0)),
+                ('tickets_n_a', models.IntegerField(default=0)),
+                ('tickets_unpaid', models.IntegerField(default=0)),
+                ('tickets_partially_paid', models.IntegerField(default=0)),
+                ('tickets_paid', models.IntegerField(default=0)),
+                ('tickets_overpaid', models.IntegerField(default=0)),
+                ('media_objects', models.IntegerField(default=0)),
+                ('media_files', models.IntegerField(default=0)),
+                ('expeditures_count', models.IntegerField(default=0)),
+                ('expeditures_amount', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('preexpeditures_count', models.IntegerField(default=0)),
+                ('preexpeditures_amount', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('accepted_amount', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('paid_wages_amount', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('paid_together_amount', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('finance_unpaid', models.DecimalField(default=0, max_digits=14, decimal_places=4)),
+                ('finance_paid', models.DecimalField(default=0, max_digits=14, decimal_places=4)),
+                ('topic_id', models.IntegerField()),
+                ('subtopic_id', models.IntegerField(null=True)),
+                ('requested_user_id', models.IntegerField(null=True)),
+                ('payment_status', models.CharField(default=b'n/a', max_length=20)),
+                ('rating_percentage', models.SmallIntegerField(null=True)),
+                ('content_acked', models.BooleanField(default=False)),
+                ('paid_sum', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('unpaid_sum', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('paid_wages_sum', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('ticket', models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='tracker.Ticket')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='TopicSummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('tickets_count', models.IntegerField(default=0)),
+                ('tickets_n_a', models.IntegerField(default=0)),
+                ('tickets_unpaid', models.IntegerField(default=0)),
+                ('tickets_partially_paid', models.IntegerField(default=0)),
+                ('tickets_paid', models.IntegerField(default=0)),
+                ('tickets_overpaid', models.IntegerField(default=0)),
+                ('media_objects', models.IntegerField(default=0)),
+                ('media_files', models.IntegerField(default=0)),
+                ('expeditures_count', models.IntegerField(default=0)),
+                ('expeditures_amount', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('preexpeditures_count', models.IntegerField(default=0)),
+                ('preexpeditures_amount', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('accepted_amount', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('paid_wages_amount', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('paid_together_amount', models.DecimalField(default=0, max_digits=12, decimal_places=2)),
+                ('finance_unpaid', models.DecimalField(default=0, max_digits=14, decimal_places=4)),
+                ('finance_paid', models.DecimalField(default=0, max_digits=14, decimal_places=4)),
+                ('grant', models.ForeignKey(to='tracker.Grant', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False)),
+                ('subtopic', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, to='tracker.Subtopic', null=True)),
+                ('topic', models.ForeignKey(to='tracker.Topic', on_delete=django.db.models.deletion.DO_NOTHING, db_constraint=False)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='topicsummary',
+            unique_together=set([('topic', 'subtopic')]),
+        ),
+        migrations.RunPython(fill_summaries, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,18 @@
 # -*- coding: utf-8 -*-
+import copy
 import datetime
 import decimal
 
 from django_comments.signals import comment_was_posted
-from django.db.models.signals import pre_save, post_save, post_delete
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+from django.core.signals import request_started, request_finished
 from django.contrib.auth.models import User
 from django.dispatch import receiver
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models.functions import Coalesce
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext_lazy as _, string_concat
+from django.utils import translation
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.conf import settings
@@ -20,9 +24,18 @@ from django import template
 from django.template.loader import get_template
 import re
 import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from users.models import UserWrapper
 
+logger = logging.getLogger(__name__)
+
 PAYMENT_STATUS_CHOICES = (
     ('n_a', _('n/a')),
     ('unpaid', _('unpaid')),
@@ -55,6 +68,20 @@ NOTIFICATION_TYPES = [
     ('media_change', _('Media changed')),
 ]
 
+TICKET_STATES = (
+    ('draft', _('draft')),
+    ('wfpreapproval', _('waiting for preapproval')),
+    ('wfsubmiting', _('waiting for submitting')),
+    ('wfapproval', _('waiting for approval')),
+    ('wfcontentrating', _('waiting for content rating')),
+    ('wfdocssub', _('waiting for document submission')),
+    ('wffill', _('waiting for filing of documents')),
+    ('complete', _('complete')),
+    ('archived', _('archived')),
+    ('closed', _('closed')),
+    ('historical', _('historical')),
+)
+
 USER_EDITABLE_ACK_TYPES = ('user_precontent', 'user_content', 'user_docs')
 
 def uber_ack(ack_type):
@@ -72,41 +99,203 @@ class PercentageField(models.SmallIntegerField):
         defaults.update(kwargs)
         return super(PercentageField, self).formfield(**defaults)
 
+class CachedModelStats(threading.local):
+    """
+    Per-thread (and so per-request) state of the CachedModel in-process
+    cache: generation of the L1 dicts, flush counts and hit/miss counters.
+    """
+    generation = 0
+    l1_hits = l1_misses = l2_hits = l2_misses = 0
+
+    def __init__(self):
+        # version key -> number of flush_cache calls in this generation
+        self.flushes = {}
+
+    def reset(self):
+        """ Starts a new L1 generation and zeroes counters, called when request starts and finishes. """
+        self.generation += 1
+        self.flushes = {}
+        self.l1_hits = self.l1_misses = self.l2_hits = self.l2_misses = 0
+
+    def as_dict(self):
+        return {'l1_hits':self.l1_hits, 'l1_misses':self.l1_misses, 'l2_hits':self.l2_hits, 'l2_misses':self.l2_misses}
+cached_model_stats = CachedModelStats()
+
+@receiver(request_started)
+@receiver(request_finished)
+def reset_cached_model_stats(sender, **kwargs):
+    # outside requests (management commands) L1 lives as long as the
+    # instance, flushes of the same object in this thread still empty it
+    cached_model_stats.reset()
+
+class CommitHooks(threading.local):
+    """ Functions waiting until changes made by this thread are committed, see after_commit. """
+    def __init__(self):
+        self.functions = OrderedDict()
+        self.in_request = False
+
+commit_hooks = CommitHooks()
+
+def after_commit(function):
+    """
+    Calls function once changes made so far are committed: right away
+    outside requests and transactions, otherwise when the request finishes or
+    the outermost deferred_notifications block exits. Pending calls of the
+    same function are merged into one.
+    """
+    commit_hooks.functions[function] = None
+    if not commit_hooks.in_request:
+        run_commit_hooks()
+
+def run_commit_hooks():
+    """ Calls functions passed to after_commit, unless a transaction is still open. """
+    if not connection.in_atomic_block:
+        _call_commit_hooks()
+
+def _call_commit_hooks():
+    while commit_hooks.functions:
+        function, _ = commit_hooks.functions.popitem(last=False)
+        function()
+
+@receiver(request_started)
+def start_commit_hooks_request(sender, **kwargs):
+    commit_hooks.in_request = True
+
+@receiver(request_finished)
+def call_commit_hooks_after_request(sender, **kwargs):
+    commit_hooks.in_request = False
+    # the response is out and its transactions are committed by now
+    _call_commit_hooks()
+
+class CommitHooksOnDeleteMixin(object):
+    """ Runs commit hooks after delete(), as post_delete handlers run inside the transaction of the deletion. """
+    def delete(self, *args, **kwargs):
+        super(CommitHooksOnDeleteMixin, self).delete(*args, **kwargs)
+        run_commit_hooks()
+
 class CachedModel(models.Model):
-    """ Model which has some values cached """
+    """
+    Model which has some values cached. Values are kept in memcached (L2)
+    and, for the duration of current request, in a dict on the instance (L1).
+    """
 
-    def _get_item_key(self, name):
-        return u'm:%s:%s:%s' % (self.__class__.__name__, self.id, name)
+    def _get_item_key(self, name, version):
+        # version is part of the key itself, so that keys of differently
+        # versioned objects can be fetched by one get_many
+        return u'm:%s:%s:%s:%s' % (self.__class__.__name__, self.id, name, version)
 
     def _get_version_key(self):
         return u'm:%s:%s:_version' % (self.__class__.__name__, self.id)
 
+    def _l1(self):
+        """ L1 dict of this instance, emptied when a new request starts or any instance of the same object is flushed """
+        state = (cached_model_stats.generation, cached_model_stats.flushes.get(self._get_version_key(), 0))
+        if getattr(self, '_l1_state', None) != state:
+            self._l1_values = {}
+            self._l1_state = state
+        return self._l1_values
+
     def _cache_version(self):
-        return cache.get(self._get_version_key()) or 1
+        l1 = self._l1()
+        if '_version' not in l1:
+            l1['_version'] = cache.get(self._get_version_key()) or 1
+        return l1['_version']
 
     def flush_cache(self):
-        cache.set(self._get_version_key(), self._cache_version() + 1)
+        # read the version from memcached, other instances could have bumped it
+        key = self._get_version_key()
+        cache.set(key, (cache.get(key) or 1) + 1)
+        cached_model_stats.flushes[key] = cached_model_stats.flushes.get(key, 0) + 1
     flush_cache.alters_data = True
 
+    @staticmethod
+    def cache_stats():
+        """ L1/L2 hit and miss counts of cached getters in current request. """
+        return cached_model_stats.as_dict()
+
     @staticmethod
     def cached_getter(raw_method):
         def wrapped(self):
-            key = self._get_item_key(raw_method.__name__)
-            version = self._cache_version()
-            cached = cache.get(key, version=version)
-            if cached is not None:
-                return cached
+            name = raw_method.__name__
+            l1 = self._l1()
+            if name in l1:
+                cached_model_stats.l1_hits += 1
+                return l1[name]
+            cached_model_stats.l1_misses += 1
+
+            key = self._get_item_key(name, self._cache_version())
+            value = cache.get(key)
+            if value is not None:
+                cached_model_stats.l2_hits += 1
             else:
+                cached_model_stats.l2_misses += 1
                 value = raw_method(self)
-                cache.set(key, value, version=version)
-                return value
+                cache.set(key, value)
+            l1[name] = value
+            return value
 
+        wrapped.raw_method = raw_method
         return wrapped
 
     class Meta:
         abstract = True
 cached_getter = CachedModel.cached_getter
 
+def prefetch_cached(objects, names):
+    """
+    Loads values of given cached getters for a list/queryset of CachedModel
+    instances in bulk: one get_many for versions, one get_many for values.
+    Misses are computed by the model's _bulk_<name> static method if it
+    has one (one by one otherwise) and stored back with one set_many.
+
+    Returns list of the instances; listed getters on them then answer from
+    L1 without touching memcached. Put getters others depend on (ack_set)
+    first in names.
+    """
+    objects = list(objects)
+    if len(objects) == 0:
+        return objects
+    model = objects[0].__class__
+
+    versions = cache.get_many([o._get_version_key() for o in objects])
+    keys = {}
+    for o in objects:
+        l1 = o._l1()
+        l1['_version'] = versions.get(o._get_version_key()) or 1
+        for name in names:
+            keys[o._get_item_key(name, l1['_version'])] = (o, name)
+
+    cached = cache.get_many(keys.keys())
+    missing = dict((name, []) for name in names)
+    for key, (o, name) in keys.items():
+        if cached.get(key) is not None:
+            cached_model_stats.l2_hits += 1
+            o._l1()[name] = cached[key]
+        else:
+            cached_model_stats.l2_misses += 1
+            missing[name].append((key, o))
+
+    to_store = {}
+    for name in names:
+        if len(missing[name]) == 0:
+            continue
+        missing_objects = [o for key, o in missing[name]]
+        bulk_method = getattr(model, '_bulk_%s' % name, None)
+        if bulk_method is not None:
+            values = bulk_method(missing_objects)
+        else:
+            raw_method = getattr(model, name).raw_method
+            values = dict((o.id, raw_method(o)) for o in missing_objects)
+
+        for key, o in missing[name]:
+            o._l1()[name] = values[o.id]
+            if values[o.id] is not None:
+                to_store[key] = values[o.id]
+
+    if to_store:
+        cache.set_many(to_store)
+    return objects
+
 class DecimalRangeField(models.DecimalField):
     def __init__(self, verbose_name=None, name=None, min_value=None, max_value=None, **kwargs):
         self.min_value, self.max_value = min_value, max_value
@@ -116,11 +305,17 @@ class DecimalRangeField(models.DecimalField):
         defaults.update(kwargs)
         return super(DecimalRangeField, self).formfield(**defaults)
 
-class Ticket(CachedModel):
+class ClusterMemberMixin(object):
+    """ Keeps save() of loaded object from overwriting its cluster, which only update_clusters writes. """
+    def _do_update(self, base_qs, using, pk_val, values, update_fields, forced_update):
+        values = [value for value in values if value[0].name != 'cluster']
+        return super(ClusterMemberMixin, self)._do_update(base_qs, using, pk_val, values, update_fields, forced_update)
+
+class Ticket(ClusterMemberMixin, CommitHooksOnDeleteMixin, CachedModel):
     """ One unit of tracked / paid stuff. """
     created = models.DateTimeField(_('created'), auto_now_add=True)
-    updated = models.DateTimeField(_('updated'))
-    event_date = models.DateField(_('event date'), blank=True, null=True, help_text=_('Date of the event this ticket is about'))
+    updated = models.DateTimeField(_('updated'), db_index=True)
+    event_date = models.DateField(_('event date'), blank=True, null=True, db_index=True, help_text=_('Date of the event this ticket is about'))
     requested_user = models.ForeignKey('auth.User', verbose_name=_('requested by'), blank=True, null=True, help_text=_('User who created/requested for this ticket'))
     requested_text = models.CharField(verbose_name=_('requested by (text)'), blank=True, max_length=30, help_text=_('Text description of who requested for this ticket, in case user is not filled in'))
     summary = models.CharField(_('summary'), max_length=100, help_text=_('Headline summary for the ticket'))
@@ -137,29 +332,66 @@ class Ticket(CachedModel):
                                 help_text=_("If you are requesting a financial deposit, please fill here its amount. Maximum amount is sum of preexpeditures. If you aren't requesting a deposit, fill here 0."))
     cluster = models.ForeignKey('Cluster', blank=True, null=True, on_delete=models.SET_NULL)
     payment_status = models.CharField(_('payment status'), max_length=20, default='n/a', choices=PAYMENT_STATUS_CHOICES)
+    state = models.CharField(_('state'), max_length=20, default='draft', choices=TICKET_STATES, db_index=True)
     imported = models.BooleanField(_('imported'), default=False, help_text=_('Was this ticket imported from older Tracker version?'))
 
     @staticmethod
     def currency():
         return settings.TRACKER_CURRENCY
 
-    def update_payment_status(self, save_afterwards=True):
-        paid_len = len(self.expediture_set.filter(paid=True))
-        all_len = len(self.expediture_set.all())
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Ticket, cls).from_db(db, field_names, values)
+        instance._loaded_values = dict((f.attname, getattr(instance, f.attname)) for f in cls._meta.concrete_fields if f.attname in instance.__dict__)
+        return instance
+
+    def changed_fields(self):
+        """ Names of fields changed since this ticket was loaded or last saved. """
+        if self.id is None:
+            return set()
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None:
+            # not loaded from the database, e.g. constructed with known id
+            loaded = Ticket.objects.filter(id=self.id).values(*[f.attname for f in self._meta.concrete_fields]).first() or {}
+            self._loaded_values = loaded
+        return set(f.name for f in self._meta.concrete_fields if f.attname in loaded and loaded[f.attname] != getattr(self, f.attname))
 
+    @staticmethod
+    def compute_payment_status(all_len, paid_len):
+        """ Payment status of a ticket with given count of all and of paid expeditures. """
         if all_len == 0:
-            self.payment_status = 'n/a'
-        elif paid_len == 0 and all_len > 0:
-            self.payment_status = 'unpaid'
+            return 'n/a'
+        elif paid_len == 0:
+            return 'unpaid'
         elif paid_len < all_len:
-            self.payment_status = 'partially_paid'
-        elif paid_len == all_len:
-            self.payment_status = 'paid'
+            return 'partially_paid'
+        else:
+            return 'paid'
+
+    def update_payment_status(self, save_afterwards=True):
+        if save_afterwards and self.id is not None and payment_status_queue.depth > 0:
+            # recomputed and saved when the batched_payment_status block exits
+            payment_status_queue.tickets[self.id] = self
+            return
+
+        counts = self.expediture_set.aggregate(**_payment_counts())
+        self.payment_status = Ticket.compute_payment_status(counts['all_len'], counts['paid_len'])
 
         if save_afterwards:
             self.save(just_payment_status=True)
     update_payment_status.alters_data = True
 
+    def update_state(self, save_afterwards=True):
+        if self.id is None:
+            acks = set()
+        else:
+            acks = set(self.ticketack_set.values_list('ack_type', flat=True))
+        self.state = Ticket.compute_state(self.imported, self.rating_percentage, acks)
+
+        if save_afterwards:
+            self.save(just_payment_status=True)
+    update_state.alters_data = True
+
     def save(self, *args, **kwargs):
         just_payment_status = kwargs.pop('just_payment_status', False)
         if not just_payment_status:
@@ -170,8 +402,10 @@ class Ticket(CachedModel):
 
         if not just_payment_status:
             self.update_payment_status(save_afterwards=False)
+            self.update_state(save_afterwards=False)
 
         super(Ticket, self).save(*args, **kwargs)
+        self._loaded_values = dict((f.attname, getattr(self, f.attname)) for f in self._meta.concrete_fields)
 
         self.flush_cache()
 
@@ -180,12 +414,7 @@ class Ticket(CachedModel):
 
     @staticmethod
     def get_tickets_with_state(state):
-        tickets = Ticket.objects.all()
-        result = []
-        for ticket in tickets:
-            if ticket.state_str() == state:
-                result.append(ticket)
-        return result
+        return Ticket.objects.filter(state=state)
 
     def admin_topic(self):
         return '%s (%s)' % (self.topic, self.topic.grant)
@@ -194,38 +423,42 @@ class Ticket(CachedModel):
         return len(self.ack_set()) == 0
 
     def state_str(self):
-        if self.imported:
-            return _('historical')
+        return self.get_state_display()
+    state_str.admin_order_field = 'state'
+    state_str.short_description = _('state')
+
+    @staticmethod
+    def compute_state(imported, rating_percentage, acks):
+        """ State code (see TICKET_STATES) for ticket with given attributes and set of ack types. """
+        if imported:
+            return 'historical'
 
-        acks = self.ack_set()
         if 'close' in acks:
-            return _('closed')
+            return 'closed'
         elif 'archive' in acks:
-            return _('archived')
+            return 'archived'
         elif 'content' in acks:
-            if not self.rating_percentage:
-                return _('waiting for content rating')
+            if not rating_percentage:
+                return 'wfcontentrating'
 
             if 'docs' in acks:
-                return _('complete')
+                return 'complete'
             elif 'user_docs' in acks:
-                return _('waiting for filing of documents')
+                return 'wffill'
             else:
-                return _('waiting for document submission')
+                return 'wfdocssub'
         elif 'precontent' in acks:
             if 'user_content' in acks:
-                return _('waiting for approval')
+                return 'wfapproval'
             else:
-                return _('waiting for submitting')
+                return 'wfsubmiting'
         else:
             if 'user_precontent' in acks:
-                return _('waiting for preapproval')
+                return 'wfpreapproval'
             elif 'user_content' in acks:
-                return _('waiting for approval')
+                return 'wfapproval'
             else:
-                return _('draft')
-    state_str.admin_order_field = 'state'
-    state_str.short_description = _('state')
+                return 'draft'
 
     def __unicode__(self):
         return '%s: %s' % (self.id , self.summary)
@@ -263,35 +496,81 @@ class Ticket(CachedModel):
     def media_count(self):
         return self.mediainfo_set.aggregate(objects=models.Count('id'), media=models.Sum('count'))
 
+    @staticmethod
+    def _bulk_media_count(tickets):
+        out = dict((t.id, {'objects': 0, 'media': None}) for t in tickets)
+        for row in MediaInfo.objects.filter(ticket__in=tickets).order_by().values('ticket_id').annotate(objects=models.Count('id'), media=models.Sum('count')):
+            out[row['ticket_id']] = {'objects': row['objects'], 'media': row['media']}
+        return out
+
     @cached_getter
     def expeditures(self):
         return self.expediture_set.aggregate(count=models.Count('id'), amount=models.Sum('amount'))
 
+    @staticmethod
+    def _bulk_expeditures(tickets):
+        out = dict((t.id, {'count': 0, 'amount': None}) for t in tickets)
+        for row in Expediture.objects.filter(ticket__in=tickets).order_by().values('ticket_id').annotate(count=models.Count('id'), total=models.Sum('amount')):
+            out[row['ticket_id']] = {'count': row['count'], 'amount': row['total']}
+        return out
+
     @cached_getter
     def preexpeditures(self):
         return self.preexpediture_set.aggregate(count=models.Count('id'), amount=models.Sum('amount'))
 
+    @staticmethod
+    def _bulk_preexpeditures(tickets):
+        out = dict((t.id, {'count': 0, 'amount': None}) for t in tickets)
+        for row in Preexpediture.objects.filter(ticket__in=tickets).order_by().values('ticket_id').annotate(count=models.Count('id'), total=models.Sum('amount')):
+            out[row['ticket_id']] = {'count': row['count'], 'amount': row['total']}
+        return out
+
+    @staticmethod
+    def rated_amount(total, rating_percentage):
+        """ Reduces given expediture total by ticket rating percentage. """
+        if rating_percentage == None:
+            return decimal.Decimal(0)
+        reduced = (total or decimal.Decimal(0)) * rating_percentage / 100
+        return reduced.quantize(decimal.Decimal('0.01'), rounding=decimal.ROUND_HALF_UP)
+
     @cached_getter
     def accepted_expeditures(self):
         if not self.has_all_acks('content') or (self.rating_percentage == None):
             return decimal.Decimal(0)
         else:
             total = sum([x.amount for x in self.expediture_set.all()], decimal.Decimal(0))
-            reduced = total * self.rating_percentage / 100
-            return reduced.quantize(decimal.Decimal('0.01'), rounding=decimal.ROUND_HALF_UP)
+            return Ticket.rated_amount(total, self.rating_percentage)
+
+    @staticmethod
+    def _bulk_accepted_expeditures(tickets):
+        totals = dict(Expediture.objects.filter(ticket__in=tickets).order_by().values_list('ticket_id').annotate(models.Sum('amount')))
+        out = {}
+        for t in tickets:
+            if t.has_all_acks('content'):
+                out[t.id] = Ticket.rated_amount(totals.get(t.id), t.rating_percentage)
+            else:
+                out[t.id] = decimal.Decimal(0)
+        return out
 
     @cached_getter
     def paid_expeditures(self):
-        if self.rating_percentage == None:
-            return decimal.Decimal(0)
-        else:
-            total = sum([x.amount for x in self.expediture_set.filter(paid=True)], decimal.Decimal(0))
-            reduced = total * self.rating_percentage / 100
-            return reduced.quantize(decimal.Decimal('0.01'), rounding=decimal.ROUND_HALF_UP)
+        total = sum([x.amount for x in self.expediture_set.filter(paid=True)], decimal.Decimal(0))
+        return Ticket.rated_amount(total, self.rating_percentage)
+
+    @staticmethod
+    def _bulk_paid_expeditures(tickets):
+        totals = dict(Expediture.objects.filter(ticket__in=tickets, paid=True).order_by().values_list('ticket_id').annotate(models.Sum('amount')))
+        return dict((t.id, Ticket.rated_amount(totals.get(t.id), t.rating_percentage)) for t in tickets)
     
     def watches(self, user, event):
         """Watches given user this ticket?"""
-        return self.topic.watches(user, event) or (user.is_authenticated() and len(TicketWatcher.objects.filter(ticket=self, user=user, notification_type=event)) > 0)
+        return event in self.watched_types(user)
+
+    def watched_types(self, user):
+        """ Set of notification types given user watches on this ticket or its topic. """
+        if not user.is_authenticated():
+            return set()
+        return self.topic.watched_types(user).union(TicketWatcher.objects.filter(ticket=self, user=user).values_list('notification_type', flat=True))
 
     def can_edit(self, user):
         """ Can given user edit this ticket through a non-admin interface? """
@@ -317,6 +596,13 @@ class Ticket(CachedModel):
     def ack_set(self):
         return set([x.ack_type for x in self.ticketack_set.only('ack_type')])
 
+    @staticmethod
+    def _bulk_ack_set(tickets):
+        out = dict((t.id, set()) for t in tickets)
+        for ticket_id, ack_type in TicketAck.objects.filter(ticket__in=tickets).values_list('ticket_id', 'ack_type'):
+            out[ticket_id].add(ack_type)
+        return out
+
     def has_ack(self, ack_type):
         return ack_type in self.ack_set()
 
@@ -347,10 +633,6 @@ class Ticket(CachedModel):
         """ List of PossibleAck objects, that can be added by ticket requester. """
         return [PossibleAck(ack_type) for ack_type in self.possible_user_ack_types()]
 
-    def flush_cache(self):
-        super(Ticket, self).flush_cache()
-        self.topic.flush_cache()
-
     class Meta:
         verbose_name = _('Ticket')
         verbose_name_plural = _('Tickets')
@@ -388,14 +670,22 @@ class FinanceStatus(object):
         except AttributeError:
             return NotImplemented
 
+    def add_ticket_sums(self, payment_status, rating_percentage, content_acked, paid_sum, unpaid_sum):
+        """ Adds ticket with given paid and unpaid expediture sums. """
+        if payment_status in ('unpaid', 'paid'):
+            if content_acked:
+                accepted = Ticket.rated_amount(paid_sum + unpaid_sum, rating_percentage)
+                if payment_status == 'unpaid':
+                    self.unpaid += accepted
+                else:
+                    self.paid += accepted
+        elif payment_status == 'partially_paid':
+            self.paid += paid_sum*(rating_percentage or 0)/100
+            self.unpaid += unpaid_sum*(rating_percentage or 0)/100
+
     def add_ticket(self, ticket):
-        if ticket.payment_status == 'unpaid':
-            self.unpaid += ticket.accepted_expeditures()
-        elif ticket.payment_status == 'paid':
-            self.paid += ticket.accepted_expeditures()
-        elif ticket.payment_status == 'partially_paid':
-            self.paid += sum([e.amount for e in Expediture.objects.filter(ticket_id=ticket.id, paid=True)])*ticket.rating_percentage/100
-            self.unpaid += sum([e.amount for e in Expediture.objects.filter(ticket_id=ticket.id, paid=False)])*ticket.rating_percentage/100
+        expeditures = dict(ticket.expediture_set.order_by().values_list('paid').annotate(models.Sum('amount')))
+        self.add_ticket_sums(ticket.payment_status, ticket.rating_percentage, ticket.has_all_acks('content'), expeditures.get(True, 0), expeditures.get(False, 0))
 
     def add_finance(self, other):
         self.fuzzy = self.fuzzy or other.fuzzy
@@ -407,66 +697,89 @@ class FinanceStatus(object):
     def as_dict(self):
         return {'fuzzy':self.fuzzy, 'unpaid':self.unpaid, 'paid':self.paid, 'overpaid':self.overpaid}
 
-class Subtopic(CachedModel):
-    name = models.CharField(_('name'), max_length=80)
-    description = models.TextField(_('description'), blank=True, help_text=_('Description shown to users who enter tickets for this subtopic'))
-    topic = models.ForeignKey('tracker.Topic', verbose_name=_('topic'), help_text=_('Topic where this subtopic belongs'))
+# payment_status values as stored by Ticket.update_payment_status
+TICKET_PAYMENT_STATUSES = ('n/a', 'unpaid', 'partially_paid', 'paid', 'overpaid')
 
-    def __unicode__(self):
-        return self.name
+# TopicSummary fields, summed as integers
+TOPIC_SUMMARY_COUNTS = ['tickets_count', 'media_objects', 'media_files', 'expeditures_count', 'preexpeditures_count'] + ['tickets_' + status.replace('/', '_') for status in TICKET_PAYMENT_STATUSES]
+TOPIC_SUMMARY_AMOUNTS = ['expeditures_amount', 'preexpeditures_amount', 'accepted_amount', 'paid_wages_amount', 'paid_together_amount', 'finance_unpaid', 'finance_paid']
 
-    @cached_getter
-    def media_count(self):
-        return MediaInfo.objects.extra(where=['ticket_id in (select ticket_id from tracker_ticket where subtopic_id = %s)'], params=[self.id]).aggregate(objects=models.Count('id'), media=models.Sum('count'))
+def _summary_totals(summary):
+    """ Aggregates summing TopicSummary rows at given lookup path, named like TopicSummary fields. """
+    totals = dict((name, Coalesce(models.Sum(summary + name), models.Value(0), output_field=models.IntegerField())) for name in TOPIC_SUMMARY_COUNTS)
+    for name in TOPIC_SUMMARY_AMOUNTS:
+        totals[name] = models.Sum(summary + name)
+    return totals
 
-    @cached_getter
-    def expeditures(self):
-        return Expediture.objects.extra(where=['ticket_id in (select ticket_id from tracker_ticket where subtopic_id = %s)'], params=[self.id]).aggregate(count=models.Count('id'), amount=models.Sum('amount'))
+class TicketTotalsQuerySet(models.QuerySet):
+    """ QuerySet of ticket containers (topics, subtopics) able to annotate their ticket totals. """
 
-    @cached_getter
-    def preexpeditures(self):
-        return Preexpediture.objects.extra(where=['ticket_id in (select ticket_id from tracker_ticket where subtopic_id = %s)'], params=[self.id]).aggregate(count=models.Count('id'), amount=models.Sum('amount'))
+    def with_totals(self):
+        """ Annotates all objects with ticket totals summed from their TopicSummary rows. """
+        return self.annotate(**_summary_totals('topicsummary__'))
 
-    @cached_getter
-    def accepted_expeditures(self):
-        return sum([t.accepted_expeditures() for t in self.ticket_set.filter(rating_percentage__gt=0)])
+class TicketTotalsMixin(object):
+    """ Ticket totals of topics and subtopics, taken from TicketTotalsQuerySet.with_totals when annotated. """
+
+    def ticket_totals(self):
+        """ Dict of ticket totals as annotated by with_totals, or queried when this object was loaded without them. """
+        if hasattr(self, 'tickets_count'):
+            return dict((name, getattr(self, name)) for name in TOPIC_SUMMARY_COUNTS + TOPIC_SUMMARY_AMOUNTS)
+        return type(self).objects.filter(id=self.id).aggregate(**_summary_totals('topicsummary__'))
+
+    def ticket_count(self):
+        return self.ticket_totals()['tickets_count']
 
-    @cached_getter
     def tickets_per_payment_status(self):
+        totals = self.ticket_totals()
         out = {}
-        tickets = self.ticket_set.order_by() # remove default ordering as it b0rks our aggregation
-        for s in tickets.values('payment_status').annotate(models.Count('payment_status')):
-            out[s['payment_status']] = s['payment_status__count']
+        for status in TICKET_PAYMENT_STATUSES:
+            count = totals['tickets_' + status.replace('/', '_')]
+            if count:
+                out[status] = count
         return out
 
-    @cached_getter
     def paid_wages(self):
-        tosum = []
-        for ticket in self.ticket_set.filter(id__gt=0):
-            ticketsum = []
-            for expediture in ticket.expediture_set.filter(wage=True, paid=True):
-                ticketsum.append(expediture.amount)
-            if ticket.rating_percentage:
-                tosum.append(sum(ticketsum)*ticket.rating_percentage/100)
-        return sum(tosum)
+        return self.ticket_totals()['paid_wages_amount'] or decimal.Decimal(0)
 
-    @cached_getter
     def paid_together(self):
-        tosum = []
-        for ticket in self.ticket_set.filter(id__gt=0):
-            ticketsum = []
-            for expediture in ticket.expediture_set.filter(paid=True):
-                ticketsum.append(expediture.amount)
-            if ticket.rating_percentage:
-                tosum.append(sum(ticketsum)*ticket.rating_percentage/100)
-        return sum(tosum)
+        return self.ticket_totals()['paid_together_amount'] or decimal.Decimal(0)
+
+    def media_count(self):
+        totals = self.ticket_totals()
+        return {'objects': totals['media_objects'], 'media': totals['media_files'] or None}
+
+    def expeditures(self):
+        totals = self.ticket_totals()
+        return {'count': totals['expeditures_count'], 'amount': totals['expeditures_amount']}
+
+    def preexpeditures(self):
+        totals = self.ticket_totals()
+        return {'count': totals['preexpeditures_count'], 'amount': totals['preexpeditures_amount']}
+
+    def accepted_expeditures(self):
+        return self.ticket_totals()['accepted_amount'] or decimal.Decimal(0)
+
+    def payment_summary(self):
+        totals = self.ticket_totals()
+        return FinanceStatus(unpaid=totals['finance_unpaid'] or 0, paid=totals['finance_paid'] or 0)
+
+class Subtopic(CommitHooksOnDeleteMixin, TicketTotalsMixin, models.Model):
+    name = models.CharField(_('name'), max_length=80)
+    description = models.TextField(_('description'), blank=True, help_text=_('Description shown to users who enter tickets for this subtopic'))
+    topic = models.ForeignKey('tracker.Topic', verbose_name=_('topic'), help_text=_('Topic where this subtopic belongs'))
+
+    objects = TicketTotalsQuerySet.as_manager()
+
+    def __unicode__(self):
+        return self.name
 
     class Meta:
         verbose_name = _('Subtopic')
         verbose_name_plural = _('Subtopics')
         ordering = ['name']
 
-class Topic(CachedModel):
+class Topic(CommitHooksOnDeleteMixin, TicketTotalsMixin, models.Model):
     """ Topics according to which the tickets are grouped. """
     name = models.CharField(_('name'), max_length=80)
     grant = models.ForeignKey('tracker.Grant', verbose_name=_('grant'), help_text=_('Grant project where this topic belongs'))
@@ -478,69 +791,23 @@ class Topic(CachedModel):
     form_description = models.TextField(_('form description'), blank=True, help_text=_('Description shown to users who enter tickets for this topic'))
     admin = models.ManyToManyField('auth.User', verbose_name=_('topic administrator'), blank=True, help_text=_('Selected users will have administration access to this topic.'))
 
+    objects = TicketTotalsQuerySet.as_manager()
+
     def __unicode__(self):
         return self.name
 
     def get_absolute_url(self):
         return reverse('topic_detail', kwargs={'pk':self.id})
 
-    @cached_getter
-    def media_count(self):
-        return MediaInfo.objects.extra(where=['ticket_id in (select id from tracker_ticket where topic_id = %s)'], params=[self.id]).aggregate(objects=models.Count('id'), media=models.Sum('count'))
-
-    @cached_getter
-    def expeditures(self):
-        return Expediture.objects.extra(where=['ticket_id in (select id from tracker_ticket where topic_id = %s)'], params=[self.id]).aggregate(count=models.Count('id'), amount=models.Sum('amount'))
-
-    @cached_getter
-    def preexpeditures(self):
-        return Preexpediture.objects.extra(where=['ticket_id in (select id from tracker_ticket where topic_id = %s)'], params=[self.id]).aggregate(count=models.Count('id'), amount=models.Sum('amount'))
-
-    @cached_getter
-    def accepted_expeditures(self):
-        return sum([t.accepted_expeditures() for t in self.ticket_set.filter(rating_percentage__gt=0)])
-
-    @cached_getter
-    def tickets_per_payment_status(self):
-        out = {}
-        tickets = self.ticket_set.order_by() # remove default ordering as it b0rks our aggregation
-        for s in tickets.values('payment_status').annotate(models.Count('payment_status')):
-            out[s['payment_status']] = s['payment_status__count']
-        return out
-
-    @cached_getter
-    def paid_wages(self):
-        tosum = []
-        for ticket in self.ticket_set.filter(id__gt=0):
-            ticketsum = []
-            for expediture in ticket.expediture_set.filter(wage=True, paid=True):
-                ticketsum.append(expediture.amount)
-            if ticket.rating_percentage:
-                tosum.append(sum(ticketsum)*ticket.rating_percentage/100)
-        return sum(tosum)
-
-    @cached_getter
-    def paid_together(self):
-        tosum = []
-        for ticket in self.ticket_set.filter(id__gt=0):
-            ticketsum = []
-            for expediture in ticket.expediture_set.filter(paid=True):
-                ticketsum.append(expediture.amount)
-            if ticket.rating_percentage:
-                tosum.append(sum(ticketsum)*ticket.rating_percentage/100)
-        return sum(tosum)
-
-    @cached_getter
-    def payment_summary(self):
-        finance = FinanceStatus()
-        for ticket in self.ticket_set.all():
-            finance.add_ticket(ticket)
-
-        return finance
-    
     def watches(self, user, event):
         """Watches given user this topic?"""
-        return user.is_authenticated() and len(TopicWatcher.objects.filter(topic=self, user=user, notification_type=event)) > 0
+        return event in self.watched_types(user)
+
+    def watched_types(self, user):
+        """ Set of notification types given user watches on this topic. """
+        if not user.is_authenticated():
+            return set()
+        return set(TopicWatcher.objects.filter(topic=self, user=user).values_list('notification_type', flat=True))
 
     class Meta:
         verbose_name = _('Topic')
@@ -563,20 +830,52 @@ class Grant(models.Model):
     def get_absolute_url(self):
         return reverse('grant_detail', kwargs={'slug':self.slug})
 
+    def totals(self):
+        """ Ticket totals across all topics of this grant, summed from its TopicSummary rows by one query. """
+        if not hasattr(self, '_totals'):
+            self._totals = TopicSummary.objects.filter(grant=self).aggregate(**_summary_totals(''))
+        return self._totals
+
     def total_tickets(self):
-        return sum([x.ticket_set.count() for x in self.topic_set.all()])
+        return self.totals()['tickets_count']
 
     def total_paid_wages(self):
-        return sum([x.paid_wages() for x in self.topic_set.all()])
+        return self.totals()['paid_wages_amount'] or decimal.Decimal(0)
 
     def total_paid_together(self):
-        return sum([x.paid_together() for x in self.topic_set.all()])
+        return self.totals()['paid_together_amount'] or decimal.Decimal(0)
 
     class Meta:
         verbose_name = _('Grant')
         verbose_name_plural = _('Grants')
         ordering = ['full_name']
 
+TOPICS_VERSION_KEY = u'm:topics:_version'
+
+def topics_version():
+    """ Cached version of all topics and subtopics; it is the time of their last change. """
+    version = cache.get(TOPICS_VERSION_KEY)
+    if version is None:
+        cache.add(TOPICS_VERSION_KEY, time.time())
+        version = cache.get(TOPICS_VERSION_KEY)
+    return version
+
+def bump_topics_version():
+    cache.set(TOPICS_VERSION_KEY, max(time.time(), (cache.get(TOPICS_VERSION_KEY) or 0) + 0.001))
+
+def topics_changed():
+    """ Bumps the topics version once changes of topics or subtopics are committed. """
+    # bumping inside a transaction would let other requests cache the old
+    # topics under the new version
+    after_commit(bump_topics_version)
+
+@receiver(post_save, sender=Topic)
+@receiver(post_delete, sender=Topic)
+@receiver(post_save, sender=Subtopic)
+@receiver(post_delete, sender=Subtopic)
+def update_topics_version(sender, **kwargs):
+    topics_changed()
+
 
 @receiver(comment_was_posted)
 def ticket_note_comment(sender, comment, **kwargs):
@@ -598,7 +897,7 @@ class MediaInfo(models.Model):
         verbose_name = _('Ticket media')
         verbose_name_plural = _('Ticket media')
 
-class Expediture(models.Model):
+class Expediture(CommitHooksOnDeleteMixin, models.Model):
     """ Expenses related to particular tickets. """
     ticket = models.ForeignKey('tracker.Ticket', verbose_name=_('ticket'), help_text=_('Ticket this expediture belongs to'))
     description = models.CharField(_('description'), max_length=255, help_text=_('Description of this expediture'))
@@ -619,7 +918,7 @@ class Expediture(models.Model):
         verbose_name = _('Ticket expediture')
         verbose_name_plural = _('Ticket expeditures')
 
-class Preexpediture(models.Model):
+class Preexpediture(CommitHooksOnDeleteMixin, models.Model):
     """Preexpeditures related to particular tickets. """
     ticket = models.ForeignKey('tracker.Ticket', verbose_name=_('ticket'), help_text=_('Ticket this preexpediture belogns to'))
     description = models.CharField(_('description'), max_length=255, help_text=_('Description of this preexpediture'))
@@ -670,6 +969,10 @@ class Document(models.Model):
 
 from django.contrib.auth.models import User
 
+def _content_acked_ticket_ids():
+    """ Subquery of content acked ticket ids for ticket__in filters, joining the acks to tickets. """
+    return Ticket.objects.filter(ticketack__ack_type='content').values('id')
+
 class TrackerProfile(models.Model):
     user = models.OneToOneField(User)
     bank_account = models.CharField(_('Bank account'), max_length=120, blank=True, help_text=_('Bank account information for money transfers'))
@@ -681,20 +984,19 @@ class TrackerProfile(models.Model):
         return reverse('user_detail', kwargs={'username':self.user.username})
 
     def media_count(self):
-        return MediaInfo.objects.extra(where=['ticket_id in (select id from tracker_ticket where requested_user_id = %s)'], params=[self.user.id]).aggregate(objects=models.Count('id'), media=models.Sum('count'))
+        return MediaInfo.objects.filter(ticket__requested_user=self.user).aggregate(objects=models.Count('id'), media=models.Sum('count'))
 
     def accepted_expeditures(self):
-        return sum([t.accepted_expeditures() for t in self.user.ticket_set.filter(rating_percentage__gt=0)])
+        """ Sum of Ticket.accepted_expeditures over tickets of this user, from one query grouped by ticket. """
+        accepted = Expediture.objects.filter(ticket__requested_user=self.user, ticket__rating_percentage__gt=0, ticket__in=_content_acked_ticket_ids())
+        rows = accepted.order_by().values_list('ticket_id', 'ticket__rating_percentage').annotate(models.Sum('amount'))
+        return sum((Ticket.rated_amount(amount, rating_percentage) for ticket_id, rating_percentage, amount in rows), decimal.Decimal(0))
 
     def paid_expeditures(self):
-        tickets = self.user.ticket_set.all()
-        res = 0
-        for ticket in tickets:
-            res += sum(e.amount for e in Expediture.objects.filter(ticket_id=ticket.id, paid=True))
-        return res
+        return Expediture.objects.filter(ticket__requested_user=self.user, paid=True).aggregate(amount=models.Sum('amount'))['amount'] or 0
 
     def count_ticket_created(self):
-        return len(self.user.ticket_set.all())
+        return self.user.ticket_set.count()
 
     def transactions(self):
         return Transaction.objects.filter(other=self.user).aggregate(count=models.Count('id'), amount=models.Sum('amount'))
@@ -705,6 +1007,13 @@ class TrackerProfile(models.Model):
         for muted_notification in json.loads(self.muted_notifications): res.append(muted_notification)
         return res
 
+    def muted_notification_set(self):
+        """ Muted notification types as a set, parsed once per instance. """
+        if getattr(self, '_muted_source', None) != self.muted_notifications:
+            self._muted_set = set(self.get_muted_notifications())
+            self._muted_source = self.muted_notifications
+        return self._muted_set
+
     def __unicode__(self):
         return unicode(self.user)
 
@@ -720,7 +1029,7 @@ def create_user_profile(sender, **kwargs):
     user = kwargs['instance']
     profile = TrackerProfile.objects.create(user=user)
 
-class Transaction(models.Model):
+class Transaction(ClusterMemberMixin, models.Model):
     """ One payment to or from the user. """
     date = models.DateField(_('date'))
     other = models.ForeignKey('auth.User', verbose_name=_('other party'), blank=True, null=True, help_text=_('The other party; user who sent or received the payment'))
@@ -810,13 +1119,704 @@ class TicketAck(models.Model):
 @receiver(post_save, sender=TicketAck)
 def flush_ticket_after_ack_save(sender, instance, created, raw, **kwargs):
     if not raw:
+        instance.ticket.update_state(save_afterwards=False)
         instance.ticket.update_payment_status()
 
 
 @receiver(post_delete, sender=TicketAck)
 def flush_ticket_after_ack_delete(sender, instance, **kwargs):
+    instance.ticket.update_state(save_afterwards=False)
     instance.ticket.update_payment_status()
 
+def _ticket_list_items(tickets):
+    """
+    (ticket id, row) pairs of the public ticket list (see tracker/index.html)
+    for given ticket queryset. Rather than calling cached getters ticket by
+    ticket, this runs one query for tickets with their topic, grant and user,
+    and one grouped query each over expeditures, preexpeditures and acks.
+    """
+    tickets = tickets.select_related('topic__grant', 'requested_user')
+    ticket_ids = tickets.order_by().values('id')
+
+    expeditures = {}
+    paid_amount = models.Case(models.When(paid=True, then='amount'), default=models.Value(0), output_field=models.DecimalField())
+    for row in Expediture.objects.filter(ticket__in=ticket_ids).order_by().values('ticket_id').annotate(total=models.Sum('amount'), paid_total=models.Sum(paid_amount)):
+        expeditures[row['ticket_id']] = row
+
+    preexpeditures = {}
+    for row in Preexpediture.objects.filter(ticket__in=ticket_ids).order_by().values('ticket_id').annotate(total=models.Sum('amount')):
+        preexpeditures[row['ticket_id']] = row['total']
+
+    acks = {}
+    for ticket_id, ack_type in TicketAck.objects.filter(ticket__in=ticket_ids).order_by().values_list('ticket_id', 'ack_type').distinct():
+        acks.setdefault(ticket_id, set()).add(ack_type)
+
+    for ticket in tickets:
+        ticket_acks = acks.get(ticket.id, set())
+        ticket_expeditures = expeditures.get(ticket.id, {})
+        if 'content' in ticket_acks:
+            accepted = Ticket.rated_amount(ticket_expeditures.get('total'), ticket.rating_percentage)
+        else:
+            accepted = decimal.Decimal(0)
+        paid = Ticket.rated_amount(ticket_expeditures.get('paid_total'), ticket.rating_percentage)
+        grant = ticket.topic.grant
+        yield ticket.id, [
+            '<a href="%s">%s</a>' % (ticket.get_absolute_url(), ticket.pk),
+            unicode(ticket.event_date),
+            '<a class="ticket-summary" href="%s">%s</a>' % (ticket.get_absolute_url(), ticket.summary),
+            '<a href="%s">%s</a>' % (grant.get_absolute_url(), grant),
+            '<a href="%s">%s</a>' % (ticket.topic.get_absolute_url(), ticket.topic),
+            ticket.requested_by_html(),
+            "%s %s" % (preexpeditures.get(ticket.id) or 0, settings.TRACKER_CURRENCY),
+            "%s %s" % (accepted, settings.TRACKER_CURRENCY),
+            "%s %s" % (paid, settings.TRACKER_CURRENCY),
+            unicode(ticket.state_str()),
+            unicode(ticket.updated),
+        ]
+
+def ticket_list_rows(tickets):
+    """ Rows of the public ticket list for given ticket queryset. """
+    return [row for ticket_id, row in _ticket_list_items(tickets)]
+
+class TicketListRow(models.Model):
+    """ Rendered row of the public ticket list, maintained per ticket and language. """
+    ticket_id = models.IntegerField() # not a foreign key, rows of deleted tickets are dropped by flush_ticket_list()
+    language = models.CharField(max_length=10)
+    data = models.TextField() # JSON encoded row
+
+    def __unicode__(self):
+        return u'%s (%s)' % (self.ticket_id, self.language)
+
+    class Meta:
+        unique_together = ('ticket_id', 'language')
+
+def write_ticket_list_file(langcode):
+    """
+    Atomically rewrites TRACKER_PUBLIC_DEPLOY_ROOT/tickets/<langcode>.json
+    from stored rows. No rendering happens here, rows are just joined.
+    """
+    deploy_root = getattr(settings, 'TRACKER_PUBLIC_DEPLOY_ROOT', None)
+    if deploy_root is None:
+        return
+
+    rows = TicketListRow.objects.filter(language=langcode).order_by('-ticket_id').values_list('data', flat=True)
+    target = os.path.join(deploy_root, 'tickets', '%s.json' % langcode)
+    tmpname = None
+    try:
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write('{"data": [')
+            f.write(', '.join(rows))
+            f.write(']}')
+        os.chmod(tmpname, 0644)
+        os.rename(tmpname, target)
+    except (IOError, OSError):
+        # the stored rows stay right, the file catches up on the next write
+        logger.exception('Cannot write ticket list file %s', target)
+        if tmpname is not None and os.path.exists(tmpname):
+            os.remove(tmpname)
+
+def update_ticket_list(ticket_ids=None):
+    """
+    Re-renders stored ticket list rows for given ticket ids (all tickets if
+    None) in all languages and rewrites the ticket list files.
+    """
+    if ticket_ids is None:
+        tickets = Ticket.objects.order_by('-id')
+        stored = TicketListRow.objects.all()
+    else:
+        tickets = Ticket.objects.filter(id__in=ticket_ids)
+        stored = TicketListRow.objects.filter(ticket_id__in=ticket_ids)
+
+    for langcode, langname in settings.LANGUAGES:
+        with translation.override(langcode):
+            rows = [
+                TicketListRow(ticket_id=ticket_id, language=langcode, data=json.dumps(row))
+                for ticket_id, row in _ticket_list_items(tickets)
+            ]
+        stored.filter(language=langcode).delete()
+        TicketListRow.objects.bulk_create(rows)
+        write_ticket_list_file(langcode)
+
+class TicketListQueue(threading.local):
+    """ Ids of tickets changed in this thread whose ticket list rows wait for flush_ticket_list. """
+    def __init__(self):
+        self.ticket_ids = set()
+
+ticket_list_queue = TicketListQueue()
+
+def ticket_list_changed(ticket_ids):
+    """ Marks ticket list rows of given tickets for re-rendering by flush_ticket_list once the changes are committed. """
+    ticket_list_queue.ticket_ids.update(ticket_ids)
+    after_commit(flush_ticket_list)
+
+def flush_ticket_list():
+    """
+    Re-renders rows of tickets changed since the last flush, however many
+    times they were saved, and rewrites the ticket list files once. Rows of
+    deleted tickets are just dropped.
+    """
+    if ticket_list_queue.ticket_ids:
+        ticket_ids = list(ticket_list_queue.ticket_ids)
+        ticket_list_queue.ticket_ids.clear()
+        update_ticket_list(ticket_ids)
+
+@receiver(post_save, sender=Ticket)
+@receiver(post_delete, sender=Ticket)
+def update_ticket_list_after_ticket_change(sender, instance, **kwargs):
+    # this also covers TicketAck saves/deletes and Expediture saves, which all
+    # end up in Ticket.save() through update_payment_status()
+    if not kwargs.get('raw', False):
+        ticket_list_changed([instance.id])
+
+@receiver(post_save, sender=Preexpediture)
+@receiver(post_delete, sender=Preexpediture)
+@receiver(post_delete, sender=Expediture)
+def update_ticket_list_after_item_change(sender, instance, **kwargs):
+    if not kwargs.get('raw', False):
+        ticket_list_changed([instance.ticket_id])
+
+def _cluster_components(pairs):
+    """
+    Union-find over (transaction id, ticket id) pairs. Returns dict mapping
+    cluster id (lowest ticket id) to (set of ticket ids, set of transaction ids).
+    """
+    parent = {}
+
+    def find(ticket_id):
+        root = parent.setdefault(ticket_id, ticket_id)
+        while root != parent[root]:
+            parent[root] = parent[parent[root]]
+            root = parent[root]
+        return root
+
+    first_ticket = {}
+    for transaction_id, ticket_id in pairs:
+        a, b = find(first_ticket.setdefault(transaction_id, ticket_id)), find(ticket_id)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    components = {}
+    for ticket_id in parent:
+        components.setdefault(find(ticket_id), (set(), set()))[0].add(ticket_id)
+    for transaction_id, ticket_id in first_ticket.items():
+        components[find(ticket_id)][1].add(transaction_id)
+    return components
+
+def _store_clusters(components, old_cluster_ids):
+    """ Replaces given old clusters with given components (see _cluster_components). """
+    Ticket.objects.filter(cluster_id__in=old_cluster_ids).update(cluster=None)
+    Transaction.objects.filter(cluster_id__in=old_cluster_ids).update(cluster=None)
+    Cluster.objects.filter(id__in=old_cluster_ids).exclude(id__in=components.keys()).delete()
+
+    for cluster_id, (ticket_ids, transaction_ids) in components.items():
+        Cluster.objects.update_or_create(id=cluster_id, defaults={'more_tickets': len(ticket_ids) > 1})
+        # plain updates, ticket save side effects are not wanted here
+        Ticket.objects.filter(id__in=ticket_ids).update(cluster=cluster_id)
+        Transaction.objects.filter(id__in=transaction_ids).update(cluster=cluster_id)
+    update_cluster_totals(components.keys())
+
+def update_cluster_totals(cluster_ids):
+    """ Refreshes total_tickets and total_transactions of given clusters. """
+    # accepted expeditures are summed from the database, as this runs from
+    # Ticket.save() before its cached getters get flushed
+    tickets = Ticket.objects.filter(cluster_id__in=cluster_ids)
+    content_acked = set(TicketAck.objects.filter(ticket__in=tickets, ack_type='content').values_list('ticket_id', flat=True))
+    expeditures = dict(Expediture.objects.filter(ticket__in=tickets).order_by().values_list('ticket_id').annotate(models.Sum('amount')))
+    transactions = Transaction.objects.filter(cluster_id__in=cluster_ids).order_by().values_list('cluster_id').annotate(models.Sum('amount'))
+
+    totals = dict((cluster_id, [decimal.Decimal(0), decimal.Decimal(0)]) for cluster_id in cluster_ids)
+    for ticket_id, cluster_id, rating_percentage in tickets.values_list('id', 'cluster_id', 'rating_percentage'):
+        if ticket_id in content_acked:
+            totals[cluster_id][0] += Ticket.rated_amount(expeditures.get(ticket_id), rating_percentage)
+    for cluster_id, amount in transactions:
+        totals[cluster_id][1] += amount
+    for cluster_id, (total_tickets, total_transactions) in totals.items():
+        Cluster.objects.filter(id=cluster_id).update(total_tickets=total_tickets, total_transactions=total_transactions)
+
+def rebuild_clusters():
+    """ Recomputes all clusters from scratch, in one pass over transaction tickets. """
+    components = _cluster_components(Transaction.tickets.through.objects.values_list('transaction_id', 'ticket_id').iterator())
+    _store_clusters(components, Cluster.objects.values_list('id', flat=True))
+
+def update_clusters(ticket_ids=(), cluster_ids=()):
+    """
+    Recomputes only clusters around given tickets and (old) clusters, after
+    their transactions changed. Clusters get merged or split as needed.
+    """
+    through = Transaction.tickets.through
+    pairs = set()
+    seen_tickets = set()
+    old_cluster_ids = set(cluster_ids)
+    new_tickets, new_clusters = set(ticket_ids), set(old_cluster_ids)
+    # walk everything reachable from given tickets, through both current
+    # transaction links and old cluster membership
+    while new_tickets or new_clusters:
+        new_tickets.update(Ticket.objects.filter(cluster_id__in=new_clusters).values_list('id', flat=True))
+        new_tickets -= seen_tickets
+        seen_tickets.update(new_tickets)
+        new_clusters = set(Ticket.objects.filter(id__in=new_tickets).exclude(cluster=None).values_list('cluster_id', flat=True)) - old_cluster_ids
+        old_cluster_ids.update(new_clusters)
+
+        transaction_ids = through.objects.filter(ticket_id__in=new_tickets).values('transaction_id')
+        new_pairs = set(through.objects.filter(transaction_id__in=transaction_ids).values_list('transaction_id', 'ticket_id')) - pairs
+        pairs.update(new_pairs)
+        new_tickets = set(ticket_id for transaction_id, ticket_id in new_pairs) - seen_tickets
+
+    _store_clusters(_cluster_components(pairs), old_cluster_ids)
+
+def _stored_cluster_ids(model, pk):
+    """ Cluster id of given object as stored, in-memory instances may be stale. """
+    return list(model.objects.filter(pk=pk).exclude(cluster=None).values_list('cluster_id', flat=True))
+
+@receiver(m2m_changed, sender=Transaction.tickets.through)
+def update_clusters_after_transaction_tickets_change(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # ticket.transaction_set changed
+        update_clusters(ticket_ids=[instance.id], cluster_ids=Transaction.objects.filter(id__in=pk_set or ()).exclude(cluster=None).values_list('cluster_id', flat=True))
+    else:
+        update_clusters(ticket_ids=pk_set or (), cluster_ids=_stored_cluster_ids(Transaction, instance.id))
+
+@receiver(post_save, sender=Transaction)
+@receiver(post_save, sender=Ticket)
+def update_cluster_after_save(sender, instance, raw, **kwargs):
+    if not raw:
+        update_cluster_totals(_stored_cluster_ids(sender, instance.id))
+
+@receiver(pre_delete, sender=Transaction)
+@receiver(pre_delete, sender=Ticket)
+def remember_cluster_before_delete(sender, instance, **kwargs):
+    instance._stored_cluster_ids = _stored_cluster_ids(sender, instance.id)
+
+@receiver(post_delete, sender=Transaction)
+@receiver(post_delete, sender=Ticket)
+def update_clusters_after_delete(sender, instance, **kwargs):
+    if instance._stored_cluster_ids:
+        update_clusters(cluster_ids=instance._stored_cluster_ids)
+
+class UserLedger(models.Model):
+    """ Totals of tickets requested by one user, as shown by the user list; changed along TicketSummary rows, rebuilt by update_user_ledgers. """
+    user_id = models.IntegerField(unique=True, null=True) # not a foreign key, None stands for tickets without a user
+    ticket_count = models.IntegerField(default=0)
+    media_objects = models.IntegerField(default=0)
+    media_files = models.IntegerField(default=0)
+    accepted_expeditures = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    paid_expeditures = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    transactions = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    def __unicode__(self):
+        return unicode(self.user_id)
+
+def _user_filter(field, user_ids):
+    """ Q matching given user ids at given lookup path, None matching no user. """
+    query = models.Q(**{field + '__in': [user_id for user_id in user_ids if user_id is not None]})
+    if None in user_ids:
+        query |= models.Q(**{field: None})
+    return query
+
+def update_user_ledgers(user_ids=None):
+    """
+    Recomputes UserLedger rows of given user ids from the database, in a
+    constant number of queries; rows of all users when user_ids is None.
+    """
+    if user_ids is None:
+        user_ids = set(User.objects.values_list('id', flat=True)) | set([None])
+        users = lambda field: models.Q()
+    else:
+        user_ids = set(user_ids)
+        users = lambda field: _user_filter(field, user_ids)
+    if not user_ids:
+        return
+    ledgers = dict((user_id, UserLedger(user_id=user_id)) for user_id in user_ids)
+    tickets = Ticket.objects.filter(users('requested_user'))
+
+    for user_id, count in tickets.order_by().values_list('requested_user_id').annotate(models.Count('id')):
+        ledgers[user_id].ticket_count = count
+    for user_id, objects, files in MediaInfo.objects.filter(users('ticket__requested_user')).order_by().values_list('ticket__requested_user_id').annotate(models.Count('id'), models.Sum('count')):
+        ledgers[user_id].media_objects, ledgers[user_id].media_files = objects, files or 0
+    # rounded per ticket, like Ticket.accepted_expeditures
+    accepted = Expediture.objects.filter(users('ticket__requested_user'), ticket__rating_percentage__gt=0, ticket__in=_content_acked_ticket_ids())
+    for user_id, rating_percentage, ticket_id, amount in accepted.order_by().values_list('ticket__requested_user_id', 'ticket__rating_percentage', 'ticket_id').annotate(models.Sum('amount')):
+        ledgers[user_id].accepted_expeditures += Ticket.rated_amount(amount, rating_percentage)
+    for user_id, amount in Expediture.objects.filter(users('ticket__requested_user'), paid=True).order_by().values_list('ticket__requested_user_id').annotate(models.Sum('amount')):
+        ledgers[user_id].paid_expeditures = amount
+    for user_id, amount in Transaction.objects.filter(users('other')).order_by().values_list('other_id').annotate(models.Sum('amount')):
+        ledgers[user_id].transactions = amount
+
+    with transaction.atomic():
+        UserLedger.objects.filter(users('user_id')).delete()
+        UserLedger.objects.bulk_create(ledgers.values())
+
+def _add_to_user_ledger(user_id, changes):
+    """ Adds given field changes to the UserLedger row of given user id, rebuilding the row when it is missing. """
+    updates = dict((name, models.F(name) + value) for name, value in changes.items() if value)
+    if updates and not UserLedger.objects.filter(user_id=user_id).update(**updates):
+        update_user_ledgers([user_id])
+
+# ticket totals are added by _replace_ticket_summaries, transactions here
+@receiver(pre_save, sender=Transaction)
+def remember_transaction_user(sender, instance, raw, **kwargs):
+    instance._stored_other = Transaction.objects.filter(pk=instance.pk).values_list('other_id', 'amount').first() if instance.pk else None
+
+@receiver(post_save, sender=Transaction)
+def update_user_ledger_after_transaction_save(sender, instance, raw, **kwargs):
+    if raw:
+        return
+    if instance._stored_other is not None:
+        other_id, amount = instance._stored_other
+        _add_to_user_ledger(other_id, {'transactions': -amount})
+    _add_to_user_ledger(instance.other_id, {'transactions': Transaction._meta.get_field('amount').to_python(instance.amount)})
+
+@receiver(post_delete, sender=Transaction)
+def update_user_ledger_after_transaction_delete(sender, instance, **kwargs):
+    _add_to_user_ledger(instance.other_id, {'transactions': -Transaction._meta.get_field('amount').to_python(instance.amount)})
+
+@receiver(post_save, sender=User)
+def create_user_ledger(sender, instance, created, raw, **kwargs):
+    # every user has a row, so that exports can filter the rows alone
+    if created and not raw:
+        UserLedger.objects.create(user_id=instance.id)
+
+@receiver(post_delete, sender=User)
+def delete_user_ledger(sender, instance, **kwargs):
+    UserLedger.objects.filter(user_id=instance.id).delete()
+
+class TicketTotals(models.Model):
+    """ Ticket totals fields of TopicSummary and TicketSummary; names listed by TOPIC_SUMMARY_COUNTS and TOPIC_SUMMARY_AMOUNTS. """
+    tickets_count = models.IntegerField(default=0)
+    tickets_n_a = models.IntegerField(default=0)
+    tickets_unpaid = models.IntegerField(default=0)
+    tickets_partially_paid = models.IntegerField(default=0)
+    tickets_paid = models.IntegerField(default=0)
+    tickets_overpaid = models.IntegerField(default=0)
+    media_objects = models.IntegerField(default=0)
+    media_files = models.IntegerField(default=0)
+    expeditures_count = models.IntegerField(default=0)
+    expeditures_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    preexpeditures_count = models.IntegerField(default=0)
+    preexpeditures_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    accepted_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    # paid amounts reduced by ticket rating percentage, rounded per ticket
+    paid_wages_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    paid_together_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    # FinanceStatus sums, partial payments are not rounded there
+    finance_unpaid = models.DecimalField(max_digits=14, decimal_places=4, default=0)
+    finance_paid = models.DecimalField(max_digits=14, decimal_places=4, default=0)
+
+    class Meta:
+        abstract = True
+
+class TopicSummary(TicketTotals):
+    """ Totals of tickets of one topic and subtopic, as shown by topic, grant and finance pages; sums of their TicketSummary rows. """
+    # no database constraints, rows are cleaned up by Topic post_delete handler
+    grant = models.ForeignKey('tracker.Grant', db_constraint=False, on_delete=models.DO_NOTHING)
+    topic = models.ForeignKey('tracker.Topic', db_constraint=False, on_delete=models.DO_NOTHING)
+    subtopic = models.ForeignKey('tracker.Subtopic', null=True, db_constraint=False, on_delete=models.DO_NOTHING)
+
+    def __unicode__(self):
+        return u'%s/%s' % (self.topic_id, self.subtopic_id)
+
+    class Meta:
+        unique_together = ('topic', 'subtopic')
+
+class TicketSummary(TicketTotals):
+    """ Totals of one ticket as currently added to the TopicSummary row of its topic and subtopic; maintained by update_ticket_summaries. """
+    # no database constraint, rows of deleted tickets are dropped by update_ticket_summaries
+    ticket = models.OneToOneField('tracker.Ticket', db_constraint=False, on_delete=models.DO_NOTHING)
+    topic_id = models.IntegerField()
+    subtopic_id = models.IntegerField(null=True)
+    requested_user_id = models.IntegerField(null=True) # UserLedger row the ticket is added to
+    # what the rated totals are computed from, so that a change of one ticket
+    # field or item does not need the rest of the ticket to be read again
+    payment_status = models.CharField(max_length=20, default='n/a')
+    rating_percentage = models.SmallIntegerField(null=True)
+    content_acked = models.BooleanField(default=False)
+    paid_sum = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    unpaid_sum = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    paid_wages_sum = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+
+    def __unicode__(self):
+        return unicode(self.ticket_id)
+
+    def compute_totals(self):
+        """ Sets payment status counts and rated amounts from payment status, rating, content ack and expediture sums of this row. """
+        for status in TICKET_PAYMENT_STATUSES:
+            setattr(self, 'tickets_' + status.replace('/', '_'), int(self.payment_status == status))
+        # rated and rounded per ticket, like Ticket.accepted_expeditures and FinanceStatus.add_ticket
+        self.paid_together_amount = Ticket.rated_amount(self.paid_sum, self.rating_percentage)
+        self.paid_wages_amount = Ticket.rated_amount(self.paid_wages_sum, self.rating_percentage)
+        if self.content_acked:
+            self.accepted_amount = Ticket.rated_amount(self.paid_sum + self.unpaid_sum, self.rating_percentage)
+        else:
+            self.accepted_amount = decimal.Decimal(0)
+        finance = FinanceStatus()
+        finance.add_ticket_sums(self.payment_status, self.rating_percentage, self.content_acked, self.paid_sum, self.unpaid_sum)
+        self.finance_unpaid, self.finance_paid = finance.unpaid, finance.paid
+
+# ticket fields copied to TicketSummary rows
+TICKET_SUMMARY_FIELDS = ('topic_id', 'subtopic_id', 'requested_user_id', 'payment_status', 'rating_percentage')
+
+def _ticket_summaries(tickets):
+    """
+    Unsaved TicketSummary rows of given ticket queryset computed from the
+    database, keyed by ticket id, in a constant number of queries.
+    """
+    summaries = {}
+    for values in tickets.order_by().values('id', *TICKET_SUMMARY_FIELDS):
+        ticket_id = values.pop('id')
+        summaries[ticket_id] = TicketSummary(ticket_id=ticket_id, tickets_count=1, **values)
+
+    # items of tickets created since the query above are skipped, they are counted on their own save
+    for ticket_id, objects, files in MediaInfo.objects.filter(ticket__in=tickets).order_by().values_list('ticket_id').annotate(models.Count('id'), models.Sum('count')):
+        if ticket_id in summaries:
+            summaries[ticket_id].media_objects, summaries[ticket_id].media_files = objects, files or 0
+    for ticket_id, count, amount in Preexpediture.objects.filter(ticket__in=tickets).order_by().values_list('ticket_id').annotate(models.Count('id'), models.Sum('amount')):
+        if ticket_id in summaries:
+            summaries[ticket_id].preexpeditures_count, summaries[ticket_id].preexpeditures_amount = count, amount
+
+    for ticket_id, paid, wage, count, amount in Expediture.objects.filter(ticket__in=tickets).order_by().values_list('ticket_id', 'paid', 'wage').annotate(models.Count('id'), models.Sum('amount')):
+        if ticket_id in summaries:
+            _add_to_ticket_summary(summaries[ticket_id], {'expeditures_count': count, 'expeditures_amount': amount})
+            _add_to_ticket_summary(summaries[ticket_id], _expediture_sums(paid, wage, amount))
+
+    for ticket_id in TicketAck.objects.filter(ack_type='content', ticket__in=tickets).values_list('ticket_id', flat=True):
+        if ticket_id in summaries:
+            summaries[ticket_id].content_acked = True
+    for summary in summaries.values():
+        summary.compute_totals()
+    return summaries
+
+def _add_to_ticket_summary(summary, additions):
+    for name, value in additions.items():
+        setattr(summary, name, getattr(summary, name) + value)
+
+def _expediture_sums(paid, wage, amount):
+    """ TicketSummary expediture sums given expediture amount belongs to. """
+    sums = {('paid_sum' if paid else 'unpaid_sum'): amount}
+    if paid and wage:
+        sums['paid_wages_sum'] = amount
+    return sums
+
+def _add_to_topic_summary(topic_id, subtopic_id, changes):
+    """ Adds given field changes to the TopicSummary row of given topic and subtopic, creating the row when it is missing. """
+    updates = dict((name, models.F(name) + value) for name, value in changes.items() if value)
+    if not updates:
+        return
+    rows = TopicSummary.objects.filter(topic_id=topic_id, subtopic_id=subtopic_id)
+    if rows.update(**updates):
+        if changes['tickets_count'] < 0:
+            # all totals come from tickets, so the last ticket leaving takes its row along
+            rows.filter(tickets_count=0).delete()
+        return
+    # MySQL does not enforce unique_together on rows with NULL subtopic, so
+    # creating rows is serialized by locking the topic row instead
+    grant_ids = list(Topic.objects.select_for_update().filter(id=topic_id).values_list('grant_id', flat=True))
+    if not grant_ids:
+        return # summaries of deleted topics are dropped anyway
+    if not rows.update(**updates): # or it was created while we waited for the lock
+        TopicSummary.objects.create(grant_id=grant_ids[0], topic_id=topic_id, subtopic_id=subtopic_id, **changes)
+
+# UserLedger fields and TicketSummary fields they sum
+USER_LEDGER_SUMS = (
+    ('ticket_count', 'tickets_count'),
+    ('media_objects', 'media_objects'),
+    ('media_files', 'media_files'),
+    ('accepted_expeditures', 'accepted_amount'),
+    ('paid_expeditures', 'paid_sum'),
+)
+
+def _replace_ticket_summaries(stored, current):
+    """ Adds the differences of replacing stored TicketSummary rows by current ones to TopicSummary and UserLedger rows. """
+    changes, ledger_changes = {}, {}
+    for summaries, sign in ((stored, -1), (current, 1)):
+        for summary in summaries:
+            fields = changes.setdefault((summary.topic_id, summary.subtopic_id), dict.fromkeys(TOPIC_SUMMARY_COUNTS + TOPIC_SUMMARY_AMOUNTS, 0))
+            for name in fields:
+                fields[name] += sign * getattr(summary, name)
+            fields = ledger_changes.setdefault(summary.requested_user_id, dict.fromkeys([name for name, summary_name in USER_LEDGER_SUMS], 0))
+            for name, summary_name in USER_LEDGER_SUMS:
+                fields[name] += sign * getattr(summary, summary_name)
+    for (topic_id, subtopic_id), fields in changes.items():
+        _add_to_topic_summary(topic_id, subtopic_id, fields)
+    for user_id, fields in ledger_changes.items():
+        _add_to_user_ledger(user_id, fields)
+
+def update_ticket_summaries(ticket_ids):
+    """
+    Recomputes TicketSummary rows of given ticket ids and adds their
+    differences to TopicSummary rows, so that the work depends on the given
+    tickets only, not on the size of their topics. Needed after item changes
+    bypassing signals, saves of single tickets and items are handled by
+    change_ticket_summary.
+    """
+    ticket_ids = set(ticket_ids)
+    if not ticket_ids:
+        return
+    with transaction.atomic():
+        stored = list(TicketSummary.objects.select_for_update().filter(ticket_id__in=ticket_ids))
+        current = _ticket_summaries(Ticket.objects.filter(id__in=ticket_ids))
+        _replace_ticket_summaries(stored, current.values())
+        TicketSummary.objects.filter(ticket_id__in=ticket_ids).delete()
+        TicketSummary.objects.bulk_create(current.values())
+
+def change_ticket_summary(ticket_id, values={}, additions={}):
+    """
+    Sets given values and adds given additions to fields of the TicketSummary
+    row of given ticket, and its resulting changes to TopicSummary rows. Only
+    the row itself is read, the ticket and its items are not.
+    """
+    with transaction.atomic():
+        stored = TicketSummary.objects.select_for_update().filter(ticket_id=ticket_id).first()
+        if stored is None:
+            # not summarized yet, e.g. saved with raw=True
+            update_ticket_summaries([ticket_id])
+            return
+        current = copy.copy(stored)
+        for name, value in values.items():
+            setattr(current, name, value)
+        _add_to_ticket_summary(current, additions)
+        current.compute_totals()
+        _replace_ticket_summaries([stored], [current])
+        current.save()
+
+def update_topic_summaries(topic_ids=None):
+    """
+    Rebuilds TicketSummary rows of tickets in given topic ids and TopicSummary
+    rows of those topics from the database, in a constant number of queries;
+    all rows when topic_ids is None. Needed after changes bypassing signals.
+    """
+    if topic_ids is None:
+        tickets, stored = Ticket.objects.all(), TicketSummary.objects.all()
+    else:
+        topic_ids = set(topic_ids)
+        if not topic_ids:
+            return
+        stored = TicketSummary.objects.filter(topic_id__in=topic_ids)
+        # tickets moved to or from these topics behind our back are rebuilt in both topics
+        tickets = Ticket.objects.filter(models.Q(topic_id__in=topic_ids) | models.Q(id__in=stored.values('ticket_id')))
+        stored = TicketSummary.objects.filter(models.Q(topic_id__in=topic_ids) | models.Q(ticket_id__in=tickets.values('id')))
+
+    with transaction.atomic():
+        current = _ticket_summaries(tickets)
+        if topic_ids is not None:
+            topic_ids.update(stored.values_list('topic_id', flat=True))
+            topic_ids.update(summary.topic_id for summary in current.values())
+        stored.delete()
+        TicketSummary.objects.bulk_create(current.values())
+
+        summaries, topics = TicketSummary.objects.all(), Topic.objects.all()
+        if topic_ids is not None:
+            summaries, topics = summaries.filter(topic_id__in=topic_ids), topics.filter(id__in=topic_ids)
+        # locked like in _add_to_topic_summary
+        grant_ids = dict(topics.select_for_update().values_list('id', 'grant_id'))
+        if topic_ids is not None:
+            TopicSummary.objects.filter(topic_id__in=topic_ids).delete()
+        else:
+            TopicSummary.objects.all().delete()
+        names = TOPIC_SUMMARY_COUNTS + TOPIC_SUMMARY_AMOUNTS
+        totals = summaries.order_by().values('topic_id', 'subtopic_id').annotate(**dict(('total_' + name, models.Sum(name)) for name in names))
+        TopicSummary.objects.bulk_create([
+            TopicSummary(grant_id=grant_ids[row['topic_id']], topic_id=row['topic_id'], subtopic_id=row['subtopic_id'], **dict((name, row['total_' + name]) for name in names))
+            for row in totals if row['topic_id'] in grant_ids
+        ])
+
+@receiver(pre_save, sender=Ticket)
+def note_ticket_summary_change(sender, instance, raw, **kwargs):
+    # changed_fields() is reset by the save
+    changed = instance.changed_fields()
+    instance._summary_changed = not raw and any(f.name in changed for f in Ticket._meta.concrete_fields if f.attname in TICKET_SUMMARY_FIELDS)
+
+@receiver(post_save, sender=Ticket)
+def update_ticket_summary_after_save(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+    values = dict((name, getattr(instance, name)) for name in TICKET_SUMMARY_FIELDS)
+    if created:
+        # a new ticket has no items and acks yet
+        summary = TicketSummary(ticket_id=instance.id, tickets_count=1, **values)
+        summary.compute_totals()
+        with transaction.atomic():
+            _replace_ticket_summaries([], [summary])
+            summary.save(force_insert=True)
+    elif instance._summary_changed:
+        change_ticket_summary(instance.id, values=values)
+
+@receiver(post_delete, sender=Ticket)
+def update_ticket_summary_after_delete(sender, instance, **kwargs):
+    with transaction.atomic():
+        stored = list(TicketSummary.objects.select_for_update().filter(ticket_id=instance.id))
+        _replace_ticket_summaries(stored, [])
+        TicketSummary.objects.filter(ticket_id=instance.id).delete()
+
+# fields of ticket items their TicketSummary sums depend on
+SUMMARY_ITEM_FIELDS = {
+    MediaInfo: ('ticket_id', 'count'),
+    Preexpediture: ('ticket_id', 'amount'),
+    Expediture: ('ticket_id', 'amount', 'paid', 'wage'),
+}
+
+def _item_summary_sums(sender, values):
+    """ TicketSummary fields and amounts one item with given SUMMARY_ITEM_FIELDS values adds to its ticket. """
+    if sender is MediaInfo:
+        return {'media_objects': 1, 'media_files': int(values['count'] or 0)}
+    amount = sender._meta.get_field('amount').to_python(values['amount'])
+    if sender is Preexpediture:
+        return {'preexpeditures_count': 1, 'preexpeditures_amount': amount}
+    sums = _expediture_sums(values['paid'], values['wage'], amount)
+    sums.update({'expeditures_count': 1, 'expeditures_amount': amount})
+    return sums
+
+def _replace_item_sums(sender, stored, current):
+    """ Replaces sums of an item with stored SUMMARY_ITEM_FIELDS values by sums of current values in its TicketSummary rows; either may be None. """
+    additions = {}
+    for values, sign in ((stored, -1), (current, 1)):
+        if values is not None:
+            fields = additions.setdefault(values['ticket_id'], {})
+            for name, value in _item_summary_sums(sender, values).items():
+                fields[name] = fields.get(name, 0) + sign * value
+    for ticket_id, fields in additions.items():
+        if any(fields.values()):
+            change_ticket_summary(ticket_id, additions=fields)
+
+@receiver(pre_save, sender=MediaInfo)
+@receiver(pre_save, sender=Preexpediture)
+@receiver(pre_save, sender=Expediture)
+def note_item_summary_sums(sender, instance, raw, **kwargs):
+    # values the item has been counted with so far
+    instance._summary_stored = None
+    if instance.pk is not None and not raw:
+        instance._summary_stored = sender.objects.filter(pk=instance.pk).values(*SUMMARY_ITEM_FIELDS[sender]).first()
+
+@receiver(post_save, sender=MediaInfo)
+@receiver(post_save, sender=Preexpediture)
+@receiver(post_save, sender=Expediture)
+def update_ticket_summary_after_item_save(sender, instance, raw, **kwargs):
+    if not raw:
+        _replace_item_sums(sender, instance._summary_stored, dict((name, getattr(instance, name)) for name in SUMMARY_ITEM_FIELDS[sender]))
+
+@receiver(post_delete, sender=MediaInfo)
+@receiver(post_delete, sender=Preexpediture)
+@receiver(post_delete, sender=Expediture)
+def update_ticket_summary_after_item_delete(sender, instance, **kwargs):
+    _replace_item_sums(sender, dict((name, getattr(instance, name)) for name in SUMMARY_ITEM_FIELDS[sender]), None)
+
+@receiver(post_save, sender=TicketAck)
+@receiver(post_delete, sender=TicketAck)
+def update_ticket_summary_after_ack(sender, instance, **kwargs):
+    if instance.ack_type == 'content' and not kwargs.get('raw', False):
+        acked = TicketAck.objects.filter(ticket_id=instance.ticket_id, ack_type='content').exists()
+        change_ticket_summary(instance.ticket_id, values={'content_acked': acked})
+
+@receiver(post_save, sender=Topic)
+def update_topic_summary_grant(sender, instance, raw, **kwargs):
+    TopicSummary.objects.filter(topic=instance).exclude(grant=instance.grant_id).update(grant=instance.grant_id)
+
+@receiver(post_delete, sender=Topic)
+def delete_topic_summaries(sender, instance, **kwargs):
+    TopicSummary.objects.filter(topic_id=instance.id).delete()
+
 class Notification(models.Model):
     """Notification that is supposed to be sent."""
     target_user = models.ForeignKey('auth.User', null=True, blank=True)
@@ -828,19 +1828,130 @@ class Notification(models.Model):
     def __unicode__(self):
         return self.text
 
+    @staticmethod
+    def recipients(ticket, notification_type, sender):
+        """ Users to be notified of given event on ticket: topic admins, watchers and possibly the ticket owner. """
+        # id subqueries instead of joins, which would repeat users and need distinct()
+        query = models.Q(id__in=Topic.admin.through.objects.filter(topic_id=ticket.topic_id).values('user_id')) \
+            | models.Q(id__in=TopicWatcher.objects.filter(topic_id=ticket.topic_id, notification_type=notification_type).values('user_id')) \
+            | models.Q(id__in=TicketWatcher.objects.filter(ticket_id=ticket.id, notification_type=notification_type).values('user_id'))
+        if notification_type not in ("ticket_new", "ticket_change", "preexpeditures_change", "expeditures_change", "media_change"):
+            query |= models.Q(id=ticket.requested_user_id)
+        users = User.objects.filter(query).select_related('trackerprofile')
+        if sender is not None:
+            users = users.exclude(id=sender.id)
+        return [u for u in users if notification_type not in u.trackerprofile.muted_notification_set()]
+
     @staticmethod
     def fire_notification(ticket, text, notification_type, sender, additional=set()):
-        initial_user = [ticket.requested_user]
-        if initial_user is None: initial_user = []
-        if notification_type in ("ticket_new", "ticket_change", "preexpeditures_change", "expeditures_change", "media_change"): initial_user = []
-        users = set(initial_user)
-        admins = set(ticket.topic.admin.all())
-        topicwatchers = set([tw.user for tw in ticket.topic.topicwatcher_set.filter(notification_type=notification_type)])
-        ticketwatchers = set([tw.user for tw in ticket.ticketwatcher_set.filter(notification_type=notification_type)])
-        users = users.union(admins, topicwatchers, ticketwatchers) - set([sender])
-        for user in users:
-            if notification_type in user.trackerprofile.get_muted_notifications(): continue
-            Notification.objects.create(text=text, notification_type=notification_type, ticket=ticket, target_user=user)
+        if notification_queue.depth > 0:
+            notification_queue.events.setdefault((ticket.id, notification_type), (ticket, []))[1].append((text, sender))
+            return
+
+        Notification.objects.bulk_create([
+            Notification(text=text, notification_type=notification_type, ticket=ticket, target_user=user)
+            for user in Notification.recipients(ticket, notification_type, sender)
+        ])
+
+    @staticmethod
+    def ticket_new_pending(ticket):
+        """ Is there an unsent ticket_new notification for ticket (queued or stored)? """
+        if (ticket.id, 'ticket_new') in notification_queue.events:
+            return True
+        return Notification.objects.filter(ticket=ticket, notification_type="ticket_new").exists()
+
+    @staticmethod
+    def flush_deferred():
+        """ Writes notifications queued by deferred_notifications, one per ticket, type and recipient. """
+        events, notification_queue.events = notification_queue.events, OrderedDict()
+        existing = set(Ticket.objects.filter(id__in=[ticket_id for ticket_id, notification_type in events]).values_list('id', flat=True))
+        rows = []
+        for (ticket_id, notification_type), (ticket, fired) in events.items():
+            if ticket_id not in existing:
+                continue
+            for user in Notification.recipients(ticket, notification_type, None):
+                texts = []
+                for text, sender in fired:
+                    if (sender is None or sender.id != user.id) and text not in texts:
+                        texts.append(text)
+                if texts:
+                    rows.append(Notification(text=u'<br />'.join(texts), notification_type=notification_type, ticket=ticket, target_user=user))
+        Notification.objects.bulk_create(rows)
+
+def _payment_counts():
+    """ Aggregates counting all and paid expeditures, for Ticket.compute_payment_status. """
+    return {
+        'all_len': models.Count('id'),
+        'paid_len': models.Count(models.Case(models.When(paid=True, then=models.Value(1)), output_field=models.IntegerField())),
+    }
+
+class PaymentStatusQueue(threading.local):
+    """ Tickets whose payment status update was requested inside batched_payment_status blocks of this thread. """
+    def __init__(self):
+        self.depth = 0
+        self.tickets = OrderedDict() # ticket id -> last ticket instance queued
+
+payment_status_queue = PaymentStatusQueue()
+
+@contextmanager
+def batched_payment_status():
+    """
+    Defers Ticket.update_payment_status calls made inside the block. When
+    the outermost block exits, expeditures of all queued tickets are counted
+    by one grouped query and each ticket is saved once.
+    """
+    payment_status_queue.depth += 1
+    try:
+        yield
+    except:
+        if payment_status_queue.depth == 1:
+            payment_status_queue.tickets.clear()
+        raise
+    finally:
+        payment_status_queue.depth -= 1
+    if payment_status_queue.depth == 0 and payment_status_queue.tickets:
+        tickets = payment_status_queue.tickets.values()
+        payment_status_queue.tickets.clear()
+        counts = dict((row['ticket_id'], row) for row in Expediture.objects.filter(ticket__in=[t.id for t in tickets]).order_by().values('ticket_id').annotate(**_payment_counts()))
+        for ticket in tickets:
+            row = counts.get(ticket.id, {'all_len': 0, 'paid_len': 0})
+            ticket.payment_status = Ticket.compute_payment_status(row['all_len'], row['paid_len'])
+            ticket.save(just_payment_status=True)
+
+class NotificationQueue(threading.local):
+    """ Notifications fired inside deferred_notifications blocks of this thread. """
+    def __init__(self):
+        self.depth = 0
+        self.events = OrderedDict() # (ticket id, notification type) -> (ticket, [(text, sender)])
+
+notification_queue = NotificationQueue()
+
+@contextmanager
+def deferred_notifications():
+    """
+    Runs the block in a transaction, collecting notifications fired inside
+    it; these are fanned out once per ticket and type and written by one
+    bulk insert after it commits. Nested blocks flush with the outermost one,
+    notifications of a nested block that rolls back are dropped.
+    """
+    queued = dict((key, len(texts)) for key, (ticket, texts) in notification_queue.events.items())
+    notification_queue.depth += 1
+    try:
+        with transaction.atomic():
+            yield
+    except:
+        # back to what was queued when the block started
+        for key, (ticket, texts) in notification_queue.events.items():
+            if key in queued:
+                del texts[queued[key]:]
+            else:
+                del notification_queue.events[key]
+        raise
+    finally:
+        notification_queue.depth -= 1
+    if notification_queue.depth == 0:
+        Notification.flush_deferred()
+        run_commit_hooks()
 
 
 class TicketWatcher(models.Model):
@@ -860,6 +1971,9 @@ class TicketWatcher(models.Model):
             res.add(tw.user)
         return res
 
+    class Meta:
+        index_together = [('ticket', 'user', 'notification_type')]
+
 class TopicWatcher(models.Model):
     """User that watch given topic"""
     topic = models.ForeignKey('Topic')
@@ -877,6 +1991,9 @@ class TopicWatcher(models.Model):
             res.add(tw.user)
         return res
 
+    class Meta:
+        index_together = [('topic', 'user', 'notification_type')]
+
 
 @receiver(comment_was_posted)
 def notify_comment(sender, comment, **kwargs):
@@ -903,38 +2020,29 @@ def notify_ticket(sender, instance, created, raw, **kwargs):
         text = u'Ticket <a href="%s%s">%s</a> byl vytvořen uživatelem <tt>%s</tt> v tématu <tt>%s</tt>' % (settings.BASE_URL, instance.get_absolute_url(), instance, instance.requested_by_html(), instance.topic)
         Notification.fire_notification(instance, text, "ticket_new", instance.requested_user)
 
-@receiver(pre_save, sender=Ticket)
-def notify_supervizor_notes(sender, instance, **kwargs):
-    if instance.id is not None:
-        old = Ticket.objects.get(id=instance.id)
-        if old.supervisor_notes != instance.supervisor_notes:
-            text = u'U ticketu <a href="%s%s">%s</a> došlo ke změně poznámek schvalovatele.' % (settings.BASE_URL, instance.get_absolute_url(), instance)
-            Notification.fire_notification(instance, text, "supervisor_notes", None)
+# notification type and text for changes of ticket fields
+TICKET_CHANGE_NOTIFICATIONS = (
+    ('supervisor_notes', 'supervisor_notes', u'U ticketu <a href="%s%s">%s</a> došlo ke změně poznámek schvalovatele.'),
+    ('description', 'ticket_change', u'U ticketu <a href="%s%s">%s</a> došlo ke změně popisku.'),
+    ('summary', 'ticket_change', u'U ticketu <a href="%s%s">%s</a> došlo ke změně názvu.'),
+    ('report_url', 'ticket_change', u'U ticketu <a href="%s%s">%s</a> došlo ke změně odkazu na report.'),
+    ('deposit', 'ticket_change', u'U ticketu <a href="%s%s">%s</a> došlo ke změně požadované zálohy.'),
+    ('mandatory_report', 'ticket_change_all', u'U ticketu <a href="%s%s">%s</a> došlo ke změně příznaku povinného reportu.'),
+)
 
 @receiver(pre_save, sender=Ticket)
 def notify_ticket_change(sender, instance, **kwargs):
-    if instance.id is not None and len(Notification.objects.filter(ticket=instance, notification_type="ticket_new")) == 0:
-        old = Ticket.objects.get(id=instance.id)
-        if old.description != instance.description:
-            text = u'U ticketu <a href="%s%s">%s</a> došlo ke změně popisku.' % (settings.BASE_URL, instance.get_absolute_url(), instance)
-            Notification.fire_notification(instance, text, "ticket_change", None)
-        if old.summary != instance.summary:
-            text = u'U ticketu <a href="%s%s">%s</a> došlo ke změně názvu.' % (settings.BASE_URL, instance.get_absolute_url(), instance)
-            Notification.fire_notification(instance, text, "ticket_change", None)
-        if old.report_url != instance.report_url:
-            text = u'U ticketu <a href="%s%s">%s</a> došlo ke změně odkazu na report.' % (settings.BASE_URL, instance.get_absolute_url(), instance)
-            Notification.fire_notification(instance, text, "ticket_change", None)
-        if old.deposit != instance.deposit:
-            text = u'U ticketu <a href="%s%s">%s</a> došlo ke změně požadované zálohy.' % (settings.BASE_URL, instance.get_absolute_url(), instance)
-            Notification.fire_notification(instance, text, "ticket_change", None)
+    changed = instance.changed_fields()
+    notifications = [(t, text) for field, t, text in TICKET_CHANGE_NOTIFICATIONS if field in changed]
+    if not notifications:
+        return
 
-@receiver(pre_save, sender=Ticket)
-def notify_ticket_change_2(sender, instance, **kwargs):
-    if instance.id is not None:
-        old = Ticket.objects.get(id=instance.id)
-        if old.mandatory_report != instance.mandatory_report:
-            text = u'U ticketu <a href="%s%s">%s</a> došlo ke změně příznaku povinného reportu.' % (settings.BASE_URL, instance.get_absolute_url(), instance)
-            Notification.fire_notification(instance, text, "ticket_change_all", None)
+    # ticket_change is not fired until the ticket_new notification is sent
+    new_pending = any(t == 'ticket_change' for t, text in notifications) and Notification.ticket_new_pending(instance)
+    for notification_type, text in notifications:
+        if notification_type == 'ticket_change' and new_pending:
+            continue
+        Notification.fire_notification(instance, text % (settings.BASE_URL, instance.get_absolute_url(), instance), notification_type, None)
 
 @receiver(post_save, sender=TicketAck)
 def notify_ack_add(sender, instance, created, **kwargs):
@@ -946,48 +2054,53 @@ def notify_ack_remove(sender, instance, **kwargs):
     text = u'U ticketu <a href="%s%s">%s</a> došlo k odebrání stavu <tt>%s</tt>' % (settings.BASE_URL, instance.ticket.get_absolute_url(), instance.ticket, instance.get_ack_type_display())
     Notification.fire_notification(instance.ticket, text, "ack_remove", None)
 
+# notification type and texts (created, changed) of saved ticket items
+ITEM_SAVE_NOTIFICATIONS = {
+    Preexpediture: ('preexpeditures_change',
+        u'K tiketu <a href="%(base)s%(url)s">%(ticket)s</a>  byly přidány plánované výdaje <tt>%(item)s</tt>',
+        u'Plánovaný výdaj <tt>%(item)s</tt> tiketu <a href="%(base)s%(url)s">%(ticket)s</a> byl změněn'),
+    Expediture: ('expeditures_change',
+        u'K tiketu <a href="%(base)s%(url)s">%(ticket)s</a>  byly přidány reálné výdaje <tt>%(item)s</tt>',
+        u'Reálný výdaj <tt>%(item)s</tt> tiketu <a href="%(base)s%(url)s">%(ticket)s</a> byl změněn'),
+    MediaInfo: ('expeditures_change',
+        u'K tiketu <a href="%(base)s%(url)s">%(ticket)s</a>  byly přidány média',
+        u'Média tiketu <a href="%(base)s%(url)s">%(ticket)s</a> byl změněn'),
+}
+
+def notify_items_saved(items, created):
+    """ Fires notifications for saved preexpeditures, expeditures or media, checking pending ticket_new once per ticket. """
+    new_pending = {}
+    for item in items:
+        ticket = item.ticket
+        if ticket.id not in new_pending:
+            new_pending[ticket.id] = Notification.ticket_new_pending(ticket)
+        if new_pending[ticket.id]:
+            continue
+        notification_type, created_text, changed_text = ITEM_SAVE_NOTIFICATIONS[type(item)]
+        text = (created_text if created else changed_text) % {'base': settings.BASE_URL, 'url': ticket.get_absolute_url(), 'ticket': ticket, 'item': item}
+        Notification.fire_notification(ticket, text, notification_type, None)
+
 @receiver(post_save, sender=Preexpediture)
-def notify_preexpediture(sender, instance, created, raw, **kwargs):
-    if len(Notification.objects.filter(ticket=instance.ticket, notification_type="ticket_new")) == 0:
-        if created:
-            text = u'K tiketu <a href="%s%s">%s</a>  byly přidány plánované výdaje <tt>%s</tt>' % (settings.BASE_URL, instance.ticket.get_absolute_url(), instance.ticket, instance)
-        else:
-            text = u'Plánovaný výdaj <tt>%s</tt> tiketu <a href="%s%s">%s</a> byl změněn' % (instance, settings.BASE_URL, instance.ticket.get_absolute_url(), instance.ticket)    
-        Notification.fire_notification(instance.ticket, text, "preexpeditures_change", None)
+@receiver(post_save, sender=Expediture)
+@receiver(post_save, sender=MediaInfo)
+def notify_item_save(sender, instance, created, raw, **kwargs):
+    notify_items_saved([instance], created)
 
 @receiver(post_delete, sender=Preexpediture)
 def notify_del_preexpediture(sender, instance, **kwargs):
-    if len(Ticket.objects.filter(id=instance.ticket.id)) > 0 and len(Notification.objects.filter(ticket=instance.ticket, notification_type="ticket_new")) == 0:
+    if len(Ticket.objects.filter(id=instance.ticket.id)) > 0 and not Notification.ticket_new_pending(instance.ticket):
         text = u'Plánovaný výdaj <ŧt>%s</tt> tiketu <a href="%s%s">%s</a> byl odstraněn' % (instance, settings.BASE_URL, instance.ticket.get_absolute_url(), instance.ticket)
         Notification.fire_notification(instance.ticket, text, "preexpeditures_change", None)
 
-@receiver(post_save, sender=Expediture)
-def notify_expediture(sender, instance, created, raw, **kwargs):
-    if len(Notification.objects.filter(ticket=instance.ticket, notification_type="ticket_new")) == 0:
-        if created:
-            text = u'K tiketu <a href="%s%s">%s</a>  byly přidány reálné výdaje <tt>%s</tt>' % (settings.BASE_URL, instance.ticket.get_absolute_url(), instance.ticket, instance)
-        else:
-            text = u'Reálný výdaj <tt>%s</tt> tiketu <a href="%s%s">%s</a> byl změněn' % (instance, settings.BASE_URL, instance.ticket.get_absolute_url(), instance.ticket)
-        Notification.fire_notification(instance.ticket, text, "expeditures_change", None)
-
 @receiver(post_delete, sender=Expediture)
 def notify_del_expediture(sender, instance, **kwargs):
-    if len(Ticket.objects.filter(id=instance.ticket.id)) > 0 and len(Notification.objects.filter(ticket=instance.ticket, notification_type="ticket_new")) == 0:
+    if len(Ticket.objects.filter(id=instance.ticket.id)) > 0 and not Notification.ticket_new_pending(instance.ticket):
         text = u'Reálný výdaj <ŧt>%s</tt> tiketu <a href="%s%s">%s</a> byl odstraněn' % (instance, settings.BASE_URL, instance.ticket.get_absolute_url(), instance.ticket)
         Notification.fire_notification(instance.ticket, text, "expeditures_change", None)
 
-@receiver(post_save, sender=MediaInfo)
-def notify_media(sender, instance, created, raw, **kwargs):
-    if len(Notification.objects.filter(ticket=instance.ticket, notification_type="ticket_new")) == 0:
-        if created:
-            text = u'K tiketu <a href="%s%s">%s</a>  byly přidány média' % (settings.BASE_URL, instance.ticket.get_absolute_url(), instance.ticket)
-        else:
-            text = u'Média tiketu <a href="%s%s">%s</a> byl změněn' % (settings.BASE_URL, instance.ticket.get_absolute_url(), instance.ticket)
-        Notification.fire_notification(instance.ticket, text, "expeditures_change", None)
-
 @receiver(post_delete, sender=MediaInfo)
 def notify_del_media(sender, instance, **kwargs):
-    if len(Ticket.objects.filter(id=instance.ticket.id)) > 0 and len(Notification.objects.filter(ticket=instance.ticket, notification_type="ticket_new")) == 0:
+    if len(Ticket.objects.filter(id=instance.ticket.id)) > 0 and not Notification.ticket_new_pending(instance.ticket):
         text = u'Média tiketu <a href="%s%s">%s</a> byla odstraněna' % (settings.BASE_URL, instance.ticket.get_absolute_url(), instance.ticket)
         Notification.fire_notification(instance.ticket, text, "media_change", None)
 
@@ -4,20 +4,36 @@ import datetime
 import re
 from decimal import Decimal
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User, Permission
 from django.contrib.contenttypes.models import ContentType
 from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core import mail
+from django.core.mail.backends import locmem
+from django.db import connection
+from django.db.models.signals import post_save
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.conf import settings
 import json
 from django.utils.encoding import force_text
 import StringIO
 import csv
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import tracker.models
 
 from users.models import UserWrapper
-from tracker.models import Ticket, Topic, FinanceStatus, Grant, MediaInfo, Expediture, TrackerProfile, Document, Cluster
+from tracker.models import Ticket, Topic, Subtopic, FinanceStatus, Grant, MediaInfo, Expediture, Preexpediture, TicketAck, Transaction, TrackerProfile, Document, Cluster, TicketListRow, ticket_list_rows, flush_ticket_list, bump_topics_version, commit_hooks, _call_commit_hooks, prefetch_cached, cached_model_stats
+from tracker.models import TOPIC_SUMMARY_COUNTS, TOPIC_SUMMARY_AMOUNTS, Notification, TicketWatcher, TopicWatcher, UserLedger, TopicSummary, deferred_notifications, batched_payment_status, change_ticket_summary, update_ticket_summaries, update_topic_summaries, update_user_ledgers
+from tracker.management.commands.sendnotifications import pending_digests
+from tracker.views import HttpResponseCsv, StreamingHttpResponseCsv, export_tickets, iterate_by_id
 
 class SimpleTicketTest(TestCase):
     def setUp(self):
@@ -43,6 +59,27 @@ class SimpleTicketTest(TestCase):
         response = Client().get(reverse('ticket_list'))
         self.assertEqual(response.status_code, 200)
 
+    def test_ticket_list_data(self):
+        url = reverse('tickets_data', kwargs={'lang':'en'})
+        response = Client().get(url, {'draw': '3', 'start': '0', 'length': '1', 'order[0][column]': '2', 'order[0][dir]': 'asc'})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(3, data['draw'])
+        self.assertEqual(2, data['recordsTotal'])
+        self.assertEqual(2, data['recordsFiltered'])
+        self.assertEqual(ticket_list_rows(Ticket.objects.filter(id=self.ticket2.id)), data['data'])
+
+        response = Client().get(url, {'start': '1', 'length': '1', 'order[0][column]': '2', 'order[0][dir]': 'asc'})
+        self.assertEqual(ticket_list_rows(Ticket.objects.filter(id=self.ticket1.id)), json.loads(response.content)['data'])
+
+        response = Client().get(url, {'start': '0', 'length': '10', 'search[value]': 'fo'})
+        data = json.loads(response.content)
+        self.assertEqual(1, data['recordsFiltered'])
+        self.assertEqual(ticket_list_rows(Ticket.objects.filter(id=self.ticket1.id)), data['data'])
+
+        response = Client().get(url, {'start': 'x'})
+        self.assertEqual(response.status_code, 400)
+
     def test_ticket_detail(self):
         response = Client().get(reverse('ticket_detail', kwargs={'pk':self.ticket1.id}))
         self.assertEqual(response.status_code, 200)
@@ -64,8 +101,32 @@ class SimpleTicketTest(TestCase):
         self.assertEqual(len(response.context['topic_list']), 1)
 
     def test_javascript_topic_list(self):
-        response = Client().get(reverse('topics_js'))
+        Subtopic.objects.create(name='sub', topic=self.topic)
+        # the test transaction is never committed, call the hooks like the commit
+        # would, which also keeps rewrites of the ticket list out of the counted request
+        _call_commit_hooks()
+        with self.assertNumQueries(2):
+            response = Client().get(reverse('topics_js'))
+        self.assertEqual(response.status_code, 200)
+        table = json.loads(response.content[len('topics_table = '):-1])
+        self.assertEqual(['sub'], [s['name'] for s in table[str(self.topic.id)]['subtopic_set']])
+
+        with self.assertNumQueries(0):
+            cached = Client().get(reverse('topics_js'))
+        self.assertEqual(response.content, cached.content)
+        with self.assertNumQueries(0):
+            response = Client().get(reverse('topics_js'), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        Subtopic.objects.create(name='another', topic=self.topic)
+        self.assertIn(bump_topics_version, commit_hooks.functions)
+        # the version is bumped only after the request which sees the old one
+        response = Client().get(reverse('topics_js'), HTTP_IF_NONE_MATCH=cached['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = Client().get(reverse('topics_js'), HTTP_IF_NONE_MATCH=cached['ETag'])
         self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(cached['ETag'], response['ETag'])
+        self.assertIn('another', response.content)
 
     def test_topic_detail(self):
         response = Client().get(reverse('topic_detail', kwargs={'pk':self.topic.id}))
@@ -95,6 +156,26 @@ class SimpleTicketTest(TestCase):
         self.ticket1.save()
         self.assertEqual(self.ticket1.state_str(), 'historical')
 
+    def test_state(self):
+        self.assertEqual('draft', Ticket.objects.get(id=self.ticket1.id).state)
+        self.ticket1.add_acks('user_precontent')
+        self.assertEqual('wfpreapproval', Ticket.objects.get(id=self.ticket1.id).state)
+        self.ticket1.add_acks('precontent', 'content')
+        self.assertEqual('wfdocssub', Ticket.objects.get(id=self.ticket1.id).state)
+        self.ticket1.rating_percentage = None
+        self.ticket1.save()
+        self.assertEqual('wfcontentrating', Ticket.objects.get(id=self.ticket1.id).state)
+        self.ticket1.ticketack_set.get(ack_type='content').delete()
+        self.assertEqual('wfsubmiting', Ticket.objects.get(id=self.ticket1.id).state)
+        self.assertEqual([self.ticket1], list(Ticket.get_tickets_with_state('wfsubmiting')))
+
+    def test_state_backfill(self):
+        self.ticket1.add_acks('user_content')
+        Ticket.objects.update(state='draft')
+        call_command('updateticketstates')
+        self.assertEqual('wfapproval', Ticket.objects.get(id=self.ticket1.id).state)
+        self.assertEqual('draft', Ticket.objects.get(id=self.ticket2.id).state)
+
 class OldRedirectTests(TestCase):
     def setUp(self):
         self.topic = Topic(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
@@ -373,6 +454,23 @@ class TicketEditTests(TestCase):
         wanted_choices = {t_open.id, t_assigned.id}
         self.assertEqual(wanted_choices, choices)
 
+    def test_copy_preexpeditures(self):
+        topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        user = User.objects.create(username='my_user')
+        user.set_password('my_password')
+        user.save()
+        ticket = Ticket.objects.create(summary='ticket', topic=topic, requested_user=user)
+        ticket.expediture_set.create(description='old', amount=5, paid=True)
+        ticket.preexpediture_set.create(description='pre1', amount=10)
+        ticket.preexpediture_set.create(description='pre2', amount=20, wage=True)
+
+        c = Client()
+        c.login(username='my_user', password='my_password')
+        response = c.get(reverse('copypreexpeditures', kwargs={'pk':ticket.id}))
+        self.assertEqual(302, response.status_code)
+        self.assertEqual([('pre1', 10, False), ('pre2', 20, True)], list(ticket.expediture_set.order_by('description').values_list('description', 'amount', 'wage')))
+        self.assertEqual('unpaid', Ticket.objects.get(id=ticket.id).payment_status)
+
     def test_ticket_edit(self):
         topic = Topic(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
         topic.save()
@@ -779,6 +877,28 @@ class SummaryTest(TestCase):
 			e.save()
         self.assertEqual({'unpaid':1, 'paid':1}, self.topic.tickets_per_payment_status())
 
+    def test_batched_payment_status(self):
+        saves = []
+        def count_save(sender, instance, **kwargs):
+            saves.append(instance.id)
+        post_save.connect(count_save, sender=Ticket)
+        self.addCleanup(post_save.disconnect, count_save, sender=Ticket)
+
+        with batched_payment_status():
+            for amount in (1, 2, 3):
+                self.ticket2.expediture_set.create(description='bar', amount=amount, paid=True)
+            self.ticket.expediture_set.update(paid=True)
+            self.ticket.update_payment_status()
+            self.assertEqual([], saves)
+        self.assertEqual([self.ticket2.id, self.ticket.id], saves)
+        self.assertEqual({'partially_paid':1, 'paid':1}, self.topic.tickets_per_payment_status())
+
+        with self.assertRaises(ValueError):
+            with batched_payment_status():
+                self.ticket.expediture_set.create(description='bar', amount=5)
+                raise ValueError
+        self.assertEqual([self.ticket2.id, self.ticket.id], saves)
+
     def test_topic_ticket_counts2(self):
         """ change event_date (and thus sort_date) of one ticket, make sure it
             does not break grouping
@@ -813,9 +933,664 @@ class SummaryTest(TestCase):
         self.assertEqual({'objects':3, 'media':13}, profile.media_count())
         self.assertEqual(150 + 610, profile.accepted_expeditures())
 
+    def test_topic_totals(self):
+        self.ticket.expediture_set.create(description='foo', amount='15.55', wage=True, paid=True)
+        self.ticket.expediture_set.filter(amount=200).update(paid=True)
+        self.ticket2.expediture_set.filter(amount=10).update(wage=True, paid=True)
+        subtopic = Subtopic.objects.create(name='sub', topic=self.topic)
+        Ticket.objects.filter(id=self.ticket.id).update(subtopic=subtopic)
+        # queryset updates bypass the signals maintaining topic summaries
+        update_topic_summaries([self.topic.id])
+
+        # 15.55 * 50% = 7.775 rounds half up
+        self.assertEqual(Decimal('17.78'), self.topic.paid_wages())
+        self.assertEqual(Decimal('117.78'), self.topic.paid_together())
+        self.assertEqual(Decimal('107.78'), subtopic.paid_together())
+        grant = self.topic.grant
+        self.assertEqual((2, Decimal('17.78'), Decimal('117.78')), (grant.total_tickets(), grant.total_paid_wages(), grant.total_paid_together()))
+
+        Topic.objects.create(name='empty', grant=grant)
+        with self.assertNumQueries(1):
+            topics = list(Topic.objects.order_by('id').with_totals())
+            self.assertEqual([2, 0], [t.ticket_count() for t in topics])
+            self.assertEqual([Decimal('117.78'), 0], [t.paid_together() for t in topics])
+            self.assertEqual({'unpaid':1, 'partially_paid':1}, topics[0].tickets_per_payment_status())
+
+        response = Client().get(grant.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(topics), set(response.context['topic_list']))
+
+        # rounded per ticket, so that grant totals are sums of their topics
+        halves = Topic.objects.create(name='halves', grant=grant)
+        for i in range(2):
+            Ticket.objects.create(summary='half', requested_text='someone', topic=halves, rating_percentage=50).expediture_set.create(description='cent', amount='0.01', wage=True, paid=True)
+        self.assertEqual(Decimal('0.02'), Topic.objects.get(id=halves.id).paid_wages())
+        self.assertEqual(Decimal('17.80'), Grant.objects.get(id=grant.id).total_paid_wages())
+
     def test_topic_finance(self):
+        expediture = self.ticket.expediture_set.get(amount=200)
+        expediture.paid = True
+        expediture.save()
+        other = Topic.objects.create(name='other', grant=self.topic.grant)
+        Ticket.objects.create(summary='bar', requested_user=self.user, topic=other, rating_percentage=100).expediture_set.create(description='bar', amount=30, paid=True)
+
+        self.assertEqual(FinanceStatus(unpaid=50 + 610, paid=100), self.topic.payment_summary())
+
+        by_ticket = FinanceStatus()
+        for ticket in Ticket.objects.all():
+            by_ticket.add_ticket(ticket)
+        self.assertEqual(FinanceStatus(unpaid=660, paid=100), by_ticket)
+
         response = Client().get(reverse('topic_finance'))
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(by_ticket, response.context['grants'][0]['finance'])
+        self.assertEqual([FinanceStatus(), FinanceStatus(unpaid=660, paid=100)], [t['finance'] for t in response.context['grants'][0]['topics']])
+
+    def test_topic_summaries(self):
+        subtopic = Subtopic.objects.create(name='sub', topic=self.topic)
+        self.ticket.subtopic = subtopic
+        self.ticket.save()
+        self.ticket.preexpediture_set.create(description='foo', amount=80)
+        stored = lambda: sorted(TopicSummary.objects.values_list('topic_id', 'subtopic_id', 'tickets_count', 'media_files', 'preexpeditures_amount', 'accepted_amount', 'finance_unpaid'))
+        self.assertEqual([(self.topic.id, None, 1, 8, 0, 610, 610), (self.topic.id, subtopic.id, 1, 5, 80, 150, 150)], stored())
+        self.assertEqual({'objects':1, 'media':5}, subtopic.media_count())
+        self.assertEqual({'count':1, 'amount':80}, subtopic.preexpeditures())
+
+        other = Topic.objects.create(name='other', grant=Grant.objects.create(full_name='h', short_name='h', slug='h'))
+        self.ticket2.topic = other
+        self.ticket2.save()
+        self.ticket2.expediture_set.get(amount=10).delete()
+        self.assertEqual([(self.topic.id, subtopic.id, 1, 5, 80, 150, 150), (other.id, None, 1, 8, 0, 600, 600)], stored())
+        self.assertEqual((1, 1), (self.topic.grant.total_tickets(), other.grant.total_tickets()))
+
+        other.grant = self.topic.grant
+        other.save()
+        self.assertEqual(2, Grant.objects.get(id=self.topic.grant_id).total_tickets())
+        incremental = stored()
+        update_topic_summaries()
+        self.assertEqual(incremental, stored())
+
+        other.delete()
+        self.assertEqual([(self.topic.id, subtopic.id, 1, 5, 80, 150, 150)], stored())
+
+    def test_ticket_export(self):
+        self.ticket.expediture_set.create(description='foo', amount='15.55')
+        draft = Ticket.objects.create(summary='bar', requested_text='someone', topic=self.topic, rating_percentage=100)
+        draft.preexpediture_set.create(description='bar', amount=40)
+        form = {'type': 'ticket', 'preexpeditures-larger': '', 'preexpeditures-smaller': '', 'expeditures-larger': '', 'expeditures-smaller': '', 'acceptedexpeditures-larger': '', 'acceptedexpeditures-smaller': ''}
+
+        def exported(**filters):
+            post = dict(form, **filters)
+            with self.assertNumQueries(1):
+                rows = list(export_tickets(post))
+            response = Client().post(reverse('export'), post)
+            self.assertEqual(response.status_code, 200)
+            lines = [line.split(';') for line in b''.join(response.streaming_content).decode('utf-8').split('\r\n')[1:-1]]
+            self.assertEqual(['"%s"' % row[0] for row in rows], [line[0] for line in lines])
+            return lines
+
+        lines = exported()
+        self.assertEqual(['"%s"' % t.id for t in (draft, self.ticket2, self.ticket)], [line[0] for line in lines])
+        # 315.55 * 50% = 157.775 rounds half up
+        self.assertEqual(['"157.78"', '"None"', '"315.55"'], lines[2][-3:])
+        self.assertEqual(['"0"', '"40.00"', '"None"'], lines[0][-3:])
+        self.assertIn('"someone"', lines[0])
+
+        ids = lambda **filters: [long(line[0].strip('"')) for line in exported(**filters)]
+        self.assertEqual([draft.id], ids(**{'preexpeditures-larger': '40'}))
+        self.assertEqual([self.ticket2.id, self.ticket.id], ids(**{'expeditures-larger': '300', 'expeditures-smaller': '700'}))
+        self.assertEqual([], ids(**{'acceptedexpeditures-larger': '1', 'acceptedexpeditures-smaller': '157'}))
+        self.assertEqual([self.ticket.id], ids(**{'acceptedexpeditures-larger': '157', 'acceptedexpeditures-smaller': '158'}))
+        self.assertEqual([draft.id], ids(**{'acceptedexpeditures-smaller': '157'}))
+        self.assertEqual([self.ticket2.id, self.ticket.id], ids(**{'ticket-user-0': str(self.user.id)}))
+        self.assertEqual([self.ticket.id], ids(**{'ticket-topic-0': str(self.topic.id), 'archived': 'on', 'expeditures-smaller': '400'}))
+
+    def test_user_export(self):
+        self.ticket.expediture_set.create(description='foo', amount='15.55', paid=True)
+        other = User.objects.create(username='other')
+        Ticket.objects.create(summary='bar', requested_user=other, topic=self.topic).expediture_set.create(description='bar', amount=40, paid=True)
+        staff = User.objects.create_user('staff', 'staff@example.com', 'pass')
+        staff.is_staff = True
+        staff.save()
+        c = Client()
+        c.login(username='staff', password='pass')
+        form = {'type': 'user', 'users-created-larger': '', 'users-created-smaller': '', 'users-accepted-larger': '', 'users-accepted-smaller': '', 'users-paid-larger': '', 'users-paid-smaller': ''}
+
+        def exported(**filters):
+            response = c.post(reverse('export'), dict(form, **filters))
+            self.assertEqual(response.status_code, 200)
+            lines = b''.join(response.streaming_content).decode('utf-8').split('\r\n')[1:-1]
+            return dict((line.split(';')[1].strip('"'), line.split(';')[10:13]) for line in lines)
+
+        flush_ticket_list()
+        with self.assertNumQueries(4): # session, request user, user ledgers and profiles
+            users = exported()
+        # (315.55 * 50% = 157.775 rounds half up) + 610
+        self.assertEqual(['"2"', '"767.78"', '"15.55"'], users['user'])
+        self.assertEqual(UserLedger.objects.get(user_id=self.user.id).accepted_expeditures, self.user.trackerprofile.accepted_expeditures())
+        self.assertEqual(['"1"', '"0.00"', '"40.00"'], users['other'])
+        self.assertEqual(['"0"', '"0.00"', '"0.00"'], users['staff'])
+        self.assertEqual(['user'], list(exported(**{'users-accepted-larger': '767', 'users-accepted-smaller': '768'})))
+        self.assertEqual([], list(exported(**{'users-accepted-smaller': '767', 'users-created-larger': '2'})))
+        self.assertEqual(set(['user', 'other']), set(exported(**{'users-paid-larger': '10', 'users-paid-smaller': '40'})))
+        self.assertEqual(['staff'], list(exported(**{'users-created-smaller': '0', 'user-permision': 'staff'})))
+
+    def test_topic_export(self):
+        self.topic.admin.add(self.user)
+        other = Topic.objects.create(name='other', grant=self.topic.grant)
+        other.admin.add(self.user, User.objects.create(username='admin2'))
+        Topic.objects.create(name='empty', grant=self.topic.grant)
+        for e in self.ticket.expediture_set.all():
+            e.paid = True
+            e.save()
+        form = {'type': 'topic', 'topics-tickets-larger': '', 'topics-tickets-smaller': '', 'topics-paymentstate': 'default', 'topics-paymentstate-larger': '', 'topics-paymentstate-smaller': ''}
+
+        def exported(**filters):
+            flush_ticket_list()
+            with self.assertNumQueries(2): # topics and their admins
+                response = Client().post(reverse('export'), dict(form, **filters))
+                lines = b''.join(response.streaming_content).decode('utf-8').split('\r\n')[1:-1]
+            return dict((line.split(';')[0].strip('"'), line.split(';')[-1].strip('"')) for line in lines)
+
+        self.assertEqual({'empty': '', 'other': 'user, admin2', 'test_topic': 'user'}, exported())
+        self.assertEqual(set(['other', 'test_topic']), set(exported(**{'topics-user-0': str(self.user.id)})))
+        self.assertEqual(['test_topic'], list(exported(**{'topics-user-0': str(self.user.id), 'topics-tickets-larger': '1'})))
+        self.assertEqual(set(['other', 'empty']), set(exported(**{'topics-tickets-smaller': '0'})))
+        self.assertEqual(['test_topic'], list(exported(**{'topics-paymentstate': 'paid', 'topics-paymentstate-larger': '1', 'topics-paymentstate-smaller': '1'})))
+        self.assertEqual(set(['other', 'empty']), set(exported(**{'topics-paymentstate': 'unpaid', 'topics-paymentstate-smaller': '0'})))
+
+    def test_streaming_csv(self):
+        fields, rows = ['a', 'b'], [[1, u'x"y'], [2, u'multi\r\nline'], [3, None]]
+        buffered = HttpResponseCsv(fields)
+        for row in rows:
+            buffered.writerow(row)
+        streamed = StreamingHttpResponseCsv(fields, iter(rows))
+        streamed.chunk_rows = 2
+        chunks = list(streamed.streaming_content)
+        self.assertEqual(2, len(chunks))
+        self.assertEqual(buffered.content, b''.join(chunks))
+
+        with self.assertNumQueries(0):
+            response = Client().get(reverse('transactions_csv'))
+        self.assertTrue(response.streaming)
+
+        ids = list(Ticket.objects.order_by('id').values_list('id', flat=True))
+        with self.assertNumQueries(len(ids) + 1): # one query per chunk and a final empty one
+            self.assertEqual(ids, [t.id for t in iterate_by_id(Ticket.objects.all(), chunk_size=1)])
+        self.assertEqual(ids[::-1], [row[0] for row in iterate_by_id(Ticket.objects.values_list('id', 'summary'), descending=True, chunk_size=1)])
+
+    def test_prefetch_cached(self):
+        getters = ['ack_set', 'accepted_expeditures', 'expeditures', 'media_count']
+        tickets = prefetch_cached(Ticket.objects.order_by('id'), getters)
+        with self.assertNumQueries(0):
+            self.assertEqual([150, 610], [t.accepted_expeditures() for t in tickets])
+            self.assertEqual([{'count':2, 'amount':300}, {'count':2, 'amount':610}], [t.expeditures() for t in tickets])
+            self.assertEqual([{'objects':1, 'media':5}, {'objects':2, 'media':8}], [t.media_count() for t in tickets])
+
+        # computed values were stored, so only the tickets are loaded now
+        with self.assertNumQueries(1):
+            tickets = prefetch_cached(Ticket.objects.order_by('id'), getters)
+        self.assertEqual(set(['content', 'docs', 'archive']), tickets[0].ack_set())
+
+        tickets[0].expediture_set.create(description='foo', amount=100)
+        self.assertEqual({'count':3, 'amount':400}, tickets[0].expeditures())
+
+    def test_cached_getter_l1(self):
+        ticket = Ticket.objects.get(id=self.ticket.id)
+        cached_model_stats.reset()
+        self.assertEqual(set(['content', 'docs', 'archive']), ticket.ack_set())
+        with self.assertNumQueries(0):
+            ticket.has_all_acks('content')
+            ticket.can_edit(self.user)
+        self.assertEqual({'l1_hits':2, 'l1_misses':1, 'l2_hits':0, 'l2_misses':1}, Ticket.cache_stats())
+
+        ticket.flush_cache()
+        ticket.ack_set()
+        self.assertEqual({'l1_hits':2, 'l1_misses':2, 'l2_hits':0, 'l2_misses':2}, Ticket.cache_stats())
+
+        # flushing another instance of the same ticket empties L1 of this one too
+        Ticket.objects.get(id=self.ticket.id).flush_cache()
+        ticket.ack_set()
+        self.assertEqual({'l1_hits':2, 'l1_misses':3, 'l2_hits':0, 'l2_misses':3}, Ticket.cache_stats())
+
+        # next request starts with empty L1, but the value is in L2 already
+        cached_model_stats.reset()
+        ticket.ack_set()
+        self.assertEqual({'l1_hits':0, 'l1_misses':1, 'l2_hits':1, 'l2_misses':0}, Ticket.cache_stats())
+
+    def test_user_list(self):
+        response = Client().get(reverse('user_list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(150 + 610, response.context['totals']['accepted_expeditures'])
+        self.assertEqual(150 + 610, [u for u in response.context['user_list'] if u == self.user][0].ledger.accepted_expeditures)
+
+    def test_user_ledger(self):
+        def ledger(user_id):
+            l = UserLedger.objects.get(user_id=user_id)
+            return (l.ticket_count, l.media_objects, l.media_files, l.accepted_expeditures, l.paid_expeditures, l.transactions)
+
+        self.assertEqual((2, 3, 13, 150 + 610, 0, 0), ledger(self.user.id))
+        self.ticket.ticketack_set.filter(ack_type='content').delete()
+        for expediture in self.ticket2.expediture_set.filter(amount=10):
+            expediture.paid = True
+            expediture.save()
+        self.ticket2.expediture_set.create(description='foo', amount='0.55', paid=True)
+        self.ticket2.mediainfo_set.filter(count=3).delete()
+        Transaction.objects.create(date=datetime.date.today(), other=self.user, amount=50, description='pay')
+        self.assertEqual((2, 2, 10, Decimal('610.55'), Decimal('10.55'), 50), ledger(self.user.id))
+
+        self.ticket.requested_user = None
+        self.ticket.save()
+        self.assertEqual((1, 1, 5, 0, 0, 0), ledger(None))
+        self.assertEqual((1, 1, 5, Decimal('610.55'), Decimal('10.55'), 50), ledger(self.user.id))
+
+        stored = sorted(UserLedger.objects.values_list('user_id', 'ticket_count', 'media_files', 'accepted_expeditures', 'paid_expeditures', 'transactions'))
+        UserLedger.objects.all().delete()
+        call_command('rebuilduserledgers')
+        self.assertEqual(stored, sorted(UserLedger.objects.values_list('user_id', 'ticket_count', 'media_files', 'accepted_expeditures', 'paid_expeditures', 'transactions')))
+
+        flush_ticket_list()
+        with self.assertNumQueries(2):
+            response = Client().get(reverse('user_list'))
+        self.assertEqual((1, 10), (response.context['unassigned'].ticket_count, response.context['totals']['media_files']))
+
+    def test_ticket_list_rows(self):
+        self.ticket2.expediture_set.filter(amount=10).update(paid=True)
+        self.ticket2.flush_cache()
+        with self.assertNumQueries(4):
+            rows = ticket_list_rows(Ticket.objects.order_by('-id'))
+
+        self.assertEqual([self.ticket2.id, self.ticket.id], [int(re.search(r'>(\d+)<', r[0]).group(1)) for r in rows])
+        for row, ticket in zip(rows, (self.ticket2, self.ticket)):
+            self.assertEqual('%s %s' % (ticket.accepted_expeditures(), settings.TRACKER_CURRENCY), row[7])
+            self.assertEqual('%s %s' % (ticket.paid_expeditures(), settings.TRACKER_CURRENCY), row[8])
+            self.assertEqual(unicode(ticket.state_str()), row[9])
+
+        response = Client().get(reverse('tickets', kwargs={'lang':'en'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(rows, json.loads(response.content)['data'])
+
+class AggregateQueryTests(TestCase):
+    """ Query counts and timings of ticket aggregates on a seeded database; TRACKER_BENCHMARK=1 prints them. """
+
+    def setUp(self):
+        grant = Grant.objects.create(full_name='g', short_name='g', slug='g')
+        self.topic = Topic.objects.create(name='topic', grant=grant)
+        other = Topic.objects.create(name='other', grant=grant)
+        self.subtopic = Subtopic.objects.create(name='sub', topic=self.topic)
+        self.users = [User.objects.create(username='user%d' % i) for i in range(3)]
+        Ticket.objects.bulk_create([Ticket(
+            summary='ticket %d' % i, topic=(self.topic, other)[i % 2], subtopic=self.subtopic if i % 4 == 0 else None,
+            requested_user=self.users[i % 3], rating_percentage=(None, 50, 100, 80, 0)[i % 5], updated=datetime.datetime.now(),
+        ) for i in range(200)])
+        tickets = list(Ticket.objects.all())
+        MediaInfo.objects.bulk_create([MediaInfo(ticket=t, description='foo', count=count) for t in tickets for count in (None, 3)])
+        Expediture.objects.bulk_create([Expediture(ticket=t, description='foo', amount=Decimal('10.25') * (i + 1), paid=i == 0, wage=i == 1) for t in tickets for i in range(3)])
+        Preexpediture.objects.bulk_create([Preexpediture(ticket=t, description='foo', amount=40) for t in tickets])
+        TicketAck.objects.bulk_create([TicketAck(ticket=t, ack_type='content') for t in tickets[::2]])
+        update_topic_summaries()
+
+    def test_ticket_summary_update(self):
+        stored = lambda: sorted(TopicSummary.objects.values_list(*['topic_id', 'subtopic_id'] + TOPIC_SUMMARY_COUNTS + TOPIC_SUMMARY_AMOUNTS))
+        ticket = Ticket.objects.filter(topic=self.topic, subtopic=None)[0]
+        # the change is added to the stored sums, the rest of the topic is not read
+        with self.assertNumQueries(10):
+            update_ticket_summaries([ticket.id])
+        # saves of a ticket or item change its summary row alone: savepoint, select, topic summary and user ledger updates, row update, release
+        with self.assertNumQueries(6):
+            change_ticket_summary(ticket.id, additions={'media_files': 1})
+        change_ticket_summary(ticket.id, additions={'media_files': -1})
+
+        expediture = ticket.expediture_set.create(description='bar', amount='5.55', paid=True, wage=True)
+        expediture.paid = False
+        expediture.save()
+        ticket.mediainfo_set.all()[0].delete()
+        ticket.preexpediture_set.create(description='bar', amount=1)
+        ticket.ticketack_set.filter(ack_type='content').delete()
+        ticket.add_acks('content')
+        ticket = Ticket.objects.get(id=ticket.id)
+        ticket.subtopic = self.subtopic
+        ticket.rating_percentage = 80
+        ticket.save()
+        Ticket.objects.filter(topic=self.topic).exclude(id=ticket.id)[0].delete()
+        incremental = stored()
+        update_topic_summaries()
+        self.assertEqual(incremental, stored())
+
+    def test_query_counts(self):
+        profile = self.users[1].trackerprofile
+        ticket_id = self.topic.ticket_set.values_list('id', flat=True)[0]
+        cases = [
+            ('topic totals', 1, Topic.objects.get(id=self.topic.id).ticket_totals),
+            ('subtopic totals', 1, Subtopic.objects.get(id=self.subtopic.id).ticket_totals),
+            ('topic list', 1, lambda: list(Topic.objects.with_totals())),
+            ('topic summary update', 16, lambda: update_topic_summaries([self.topic.id])),
+            ('ticket summary update', 10, lambda: update_ticket_summaries([ticket_id])),
+            ('user media', 1, profile.media_count),
+            ('user accepted expeditures', 1, profile.accepted_expeditures),
+            ('user paid expeditures', 1, profile.paid_expeditures),
+            ('user export', 1, lambda: list(TrackerProfile.objects.filter(user_id__in=UserLedger.objects.filter(accepted_expeditures__gte=100).values('user_id')))),
+            ('user ledger update', 9, lambda: update_user_ledgers([self.users[1].id])),
+        ]
+        report = []
+        for label, count, function in cases:
+            with CaptureQueriesContext(connection) as queries:
+                start = time.time()
+                function()
+                duration = time.time() - start
+            report.append('%s: %d queries, %.2f ms' % (label, len(queries), duration * 1000))
+            self.assertEqual(count, len(queries), report[-1])
+        if os.environ.get('TRACKER_BENCHMARK'):
+            sys.stderr.write('\n' + '\n'.join(report) + '\n')
+
+    def test_results(self):
+        for user in self.users:
+            tickets = user.ticket_set.all()
+            self.assertEqual(sum(t.accepted_expeditures() for t in tickets), user.trackerprofile.accepted_expeditures())
+            self.assertEqual(sum(e.amount for e in Expediture.objects.filter(ticket__in=tickets, paid=True)), user.trackerprofile.paid_expeditures())
+            self.assertEqual({'objects': 2 * len(tickets), 'media': 3 * len(tickets)}, user.trackerprofile.media_count())
+        for container in (self.topic, self.subtopic):
+            tickets = container.ticket_set.all()
+            self.assertEqual(sum(t.accepted_expeditures() for t in tickets), container.accepted_expeditures())
+            self.assertEqual({'count': len(tickets), 'amount': 40 * len(tickets)}, container.preexpeditures())
+            self.assertEqual({'objects': 2 * len(tickets), 'media': 3 * len(tickets)}, container.media_count())
+
+class TicketListStoreTests(TestCase):
+    def setUp(self):
+        self.deploy_root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.deploy_root, 'tickets'))
+        self.topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+
+    def tearDown(self):
+        shutil.rmtree(self.deploy_root)
+
+    def get_file_rows(self, langcode='en'):
+        with open(os.path.join(self.deploy_root, 'tickets', '%s.json' % langcode)) as f:
+            return json.load(f)['data']
+
+    def test_rows_follow_changes(self):
+        with self.settings(TRACKER_PUBLIC_DEPLOY_ROOT=self.deploy_root):
+            ticket = Ticket.objects.create(summary='ticket', requested_text='someone', topic=self.topic, rating_percentage=50)
+            ticket2 = Ticket.objects.create(summary='ticket2', requested_text='someone', topic=self.topic)
+            self.assertFalse(os.path.exists(os.path.join(self.deploy_root, 'tickets', 'en.json')))
+            flush_ticket_list()
+            self.assertEqual(ticket_list_rows(Ticket.objects.order_by('-id')), self.get_file_rows())
+            self.assertEqual(2 * len(settings.LANGUAGES), TicketListRow.objects.count())
+
+            ticket.preexpediture_set.create(description='foo', amount=30)
+            ticket.expediture_set.create(description='foo', amount=100, paid=True)
+            ticket.add_acks('content')
+            flush_ticket_list()
+            self.assertEqual(ticket_list_rows(Ticket.objects.order_by('-id')), self.get_file_rows())
+            self.assertEqual(['30.00 CZK', '50.00 CZK', '50.00 CZK'], self.get_file_rows()[1][6:9])
+
+            ticket.expediture_set.all().delete()
+            flush_ticket_list()
+            self.assertEqual(ticket_list_rows(Ticket.objects.order_by('-id')), self.get_file_rows())
+
+            ticket2.delete()
+            flush_ticket_list()
+            self.assertEqual(1, len(self.get_file_rows('cs')))
+            self.assertEqual(len(settings.LANGUAGES), TicketListRow.objects.count())
+
+    def test_rewritten_once_per_request(self):
+        user = User.objects.create_user('user', 'user@example.com', 'pass')
+        ticket = Ticket.objects.create(summary='ticket', requested_user=user, topic=self.topic)
+        flush_ticket_list()
+        c = Client()
+        c.login(username='user', password='pass')
+        writes = []
+        original = tracker.models.write_ticket_list_file
+        tracker.models.write_ticket_list_file = lambda langcode: writes.append(langcode) or original(langcode)
+        try:
+            with self.settings(TRACKER_PUBLIC_DEPLOY_ROOT=self.deploy_root):
+                c.post(reverse('edit_ticket', kwargs={'pk': ticket.id}), {
+                    'summary': 'changed', 'topic': self.topic.id, 'description': '', 'deposit': '0',
+                    'mediainfo-TOTAL_FORMS': '0', 'mediainfo-INITIAL_FORMS': '0',
+                    'expediture-TOTAL_FORMS': '1', 'expediture-INITIAL_FORMS': '0',
+                    'expediture-0-description': 'foo', 'expediture-0-amount': '10',
+                    'preexpediture-TOTAL_FORMS': '1', 'preexpediture-INITIAL_FORMS': '0',
+                    'preexpediture-0-description': 'bar', 'preexpediture-0-amount': '20',
+                })
+        finally:
+            tracker.models.write_ticket_list_file = original
+        self.assertEqual(sorted(code for code, name in settings.LANGUAGES), sorted(writes))
+        self.assertEqual(ticket_list_rows(Ticket.objects.order_by('-id')), self.get_file_rows())
+        self.assertEqual('20.00 CZK', self.get_file_rows()[0][6])
+
+    def test_write_errors_do_not_break_saves(self):
+        with self.settings(TRACKER_PUBLIC_DEPLOY_ROOT=os.path.join(self.deploy_root, 'missing')):
+            Ticket.objects.create(summary='ticket', requested_text='someone', topic=self.topic)
+            flush_ticket_list()
+        self.assertEqual(len(settings.LANGUAGES), TicketListRow.objects.count())
+
+    def test_rebuild(self):
+        Ticket.objects.create(summary='ticket', requested_text='someone', topic=self.topic)
+        TicketListRow.objects.all().delete()
+        with self.settings(TRACKER_PUBLIC_DEPLOY_ROOT=self.deploy_root):
+            call_command('cachetickets')
+            self.assertEqual(ticket_list_rows(Ticket.objects.order_by('-id')), self.get_file_rows())
+
+
+class TicketListCommitTests(TransactionTestCase):
+    """ Ticket list flushes outside requests, as in management commands, where the changes are really committed. """
+    def test_flushed_on_commit(self):
+        deploy_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, deploy_root)
+        os.mkdir(os.path.join(deploy_root, 'tickets'))
+        topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        with self.settings(TRACKER_PUBLIC_DEPLOY_ROOT=deploy_root):
+            ticket = Ticket.objects.create(summary='ticket', requested_text='someone', topic=topic)
+            self.assertEqual(len(settings.LANGUAGES), TicketListRow.objects.count())
+
+            with deferred_notifications():
+                ticket2 = Ticket.objects.create(summary='ticket2', requested_text='someone', topic=topic)
+                ticket2.preexpediture_set.create(description='foo', amount=30)
+                self.assertEqual(len(settings.LANGUAGES), TicketListRow.objects.count())
+            self.assertEqual(2 * len(settings.LANGUAGES), TicketListRow.objects.count())
+
+            ticket.delete()
+            self.assertEqual([ticket2.id] * len(settings.LANGUAGES), list(TicketListRow.objects.values_list('ticket_id', flat=True)))
+            with open(os.path.join(deploy_root, 'tickets', 'en.json')) as f:
+                self.assertEqual(ticket_list_rows(Ticket.objects.order_by('-id')), json.load(f)['data'])
+
+class ClusterTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+        topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        self.tickets = []
+        for amount in (100, 200, 300):
+            ticket = Ticket.objects.create(summary='foo', requested_user=self.user, topic=topic, rating_percentage=100)
+            ticket.expediture_set.create(description='foo', amount=amount)
+            ticket.add_acks('content')
+            self.tickets.append(ticket)
+
+    def transaction(self, amount, *tickets):
+        transaction = Transaction.objects.create(date=datetime.date.today(), other=self.user, amount=amount, description='pay')
+        transaction.tickets.add(*tickets)
+        return transaction
+
+    def clusters(self):
+        """ ticket id -> cluster id, plus (more_tickets, total_tickets, total_transactions) per cluster """
+        tickets = dict(Ticket.objects.values_list('id', 'cluster_id'))
+        clusters = dict((c.id, (c.more_tickets, c.total_tickets, c.total_transactions)) for c in Cluster.objects.all())
+        return tickets, clusters
+
+    def test_incremental(self):
+        a, b, c = self.tickets
+        t1 = self.transaction(250, a, b)
+        t2 = self.transaction(300, c)
+        self.assertEqual(({a.id:a.id, b.id:a.id, c.id:c.id}, {a.id:(True, 300, 250), c.id:(False, 300, 300)}), self.clusters())
+        self.assertEqual(a.id, Transaction.objects.get(id=t1.id).cluster_id)
+
+        # merge
+        t2.tickets.add(b)
+        self.assertEqual(({a.id:a.id, b.id:a.id, c.id:a.id}, {a.id:(True, 600, 550)}), self.clusters())
+
+        # saving instances loaded before keeps their new clusters
+        c.save()
+        t2.save()
+        self.assertEqual(({a.id:a.id, b.id:a.id, c.id:a.id}, {a.id:(True, 600, 550)}), self.clusters())
+        self.assertEqual(a.id, Transaction.objects.get(id=t2.id).cluster_id)
+
+        # split
+        t1.tickets.remove(a)
+        self.assertEqual(({a.id:None, b.id:b.id, c.id:b.id}, {b.id:(True, 500, 550)}), self.clusters())
+
+        t2.delete()
+        self.assertEqual(({a.id:None, b.id:b.id, c.id:None}, {b.id:(False, 200, 250)}), self.clusters())
+
+        # totals follow ticket changes
+        b.expediture_set.create(description='foo', amount=50)
+        self.assertEqual({b.id:(False, 250, 250)}, self.clusters()[1])
+
+    def test_rebuild(self):
+        a, b, c = self.tickets
+        self.transaction(250, a, b)
+        self.transaction(300, b, c)
+        self.transaction(-50, c)
+        incremental = self.clusters()
+
+        Ticket.objects.update(cluster=None)
+        Cluster.objects.all().delete()
+        call_command('rebuildclusters')
+        self.assertEqual(incremental, self.clusters())
+        self.assertEqual(({a.id:a.id, b.id:a.id, c.id:a.id}, {a.id:(True, 600, 500)}), incremental)
+
+class NotificationTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create(username='owner')
+        self.admin = User.objects.create(username='admin')
+        self.watcher = User.objects.create(username='watcher')
+        self.muted = User.objects.create(username='muted')
+        self.topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'))
+        self.topic.admin.add(self.admin, self.muted)
+        self.ticket = Ticket.objects.create(summary='foo', requested_user=self.owner, topic=self.topic)
+        TopicWatcher.objects.create(topic=self.topic, user=self.watcher, notification_type='comment')
+        TicketWatcher.objects.create(ticket=self.ticket, user=self.admin, notification_type='comment')
+        self.muted.trackerprofile.muted_notifications = json.dumps(['comment'])
+        self.muted.trackerprofile.save()
+
+    def test_fire_notification(self):
+        Notification.objects.all().delete()
+        with self.assertNumQueries(2):
+            Notification.fire_notification(self.ticket, 'text', 'comment', self.watcher)
+        self.assertEqual(set([self.owner, self.admin]), set(n.target_user for n in Notification.objects.filter(ticket=self.ticket, notification_type='comment')))
+        # admin is also a ticket watcher, still notified once
+        self.assertEqual(2, Notification.objects.filter(ticket=self.ticket, notification_type='comment').count())
+
+        Notification.fire_notification(self.ticket, 'text', 'ticket_change', None)
+        self.assertEqual(set([self.admin, self.muted]), set(n.target_user for n in Notification.objects.filter(notification_type='ticket_change')))
+
+    def test_ticket_change(self):
+        ticket = Ticket.objects.get(id=self.ticket.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(set(), ticket.changed_fields())
+            ticket.summary = 'bar'
+            ticket.mandatory_report = True
+            self.assertEqual(set(['summary', 'mandatory_report']), ticket.changed_fields())
+
+        # ticket_change waits until ticket_new gets sent
+        ticket.save()
+        self.assertEqual(set(), ticket.changed_fields())
+        self.assertFalse(Notification.objects.filter(notification_type='ticket_change').exists())
+        self.assertEqual(set([self.owner, self.admin, self.muted]), set(n.target_user for n in Notification.objects.filter(notification_type='ticket_change_all')))
+
+        Notification.objects.all().delete()
+        ticket.summary = 'baz'
+        del ticket._loaded_values # as if not loaded from the database
+        self.assertEqual(set(['summary']), ticket.changed_fields())
+        ticket.save()
+        self.assertEqual(set([self.admin, self.muted]), set(n.target_user for n in Notification.objects.filter(notification_type='ticket_change')))
+
+    def test_deferred_notifications(self):
+        Notification.objects.all().delete()
+        with deferred_notifications():
+            for amount in (10, 20, 30):
+                self.ticket.expediture_set.create(description='foo', amount=amount)
+            self.assertFalse(Notification.objects.exists())
+        notifications = Notification.objects.filter(notification_type='expeditures_change')
+        self.assertEqual(set([self.admin, self.muted]), set(n.target_user for n in notifications))
+        self.assertEqual([3, 3], [n.text.count('<br />') + 1 for n in notifications])
+
+        Notification.objects.all().delete()
+        try:
+            with deferred_notifications():
+                self.ticket.expediture_set.create(description='foo', amount=40)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(Notification.objects.exists())
+        self.assertFalse(self.ticket.expediture_set.filter(amount=40).exists())
+
+        with deferred_notifications():
+            self.ticket.expediture_set.create(description='foo', amount=50)
+            try:
+                with deferred_notifications():
+                    self.ticket.expediture_set.create(description='foo', amount=60)
+                    self.ticket.mediainfo_set.create(description='foo', count=1)
+                    raise ValueError
+            except ValueError:
+                pass
+        notifications = Notification.objects.filter(notification_type='expeditures_change')
+        self.assertEqual([1, 1], [n.text.count('<br />') + 1 for n in notifications])
+        self.assertFalse(Notification.objects.filter(notification_type='media_change').exists())
+
+    def test_watch_ticket(self):
+        self.watcher.set_password('pw')
+        self.watcher.save()
+        c = Client()
+        c.login(username='watcher', password='pw')
+        response = c.post(reverse('watch_ticket', kwargs={'pk':self.ticket.id}), {'ack_add':'on', 'expeditures_change':'on'})
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(set(['comment', 'ack_add', 'expeditures_change']), self.ticket.watched_types(self.watcher))
+
+        with self.assertNumQueries(3): # one per watcher table and call
+            self.assertEqual(set(['comment']), self.topic.watched_types(self.watcher))
+            self.assertTrue(self.ticket.watches(self.watcher, 'ack_add'))
+        response = c.get(reverse('watch_ticket', kwargs={'pk':self.ticket.id}))
+        self.assertEqual(set(['comment', 'ack_add', 'expeditures_change']), set(t for t, name, watched in response.context['notification_types'] if watched))
+
+    def test_sendnotifications(self):
+        Notification.objects.all().delete()
+        for user in (self.owner, self.admin, self.watcher):
+            user.email = '%s@example.com' % user.username
+            user.save()
+        for text in ('one', 'two', 'three'):
+            Notification.fire_notification(self.ticket, text, 'comment', None)
+        self.assertEqual(9, Notification.objects.count()) # owner, admin and watcher; muted has no email
+
+        # digests of users with more than a batch of notifications are read in pages
+        self.assertEqual([3, 3, 3], [len(notifications) for user, notifications in pending_digests(2)])
+
+        out = StringIO.StringIO()
+        with self.assertNumQueries(5): # three batch reads, the last one short, and two deletes
+            call_command('sendnotifications', batch_size=4, workers=2, stdout=out)
+        self.assertFalse(Notification.objects.exists())
+        self.assertTrue(out.getvalue().startswith('Sent 3 digests, 0 failed'))
+        self.assertEqual(set(['owner@example.com', 'admin@example.com', 'watcher@example.com']), set(m.to[0] for m in mail.outbox))
+        for message in mail.outbox:
+            self.assertTrue('three' in message.body)
+            self.assertTrue('three' in message.alternatives[0][0])
+
+    @override_settings(EMAIL_BACKEND='tracker.tests.RejectingEmailBackend')
+    def test_sendnotifications_rejected(self):
+        Notification.objects.all().delete()
+        for user in (self.owner, self.admin, self.watcher):
+            user.email = '%s@example.com' % user.username
+            user.save()
+        Notification.fire_notification(self.ticket, 'one', 'comment', None)
+
+        out = StringIO.StringIO()
+        call_command('sendnotifications', stdout=out)
+        self.assertTrue(out.getvalue().startswith('Sent 2 digests, 1 failed'))
+        self.assertEqual(['admin@example.com'], [n.target_user.email for n in Notification.objects.all()])
+        self.assertEqual(set(['owner@example.com', 'watcher@example.com']), set(m.to[0] for m in mail.outbox))
+
+class RejectingEmailBackend(locmem.EmailBackend):
+    """ Sends no messages to admin@example.com, like a server refusing the recipient. """
+    def send_messages(self, messages):
+        return super(RejectingEmailBackend, self).send_messages([m for m in messages if m.to != ['admin@example.com']])
 
 class UserProfileTests(TestCase):
     def test_simple_create(self):
@@ -936,6 +1711,69 @@ class ImportTests(TestCase):
             })
             self.assertEqual(testConfiguration['superuser'], response.status_code)
 
+    def test_ambiguous_topic(self):
+        User.objects.create_user('importer', 'importer@example.com', 'pw')
+        grant = Grant.objects.create(full_name='g', short_name='g', slug='g')
+        for i in range(2):
+            Topic.objects.create(name='Nazev tematu', grant=grant)
+        c = Client()
+        c.login(username='importer', password='pw')
+        response = c.post(reverse('importcsv'), {'type': 'ticket', 'csvfile': self.get_test_data('ticket')})
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(Ticket.objects.exists())
+
+    def test_topic_import(self):
+        User.objects.create_superuser('importer', 'importer@example.com', 'pw')
+        Grant.objects.create(full_name='Nazev grantu', short_name='g', slug='g')
+        topics_js = Client().get(reverse('topics_js'))
+        c = Client()
+        c.login(username='importer', password='pw')
+        response = c.post(reverse('importcsv'), {'type': 'topic', 'csvfile': self.get_test_data('topic')})
+        self.assertEqual(302, response.status_code)
+        response = Client().get(reverse('topics_js'), HTTP_IF_NONE_MATCH=topics_js['ETag'])
+        self.assertEqual(200, response.status_code)
+        self.assertIn('Popis formulare tematu', response.content)
+
+    def test_bulk_import(self):
+        user = User.objects.create_user('importer', 'importer@example.com', 'pw')
+        topic = Topic.objects.create(name='topic', grant=Grant.objects.create(full_name='g', short_name='g', slug='g'), ticket_expenses=True)
+        topic.admin.add(User.objects.create(username='admin'))
+        tickets = [Ticket.objects.create(summary='foo', topic=topic, requested_user=user) for i in range(3)]
+        Notification.objects.all().delete() # ticket_new sent out
+
+        def post(rows):
+            csvfile = StringIO.StringIO()
+            csvwriter = csv.writer(csvfile, delimiter=';')
+            csvwriter.writerow(['ticket_id', 'description', 'amount', 'wage'])
+            for row in rows:
+                csvwriter.writerow(row)
+            csvfile.seek(0)
+            c = Client()
+            c.login(username='importer', password='pw')
+            return c.post(reverse('importcsv'), {'type': 'expense', 'csvfile': csvfile})
+
+        response = post([[t.id, 'item %d' % i, '10.50', 'False'] for t in tickets for i in range(2)])
+        self.assertEqual(302, response.status_code)
+        self.assertEqual(6, Expediture.objects.count())
+        self.assertEqual(['unpaid'] * 3, [t.payment_status for t in Ticket.objects.filter(id__in=[t.id for t in tickets])])
+        self.assertEqual(False, Expediture.objects.filter(wage=True).exists())
+        notifications = Notification.objects.filter(notification_type='expeditures_change')
+        self.assertEqual(set(t.id for t in tickets), set(n.ticket_id for n in notifications))
+        self.assertEqual(3, len(notifications))
+        self.assertEqual(2, notifications[0].text.count('item'))
+
+        # the whole file is rolled back on any bad row
+        response = post([[tickets[0].id, 'more', '1', 'False'], [tickets[0].id, 'bad', 'x', 'False']])
+        self.assertEqual(200, response.status_code)
+        response = post([[tickets[0].id, 'more', '1', 'False'], [0, 'unknown', '1', 'False']])
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(6, Expediture.objects.count())
+
+        tickets[0].add_acks('close')
+        response = post([[tickets[1].id, 'more', '1', 'False'], [tickets[0].id, 'closed', '1', 'False']])
+        self.assertEqual(403, response.status_code)
+        self.assertEqual(6, Expediture.objects.count())
+
 class DocumentAccessTests(TestCase):
     def setUp(self):
         self.owner = {'user': User.objects.create(username='ticket_owner'), 'password':'pw1'}
@@ -1,8 +1,7 @@
 # -*- coding: utf-8 -*-
 from django.conf.urls import patterns, include, url
-from django.views.generic import DetailView, RedirectView
+from django.views.generic import RedirectView
 
-from tracker.models import Grant
 from tracker import feeds
 
 urlpatterns = patterns('',
@@ -28,7 +27,7 @@ urlpatterns = patterns('',
     url(r'^topic/watch/(?P<pk>\d+)/$', 'tracker.views.watch_topic', name='watch_topic'),
     url(r'^topic/(?P<pk>\d+)/feed/$', feeds.TopicTicketsFeed(), name='topic_ticket_feed'),
     url(r'^topic/(?P<pk>\d+)/feed/submitted/$', feeds.TopicSubmittedTicketsFeed(), name='topic_submitted_ticket_feed'),
-    url(r'^grant/(?P<slug>[-\w]+)/$', DetailView.as_view(model=Grant), name='grant_detail'),
+    url(r'^grant/(?P<slug>[-\w]+)/$', 'tracker.views.grant_detail', name='grant_detail'),
     url(r'^users/$', 'tracker.views.user_list', name='user_list'),
     url(r'^users/(?P<username>[^/]+)/$', 'tracker.views.user_detail', name='user_detail'),
     url(r'^my/details/$', 'tracker.views.user_details_change', name='user_details_change'),
@@ -44,4 +43,5 @@ urlpatterns = patterns('',
     url(r'^export/$', 'tracker.views.export', name='export'),
     url(r'^import/$', 'tracker.views.importcsv', name='importcsv'),
     url(r'tickets/json/(?P<lang>.+).json$', 'tracker.views.tickets', name='tickets'),
+    url(r'^tickets/data/(?P<lang>[-\w]+)\.json$', 'tracker.views.tickets_data', name='tickets_data'),
 )
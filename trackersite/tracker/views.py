@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 import datetime
+import decimal
 import json
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 
 from django.db import models, connection
 from django.db.models import Q
@@ -11,7 +12,7 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.shortcuts import render, get_object_or_404
 from django.contrib import messages
-from django.http import HttpResponse, HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest, Http404
+from django.http import HttpResponse, StreamingHttpResponse, HttpResponseRedirect, HttpResponseForbidden, HttpResponseBadRequest, Http404
 from django.utils.functional import curry, lazy
 from django.utils.translation import ugettext as _, ugettext_lazy
 from django.core import serializers
@@ -21,34 +22,87 @@ from django.views.generic import ListView, DetailView, FormView, DeleteView
 from django.contrib.admin import widgets as adminwidgets
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.core.cache import cache
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
 from sendfile import sendfile
 from django.utils.translation import get_language
+from django.utils import translation
 import csv
 
 from tracker.models import Ticket, Topic, Subtopic, Grant, FinanceStatus, MediaInfo, Expediture, Preexpediture, Transaction, Cluster, TrackerProfile, Document, TicketAck, PossibleAck, TicketWatcher, TopicWatcher
-from tracker.models import NOTIFICATION_TYPES
+from tracker.models import NOTIFICATION_TYPES, TICKET_STATES, TICKET_PAYMENT_STATUSES, ticket_list_rows, prefetch_cached, deferred_notifications, batched_payment_status, topics_version
+from tracker.models import UserLedger, notify_items_saved, ticket_list_changed, topics_changed, update_ticket_summaries
 from users.models import UserWrapper
 
 def ticket_list(request, page):
     return render(request, 'tracker/index.html', {"LANGUAGE": get_language()})
 
 def tickets(request, lang):
-    tickets = []
-    for ticket in Ticket.objects.order_by('-id'):
-        tickets.append([
-            '<a href="%s">%s</a>' % (ticket.get_absolute_url(), ticket.pk),
-            unicode(ticket.event_date),
-            '<a class="ticket-summary" href="%s">%s</a>' % (ticket.get_absolute_url(), ticket.summary),
-            '<a href="%s">%s</a>' % (ticket.topic.grant.get_absolute_url(), ticket.topic.grant),
-            '<a href="%s">%s</a>' % (ticket.topic.get_absolute_url(), ticket.topic),
-            ticket.requested_by_html(),
-            "%s %s" % (ticket.preexpeditures()['amount'] or 0, settings.TRACKER_CURRENCY),
-            "%s %s" % (ticket.accepted_expeditures(), settings.TRACKER_CURRENCY),
-            "%s %s" % (ticket.paid_expeditures(), settings.TRACKER_CURRENCY),
-            unicode(ticket.state_str()),
-            unicode(ticket.updated),
-        ])
-    return JsonResponse({"data": tickets})
+    return JsonResponse({"data": ticket_list_rows(Ticket.objects.order_by('-id'))})
+
+# DataTables column index -> ticket ordering field, see tracker/index.html
+TICKET_LIST_ORDERING = {
+    '0': 'id',
+    '1': 'event_date',
+    '2': 'summary',
+    '4': 'topic__name',
+    '10': 'updated',
+}
+
+def tickets_data(request, lang):
+    """
+    Server-side processing endpoint for the DataTables ticket list, see
+    https://datatables.net/manual/server-side for the protocol.
+    """
+    if lang not in dict(settings.LANGUAGES):
+        raise Http404
+    try:
+        draw = int(request.GET.get('draw', 0))
+        start = max(int(request.GET.get('start', 0)), 0)
+        length = int(request.GET.get('length', 25))
+    except ValueError:
+        return HttpResponseBadRequest('Invalid paging parameters')
+
+    ordering = []
+    i = 0
+    while 'order[%d][column]' % i in request.GET:
+        field = TICKET_LIST_ORDERING.get(request.GET['order[%d][column]' % i])
+        if field is not None:
+            prefix = '-' if request.GET.get('order[%d][dir]' % i) == 'desc' else ''
+            ordering.append(prefix + field)
+        i += 1
+    if 'id' not in ordering and '-id' not in ordering:
+        ordering.append('-id') # unique key at the end keeps paging stable
+
+    tickets = Ticket.objects.all()
+    total = tickets.count()
+    search = request.GET.get('search[value]', '').strip()
+    if search:
+        query = Q(summary__icontains=search) | Q(topic__name__icontains=search) | Q(requested_user__username__icontains=search) | Q(requested_text__icontains=search)
+        if search.isdigit():
+            query |= Q(id=int(search))
+        tickets = tickets.filter(query)
+        filtered = tickets.count()
+    else:
+        filtered = total
+
+    # look up ids of the page first, so the database can page through the
+    # index only, and render just the tickets that are going to be shown
+    page_ids = tickets.order_by(*ordering).values_list('id', flat=True)
+    if length >= 0:
+        page_ids = page_ids[start:start + length]
+    else:
+        page_ids = page_ids[start:]
+    with translation.override(lang):
+        rows = ticket_list_rows(Ticket.objects.filter(id__in=list(page_ids)).order_by(*ordering))
+
+    return JsonResponse({
+        'draw': draw,
+        'recordsTotal': total,
+        'recordsFiltered': filtered,
+        'data': rows,
+    })
 
 class CommentPostedCatcher(object):
     """
@@ -139,42 +193,93 @@ class TicketAckDeleteView(DeleteView):
         return HttpResponseRedirect(self.ticket.get_absolute_url())
 ticket_ack_delete = TicketAckDeleteView.as_view()
 
+def topic_table_list(topics):
+    """ Prepares topic queryset for rendering in tracker/topic_table.html """
+    return topics.with_totals().select_related('grant').prefetch_related('admin')
+
 def topic_list(request):
     return render(request, 'tracker/topic_list.html', {
-        'open_topics': Topic.objects.filter(open_for_tickets=True),
-        'closed_topics': Topic.objects.filter(open_for_tickets=False),
+        'open_topics': topic_table_list(Topic.objects.filter(open_for_tickets=True)),
+        'closed_topics': topic_table_list(Topic.objects.filter(open_for_tickets=False)),
     })
 
+class GrantDetailView(DetailView):
+    model = Grant
+
+    def get_context_data(self, **kwargs):
+        context = super(GrantDetailView, self).get_context_data(**kwargs)
+        context['topic_list'] = topic_table_list(self.object.topic_set.all())
+        return context
+grant_detail = GrantDetailView.as_view()
+
+# cached getters used by tracker/ticket_table.html
+TICKET_TABLE_GETTERS = ['ack_set', 'media_count', 'preexpeditures', 'accepted_expeditures', 'paid_expeditures']
+
+def ticket_table_list(tickets):
+    """ Prepares ticket queryset for rendering in tracker/ticket_table.html """
+    tickets = tickets.select_related('topic__grant', 'requested_user').prefetch_related('mediainfo_set')
+    return prefetch_cached(tickets, TICKET_TABLE_GETTERS)
+
 class TopicDetailView(CommentPostedCatcher, DetailView):
-    model = Topic
+    queryset = Topic.objects.with_totals()
 
     def get_context_data(self, **kwargs):
         context = super(TopicDetailView, self).get_context_data(**kwargs)
         context['user_admin_of_topic'] = self.request.user in self.object.admin.all()
+        context['ticket_list'] = ticket_table_list(self.object.ticket_set.all())
         return context
 topic_detail = TopicDetailView.as_view()
 
 class SubtopicDetailView(CommentPostedCatcher, DetailView):
-    model = Subtopic
+    queryset = Subtopic.objects.with_totals()
+
+    def get_context_data(self, **kwargs):
+        context = super(SubtopicDetailView, self).get_context_data(**kwargs)
+        context['ticket_list'] = ticket_table_list(self.object.ticket_set.all())
+        return context
 subtopic_detail = SubtopicDetailView.as_view()
 
-def topics_js(request):
-    data = {}
-    for t in Topic.objects.all():
-        data[t.id] = {}
-        for attr in ('form_description', 'ticket_media', 'ticket_expenses', 'ticket_preexpenses'):
-            data[t.id][attr] = getattr(t, attr)
-        data[t.id]['subtopic_set'] = []
-        for subtopic in t.subtopic_set.all():
-            data[t.id]['subtopic_set'].append({
+def topics_js_content(version):
+    """ Topic table script of given topics version, rendered from one topic and one subtopic query and cached. """
+    key = u'topics_js:%r' % version
+    content = cache.get(key)
+    if content is None:
+        data = {}
+        for t in Topic.objects.order_by():
+            data[t.id] = {}
+            for attr in ('form_description', 'ticket_media', 'ticket_expenses', 'ticket_preexpenses'):
+                data[t.id][attr] = getattr(t, attr)
+            data[t.id]['subtopic_set'] = []
+        for subtopic in Subtopic.objects.all():
+            if subtopic.topic_id not in data:
+                continue # its topic was created after the topic query
+            data[subtopic.topic_id]['subtopic_set'].append({
                 "id": subtopic.id,
                 "name": subtopic.name,
                 "display_name": unicode(subtopic),
                 "description": subtopic.description
             })
-
-    content = 'topics_table = %s;' % json.dumps(data)
-    return HttpResponse(content, content_type='text/javascript')
+        content = 'topics_table = %s;' % json.dumps(data)
+        # topics changed while they were read may be in the content or not
+        if topics_version() == version:
+            cache.set(key, content)
+    return content
+
+def _request_topics_version(request):
+    """ topics_version() read once per request, so that its ETag, Last-Modified and content agree. """
+    if not hasattr(request, '_topics_version'):
+        request._topics_version = topics_version()
+    return request._topics_version
+
+@condition(
+    etag_func=lambda request: u'%r' % _request_topics_version(request),
+    last_modified_func=lambda request: datetime.datetime.utcfromtimestamp(_request_topics_version(request)),
+)
+def topics_js(request):
+    response = HttpResponse(topics_js_content(_request_topics_version(request)), content_type='text/javascript')
+    # the URL stays the same, browsers have to ask whether the table changed
+    patch_cache_control(response, no_cache=True)
+    return response
 
 class TicketForm(forms.ModelForm):
     def __init__(self, *args, **kwargs):
@@ -191,7 +296,7 @@ class TicketForm(forms.ModelForm):
     class Meta:
         model = Ticket
         exclude = ('created', 'updated', 'requested_user', 'requested_text',
-            'custom_state', 'rating_percentage', 'supervisor_notes', 'cluster', 'payment_status', 'mandatory_report', 'imported')
+            'custom_state', 'rating_percentage', 'supervisor_notes', 'cluster', 'payment_status', 'state', 'mandatory_report', 'imported')
         widgets = {
             'event_date': adminwidgets.AdminDateWidget(),
             'summary': forms.TextInput(attrs={'size':'40'}),
@@ -312,22 +417,25 @@ def watch_ticket(request, pk):
         messages.warning(request, _('You cannot watch ticket in topic you are an admin of explicitely. You are already subscribed to all notifications.'))
         return HttpResponseRedirect(ticket.get_absolute_url())
     if request.method == 'POST':
-        for watcher in TicketWatcher.objects.filter(ticket=ticket, user=request.user): watcher.delete()
-        for notification_type in NOTIFICATION_TYPES:
-            if notification_type[0] in request.POST: TicketWatcher.objects.create(ticket=ticket, user=request.user, notification_type=notification_type[0])
+        TicketWatcher.objects.filter(ticket=ticket, user=request.user).delete()
+        TicketWatcher.objects.bulk_create([
+            TicketWatcher(ticket=ticket, user=request.user, notification_type=notification_type[0])
+            for notification_type in NOTIFICATION_TYPES if notification_type[0] in request.POST
+        ])
         messages.success(request, _("Ticket's %s watching settings are changed.") % ticket)
         return HttpResponseRedirect(ticket.get_absolute_url())
     else:
         notification_types = []
+        watched = ticket.watched_types(request.user)
         for notification_type in NOTIFICATION_TYPES:
             if notification_type[0] == 'ticket_new': continue # Watching ticket created event on particular ticket doesn't make sense
             notification_types.append((
                 notification_type[0],
                 notification_type[1],
-                ticket.watches(request.user, notification_type[0])
+                notification_type[0] in watched
             ))
         return render(request, 'tracker/watch.html',{
-            "object": get_object_or_404(Ticket, id=pk),
+            "object": ticket,
             "objecttype": _("ticket"),
             "notification_types": notification_types,
         })
@@ -339,18 +447,21 @@ def watch_topic(request, pk):
         messages.warning(request, _('You cannot watch topic you are an admin of explicitely. You are already subscribed to all notifications.'))
         return HttpResponseRedirect(topic.get_absolute_url())
     if request.method == 'POST':
-        for watcher in TopicWatcher.objects.filter(topic=topic, user=request.user): watcher.delete()
-        for notification_type in NOTIFICATION_TYPES:
-            if notification_type[0] in request.POST: TopicWatcher.objects.create(topic=topic, user=request.user, notification_type=notification_type[0])
+        TopicWatcher.objects.filter(topic=topic, user=request.user).delete()
+        TopicWatcher.objects.bulk_create([
+            TopicWatcher(topic=topic, user=request.user, notification_type=notification_type[0])
+            for notification_type in NOTIFICATION_TYPES if notification_type[0] in request.POST
+        ])
         messages.success(request, _("Topic's %s watching settings are changed.") % topic)
         return HttpResponseRedirect(topic.get_absolute_url())
     else:
         notification_types = []
+        watched = topic.watched_types(request.user)
         for notification_type in NOTIFICATION_TYPES:
             notification_types.append((
                 notification_type[0],
                 notification_type[1],
-                topic.watches(request.user, notification_type[0])
+                notification_type[0] in watched
             ))
         return render(request, 'tracker/watch.html', {
             "object": topic,
@@ -379,19 +490,20 @@ def create_ticket(request):
 
         check_ticket_form_deposit(ticketform, preexpeditures)
         if ticketform.is_valid() and mediainfo.is_valid() and expeditures.is_valid() and preexpeditures.is_valid():
-            ticket = ticketform.save(commit=False)
-            ticket.requested_user = request.user
-            ticket.save()
-            ticketform.save_m2m()
-            if ticket.topic.ticket_media:
-                mediainfo.instance = ticket
-                mediainfo.save()
-            if ticket.topic.ticket_expenses:
-                expeditures.instance = ticket
-                expeditures.save()
-            if ticket.topic.ticket_preexpenses:
-                preexpeditures.instance = ticket
-                preexpeditures.save()
+            with deferred_notifications(), batched_payment_status():
+                ticket = ticketform.save(commit=False)
+                ticket.requested_user = request.user
+                ticket.save()
+                ticketform.save_m2m()
+                if ticket.topic.ticket_media:
+                    mediainfo.instance = ticket
+                    mediainfo.save()
+                if ticket.topic.ticket_expenses:
+                    expeditures.instance = ticket
+                    expeditures.save()
+                if ticket.topic.ticket_preexpenses:
+                    preexpeditures.instance = ticket
+                    preexpeditures.save()
 
             messages.success(request, _('Ticket %s created.') % ticket)
             return HttpResponseRedirect(ticket.get_absolute_url())
@@ -468,12 +580,15 @@ def edit_ticket(request, pk):
         if ticketform.is_valid() and mediainfo.is_valid() \
                 and (expeditures.is_valid() if 'content' not in ticket.ack_set() else True) \
                 and (preexpeditures.is_valid() if 'precontent' not in ticket.ack_set() and 'content' not in ticket.ack_set() else True):
-            ticket = ticketform.save()
-            mediainfo.save()
-            if 'content' not in ticket.ack_set():
-                expeditures.save()
-            if 'precontent' not in ticket.ack_set():
-                preexpeditures.save()
+            with deferred_notifications(), batched_payment_status():
+                ticket = ticketform.save()
+                mediainfo.save()
+                if 'content' not in ticket.ack_set():
+                    expeditures.save()
+                    # deleted expeditures do not update it on their own
+                    ticket.update_payment_status()
+                if 'precontent' not in ticket.ack_set():
+                    preexpeditures.save()
 
             messages.success(request, _('Ticket %s saved.') % ticket)
             return HttpResponseRedirect(ticket.get_absolute_url())
@@ -598,21 +713,27 @@ def download_document(request, ticket_id, filename):
     return sendfile(request, doc.payload.path, mimetype=doc.content_type)
 
 def topic_finance(request):
+    grant_topics = defaultdict(list)
+    for topic in Topic.objects.with_totals():
+        grant_topics[topic.grant_id].append({'topic':topic, 'finance':topic.payment_summary()})
+
     grants_out = []
     for grant in Grant.objects.all():
-        topics = []
-        grant_finance = FinanceStatus()
-        for topic in grant.topic_set.all():
-            topic_finance = topic.payment_summary()
-            grant_finance.add_finance(topic_finance)
-            topics.append({'topic':topic, 'finance':topic_finance})
-        grants_out.append({'grant':grant, 'topics':topics, 'finance':grant_finance, 'rows':len(topics)+1})
+        topics = grant_topics[grant.id]
+        finance = FinanceStatus()
+        for titem in topics:
+            finance.add_finance(titem['finance'])
+        grants_out.append({'grant':grant, 'topics':topics, 'finance':finance, 'rows':len(topics)+1})
 
     return render(request, 'tracker/topic_finance.html', {
         'grants': grants_out,
         'have_fuzzy': any([row['finance'].fuzzy for row in grants_out]),
     })
 
+def csv_line(row):
+    """ One CSV line of given values, quoted the way tracker exports always were. """
+    return u';'.join(map(lambda s: u'"' + unicode(s).replace('"', "'").replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ') + u'"', row)) + u'\r\n'
+
 class HttpResponseCsv(HttpResponse):
     def __init__(self, fields, *args, **kwargs):
         kwargs['content_type'] = 'text/csv'
@@ -620,8 +741,43 @@ class HttpResponseCsv(HttpResponse):
         self.writerow(fields)
 
     def writerow(self, row):
-        self.write(u';'.join(map(lambda s: u'"' + unicode(s).replace('"', "'").replace('\r\n', ' ').replace('\n', ' ').replace('\r', ' ') + u'"', row)))
-        self.write(u'\r\n')
+        self.write(csv_line(row))
+
+class StreamingHttpResponseCsv(StreamingHttpResponse):
+    """ CSV response rendered lazily from an iterable of rows, sent in chunks of chunk_rows lines. """
+    chunk_rows = 500
+
+    def __init__(self, fields, rows, *args, **kwargs):
+        kwargs['content_type'] = 'text/csv'
+        super(StreamingHttpResponseCsv, self).__init__(self.chunks(fields, rows), *args, **kwargs)
+
+    def chunks(self, fields, rows):
+        chunk = [csv_line(fields)]
+        for row in rows:
+            chunk.append(csv_line(row))
+            if len(chunk) >= self.chunk_rows:
+                yield u''.join(chunk)
+                chunk = []
+        if chunk:
+            yield u''.join(chunk)
+
+def iterate_by_id(queryset, descending=False, chunk_size=500):
+    """
+    Yields objects of queryset ordered by id, reading chunk_size of them per
+    query that continues after the last id read; iterator() would not help,
+    MySQLdb fetches its whole result into memory. values_list() rows have to
+    start with the id.
+    """
+    ordered = queryset.order_by('-id' if descending else 'id')
+    chunk = list(ordered[:chunk_size])
+    while chunk:
+        for obj in chunk:
+            yield obj
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1]
+        last_id = last[0] if isinstance(last, tuple) else last.pk
+        chunk = list(ordered.filter(**{'id__lt' if descending else 'id__gt': last_id})[:chunk_size])
 
 def _get_topic_content_acks_per_user():
     """ Returns content acks counts per user and topic """
@@ -656,10 +812,8 @@ def topic_content_acks_per_user(request):
     })
 
 def topic_content_acks_per_user_csv(request):
-    response = HttpResponseCsv(['user', 'grant', 'topic', 'ack_count'])
-    for row in _get_topic_content_acks_per_user():
-        response.writerow([row.user, row.grant, row.topic, row.ack_count])
-    return response
+    rows = ([row.user, row.grant, row.topic, row.ack_count] for row in _get_topic_content_acks_per_user())
+    return StreamingHttpResponseCsv(['user', 'grant', 'topic', 'ack_count'], rows)
 
 def transaction_list(request):
     return render(request, 'tracker/transaction_list.html', {
@@ -670,42 +824,32 @@ def transaction_list(request):
 
 
 def transactions_csv(request):
-    response = HttpResponseCsv(
-        ['DATE', 'OTHER PARTY', 'AMOUNT ' + unicode(settings.TRACKER_CURRENCY), 'DESCRIPTION', 'TICKETS', 'GRANTS', 'ACCOUNTING INFO']
+    rows = ([
+        tx.date.strftime('%Y-%m-%d'),
+        tx.other_party(),
+        tx.amount,
+        tx.description,
+        u' '.join([unicode(t.id) for t in tx.tickets.all()]),
+        u' '.join([g.short_name for g in tx.grant_set()]),
+        tx.accounting_info,
+    ] for tx in iterate_by_id(Transaction.objects.all()))
+    return StreamingHttpResponseCsv(
+        ['DATE', 'OTHER PARTY', 'AMOUNT ' + unicode(settings.TRACKER_CURRENCY), 'DESCRIPTION', 'TICKETS', 'GRANTS', 'ACCOUNTING INFO'], rows
     )
 
-    for tx in Transaction.objects.all():
-        response.writerow([
-            tx.date.strftime('%Y-%m-%d'),
-            tx.other_party(),
-            tx.amount,
-            tx.description,
-            u' '.join([unicode(t.id) for t in tx.tickets.all()]),
-            u' '.join([g.short_name for g in tx.grant_set()]),
-            tx.accounting_info,
-        ])
-    return response
-
 def user_list(request):
-    totals = {
-        'ticket_count': Ticket.objects.count(),
-        'media': MediaInfo.objects.aggregate(objects=models.Count('id'), media=models.Sum('count')),
-        'accepted_expeditures': sum([t.accepted_expeditures() for t in Ticket.objects.filter(rating_percentage__gt=0)]),
-        'transactions': Expediture.objects.filter(paid=True).aggregate(amount=models.Sum('amount'))['amount'],
-    }
-
-    userless = Ticket.objects.filter(requested_user=None)
-    if userless.count() > 0:
-        unassigned = {
-            'ticket_count': userless.count(),
-            'media': MediaInfo.objects.extra(where=['ticket_id in (select id from tracker_ticket where requested_user_id is null)']).aggregate(objects=models.Count('id'), media=models.Sum('count')),
-            'accepted_expeditures': sum([t.accepted_expeditures() for t in userless]),
-        }
-    else:
+    ledgers = dict((ledger.user_id, ledger) for ledger in UserLedger.objects.all())
+    users = list(User.objects.select_related('trackerprofile'))
+    for u in users:
+        u.ledger = ledgers.get(u.id)
+
+    totals = dict((field, sum(getattr(ledger, field) for ledger in ledgers.values())) for field in ('ticket_count', 'media_objects', 'media_files', 'accepted_expeditures', 'paid_expeditures'))
+    unassigned = ledgers.get(None)
+    if unassigned is not None and unassigned.ticket_count == 0:
         unassigned = None
 
     return render(request, 'tracker/user_list.html', {
-        'user_list': User.objects.all(),
+        'user_list': users,
         'unassigned': unassigned,
         'totals': totals,
     })
@@ -716,7 +860,7 @@ def user_detail(request, username):
     return render(request, 'tracker/user_detail.html', {
         'user_obj': user,
         # ^ NOTE 'user' means session user in the template, so we're using user_obj
-        'ticket_list': user.ticket_set.all(),
+        'ticket_list': ticket_table_list(user.ticket_set.all()),
     })
 
 class UserDetailsChange(FormView):
@@ -772,6 +916,7 @@ def cluster_detail(request, pk):
 
     return render(request, 'tracker/cluster_detail.html', {
         'cluster': cluster,
+        'ticket_list': ticket_table_list(cluster.ticket_set.all()),
         'ticket_summary': {'accepted_expeditures': cluster.total_tickets},
     })
 
@@ -786,153 +931,67 @@ class AdminUserListView(ListView):
             return context
 admin_user_list = login_required(AdminUserListView.as_view())
 
+def _range_filter(queryset, field, larger, smaller):
+    """ Filters queryset to given field being within optional larger/smaller bounds from the export form. """
+    if larger != '':
+        queryset = queryset.filter(**{field + '__gte': int(larger)})
+    if smaller != '':
+        queryset = queryset.filter(**{field + '__lte': int(smaller)})
+    return queryset
+
+def export_tickets(post):
+    """
+    values_list queryset of ticket export rows matching the export form, with
+    all filters compiled into SQL; money totals come from the TicketSummary
+    row of each ticket, so a single query serves any number of tickets.
+    """
+    tickets = Ticket.objects.all()
+    states = [state for state, label in TICKET_STATES if state in post]
+    if states:
+        tickets = tickets.filter(state__in=states)
+    topics = [long(post[item]) for item in post if item.startswith('ticket-topic-')]
+    if topics:
+        tickets = tickets.filter(topic_id__in=topics)
+    users = [long(post[item]) for item in post if item.startswith('ticket-user-')]
+    if users:
+        tickets = tickets.filter(requested_user_id__in=users)
+    if 'ticket-report-mandatory' in post:
+        tickets = tickets.filter(mandatory_report=True)
+
+    tickets = _range_filter(tickets, 'ticketsummary__preexpeditures_amount', post['preexpeditures-larger'], post['preexpeditures-smaller'])
+    tickets = _range_filter(tickets, 'ticketsummary__expeditures_amount', post['expeditures-larger'], post['expeditures-smaller'])
+    # stored rounded half up per ticket, like Ticket.accepted_expeditures
+    tickets = _range_filter(tickets, 'ticketsummary__accepted_amount', post['acceptedexpeditures-larger'], post['acceptedexpeditures-smaller'])
+
+    return tickets.values_list(
+        'id', 'created', 'updated', 'event_date', 'event_url', 'summary', 'requested_user__username', 'requested_text',
+        'topic__grant__full_name', 'topic__name', 'state', 'deposit', 'description', 'mandatory_report',
+        'ticketsummary__accepted_amount', 'ticketsummary__preexpeditures_count', 'ticketsummary__preexpeditures_amount',
+        'ticketsummary__expeditures_count', 'ticketsummary__expeditures_amount',
+    )
+
+def ticket_export_rows(tickets):
+    """ Yields ticket export CSV rows of given export_tickets queryset, newest first like the ticket list. """
+    state_labels = dict(TICKET_STATES)
+    for row in iterate_by_id(tickets, descending=True):
+        (ticket_id, created, updated, event_date, event_url, summary, username, requested_text, grant, topic, state, deposit,
+            description, mandatory_report, accepted, preexpeditures_count, preexpeditures, expeditures_count, expeditures) = row
+        # sums of no items are None, as Ticket.preexpeditures() and Ticket.expeditures() give them
+        preexpeditures = preexpeditures if preexpeditures_count else None
+        expeditures = expeditures if expeditures_count else None
+        yield [ticket_id, created, updated, event_date, event_url, summary, username if username is not None else requested_text, grant, topic, state_labels.get(state, state), deposit, description, mandatory_report, accepted or decimal.Decimal(0), preexpeditures, expeditures]
+
 def export(request):
     if request.method == 'POST':
         typ = request.POST['type']
         if typ == 'ticket':
-            states = ['draft', 'wfpreapproval', 'wfsubmiting', 'wfapproval', 'wfdocssub', 'wffill', 'complete', 'archived', 'closed', 'custom']
-            tickets = []
-            for state in states:
-                if state in request.POST:
-                    tickets += Ticket.get_tickets_with_state(request.POST[state])
-            if len(tickets) == 0:
-                tickets = list(Ticket.objects.all())
-            tickets = list(set(tickets))
-            topics = []
-            for item in request.POST:
-                if item.startswith('ticket-topic-'):
-                    topics.append(Topic.objects.get(id=long(request.POST[item])))
-            tmp = []
-            if len(topics) != 0:
-                for topic in topics:
-                    for ticket in tickets:
-                        if ticket.topic == topic:
-                            tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            users = []
-            for item in request.POST:
-                if item.startswith('ticket-user-'):
-                    users.append(User.objects.get(id=long(request.POST[item])))
-            if len(users) != 0:
-                for user in users:
-                    for ticket in tickets:
-                        if ticket.requested_user == user:
-                            tmp.append(ticket)
-                    tickets = tmp
-                    tmp = []
-            larger = request.POST['preexpeditures-larger']
-            smaller = request.POST['preexpeditures-smaller']
-            if larger != '' and smaller != '':
-                larger = int(larger)
-                smaller = int(smaller)
-                for ticket in tickets:
-                    real = ticket.preexpeditures()['amount']
-                    if real == None:
-                        real = 0
-                    if real >= larger and real <= smaller:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            elif larger != '' and smaller == '':
-                larger = int(larger)
-                for ticket in tickets:
-                    real = ticket.preexpeditures()['amount']
-                    if real == None:
-                        real = 0
-                    if real >= larger:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            elif larger == '' and smaller != '':
-                smaller = int(smaller)
-                for ticket in tickets:
-                    real = ticket.preexpeditures()['amount']
-                    if real == None:
-                        real = 0
-                    if real <= smaller:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            larger = request.POST['expeditures-larger']
-            smaller = request.POST['expeditures-smaller']
-            if larger != '' and smaller != '':
-                larger = int(larger)
-                smaller = int(smaller)
-                for ticket in tickets:
-                    real = ticket.expeditures()['amount']
-                    if real == None:
-                        real = 0
-                    if real >= larger and real <= smaller:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            elif larger != '' and smaller == '':
-                larger = int(larger)
-                for ticket in tickets:
-                    real = ticket.expeditures()['amount']
-                    if real == None:
-                        real = 0
-                    if real >= larger:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            elif larger == '' and smaller != '':
-                smaller = int(smaller)
-                for ticket in tickets:
-                    real = ticket.expeditures()['amount']
-                    if real == None:
-                        real = 0
-                    if real <= smaller:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            larger = request.POST['acceptedexpeditures-larger']
-            smaller = request.POST['acceptedexpeditures-smaller']
-            if larger != '' and smaller != '':
-                larger = int(larger)
-                smaller = int(smaller)
-                for ticket in tickets:
-                    real = ticket.accepted_expeditures()
-                    if real >= larger and real <= smaller:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            elif larger != '' and smaller == '':
-                larger = int(larger)
-                for ticket in tickets:
-                    real = ticket.accepted_expeditures()
-                    if real >= larger:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            elif larger == '' and smaller != '':
-                smaller = int(smaller)
-                for ticket in tickets:
-                    real = ticket.accepted_expeditures()
-                    if real <= smaller:
-                        tmp.append(ticket)
-                tickets = tmp
-                tmp = []
-            mandatory_report = 'ticket-report-mandatory' in request.POST
-            if mandatory_report:
-                tmp = []
-                for ticket in tickets:
-                    if ticket.mandatory_report:
-                        tmp.append(ticket)
-                tickets = tmp
-                del(tmp)
-            response = HttpResponseCsv(['id', 'created', 'updated', 'event_date', 'event_url', 'summary', 'requested_by', 'grant', 'topic', 'state', 'deposit', 'description', 'mandatory_report', 'accepted_expeditures', 'preexpeditures', 'expeditures'])
+            response = StreamingHttpResponseCsv(['id', 'created', 'updated', 'event_date', 'event_url', 'summary', 'requested_by', 'grant', 'topic', 'state', 'deposit', 'description', 'mandatory_report', 'accepted_expeditures', 'preexpeditures', 'expeditures'], ticket_export_rows(export_tickets(request.POST)))
             response['Content-Disposition'] = 'attachment; filename="exported-tickets.csv"'
-            for ticket in tickets:
-                response.writerow([ticket.id, ticket.created, ticket.updated, ticket.event_date, ticket.event_url, ticket.summary, ticket.requested_by(), ticket.topic.grant.full_name, ticket.topic.name, ticket.state_str(), ticket.deposit, ticket.description, ticket.mandatory_report, ticket.accepted_expeditures(), ticket.preexpeditures()['amount'], ticket.expeditures()['amount']])
             return response
         elif typ == 'grant':
-            response = HttpResponseCsv(['full_name', 'short_name', 'slug', 'description'])
-            grants = Grant.objects.all()
-            for grant in grants:
-                response.writerow([grant.full_name, grant.short_name, grant.slug, grant.description])
-            return response
+            # not paged, grants are few and listed by name
+            rows = ([grant.full_name, grant.short_name, grant.slug, grant.description] for grant in Grant.objects.all())
+            return StreamingHttpResponseCsv(['full_name', 'short_name', 'slug', 'description'], rows)
         elif typ == 'preexpediture':
             larger = request.POST['preexpediture-amount-larger']
             smaller = request.POST['preexpediture-amount-larger']
@@ -949,10 +1008,9 @@ def export(request):
                 preexpeditures = Preexpediture.objects.filter(amount__lte=smaller, wage=wage)
             else:
                 preexpeditures = Preexpediture.objects.filter(wage=wage)
-            response = HttpResponseCsv(['ticket_id', 'description', 'amount', 'wage'])
+            rows = ([preexpediture.ticket_id, preexpediture.description, preexpediture.amount, preexpediture.wage] for preexpediture in iterate_by_id(preexpeditures))
+            response = StreamingHttpResponseCsv(['ticket_id', 'description', 'amount', 'wage'], rows)
             response['Content-Disposition'] = 'attachment; filename="exported-preexpeditures.csv"'
-            for preexpediture in preexpeditures:
-                response.writerow([preexpediture.ticket_id, preexpediture.description, preexpediture.amount, preexpediture.wage])
             return response
         elif typ == 'expediture':
             larger = request.POST['expediture-amount-larger']
@@ -971,225 +1029,55 @@ def export(request):
                 expeditures = Expediture.objects.filter(amount__lte=smaller, wage=wage, paid=paid)
             else:
                 expeditures = Expediture.objects.filter(wage=wage, paid=paid)
-            response = HttpResponseCsv(['ticket_id', 'description', 'amount', 'wage', 'paid'])
+            rows = ([expediture.ticket_id, expediture.description, expediture.amount, expediture.wage, expediture.paid] for expediture in iterate_by_id(expeditures))
+            response = StreamingHttpResponseCsv(['ticket_id', 'description', 'amount', 'wage', 'paid'], rows)
             response['Content-Disposition'] = 'attachment; filename="exported-expeditures.csv"'
-            for expediture in expeditures:
-                response.writerow([expediture.ticket_id, expediture.description, expediture.amount, expediture.wage, expediture.paid])
             return response
         elif typ == 'topic':
-            users = []
-            for item in request.POST:
-                if item.startswith('topics-user-'):
-                    users.append(User.objects.get(id=long(request.POST[item])))
             topics = Topic.objects.all()
-            if len(users) != 0:
-                tmp = []
-                for user in users:
-                    for topic in topics:
-                        if user in topic.admin.all():
-                            tmp.append(topic)
-                topics = list(set(tmp))
-                tmp = []
-            larger = request.POST['topics-tickets-larger']
-            smaller = request.POST['topics-tickets-smaller']
-            if larger != '' and smaller != '':
-                larger = int(larger)
-                smaller = int(smaller)
-                tmp = []
-                for topic in topics:
-                    if topic.ticket_set.count >= larger and topic.ticket_set.count <= smaller:
-                        tmp.append(topic)
-                topics = tmp
-                tmp = []
-            elif larger != '' and smaller == '':
-                larger = int(larger)
-                tmp = []
-                for topic in topics:
-                    if topic.ticket_set.count >= larger:
-                        tmp.append(topic)
-                topics = tmp
-                tmp = []
-            elif larger == '' and smaller != '':
-                smaller = int(smaller)
-                tmp = []
-                for topic in topics:
-                    if topic.ticket_set.count <= smaller:
-                        tmp.append(topic)
-                topics = tmp
-                tmp = []
-            if request.POST['topics-paymentstate'] != 'default':
-                paymentstatus = request.POST['topics-paymentstate']
-                larger = request.POST['topics-paymentstate-larger']
-                smaller = request.POST['topics-paymentstate-smaller']
-                if larger != '' and smaller != '':
-                    larger = int(larger)
-                    smaller = int(smaller)
-                    tmp = []
-                    for topic in topics:
-                        number = -1
-                        if paymentstatus in topic.tickets_per_payment_status():
-                            number = topic.tickets_per_payment_status()[paymentstatus]
-                        else:
-                            number = 0
-                        if number >= larger and number <= smaller:
-                            tmp.append(topic)
-                    topics = tmp
-                    del(tmp)
-                elif larger != '' and smaller == '':
-                    larger = int(larger)
-                    tmp = []
-                    for topic in topics:
-                        number = -1
-                        if paymentstatus in topic.tickets_per_payment_status():
-                            number = topic.tickets_per_payment_status()[paymentstatus]
-                        else:
-                            number = 0
-                        if number >= larger:
-                            tmp.append(topic)
-                    topics = tmp
-                    del(tmp)
-                elif larger == '' and smaller != '':
-                    smaller = int(smaller)
-                    tmp = []
-                    for topic in topics:
-                        number = -1
-                        if paymentstatus in topic.tickets_per_payment_status():
-                            number = topic.tickets_per_payment_status()[paymentstatus]
-                        else:
-                            number = 0
-                        if number <= smaller:
-                            tmp.append(topic)
-                    topics = tmp
-                    del(tmp)
-            response = HttpResponseCsv(['name', 'grant', 'open_for_new_tickets', 'media', 'expenses', 'preexpenses', 'description', 'form_description', 'admins'])
+            users = [long(request.POST[item]) for item in request.POST if item.startswith('topics-user-')]
+            if users:
+                topics = topics.filter(id__in=Topic.objects.filter(admin__in=users).values('id'))
+            topics = topic_table_list(topics)
+            topics = _range_filter(topics, 'tickets_count', request.POST['topics-tickets-larger'], request.POST['topics-tickets-smaller'])
+            paymentstatus = request.POST['topics-paymentstate']
+            if paymentstatus != 'default':
+                if paymentstatus not in [status.replace('/', '_') for status in TICKET_PAYMENT_STATUSES]:
+                    return HttpResponseBadRequest(_('You must fill the form validly'))
+                topics = _range_filter(topics, 'tickets_' + paymentstatus, request.POST['topics-paymentstate-larger'], request.POST['topics-paymentstate-smaller'])
+            # not iterator(), admins are prefetched for the whole (small) topic list
+            rows = ([topic.name, topic.grant.full_name, topic.open_for_tickets, topic.ticket_media, topic.ticket_expenses, topic.ticket_preexpenses, topic.description, topic.form_description, ", ".join([ad.username for ad in topic.admin.all()])] for topic in topics)
+            response = StreamingHttpResponseCsv(['name', 'grant', 'open_for_new_tickets', 'media', 'expenses', 'preexpenses', 'description', 'form_description', 'admins'], rows)
             response['Content-Disposition'] = 'attachment; filename="exported-topics.csv"'
-            for topic in topics:
-                names = []
-                for ad in topic.admin.all():
-                    names.append(ad.username)
-                admins = ", ".join(names)
-                response.writerow([topic.name, topic.grant.full_name, topic.open_for_tickets, topic.ticket_media, topic.ticket_expenses, topic.ticket_preexpenses, topic.description, topic.form_description, admins])
             return response
         elif typ == 'user':
             if request.user.is_authenticated():
                 if request.user.is_staff:
-                    users = TrackerProfile.objects.all()
-                    larger = request.POST['users-created-larger']
-                    smaller = request.POST['users-created-smaller']
-                    if larger != '' and smaller != '':
-                        larger = int(larger)
-                        smaller = int(smaller)
-                        tmp = []
-                        for user in users:
-                            real = user.count_ticket_created()
-                            if real >= larger and real <= smaller:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    elif larger != '' and smaller == '':
-                        larger = int(larger)
-                        tmp = []
-                        for user in users:
-                            real = user.count_ticket_created()
-                            if real >= larger:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    elif larger == '' and smaller != '':
-                        smaller = int(smaller)
-                        tmp = []
-                        for user in users:
-                            real = user.count_ticket_created()
-                            if real <= smaller:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    larger = request.POST['users-accepted-larger']
-                    smaller = request.POST['users-accepted-smaller']
-                    if larger != '' and smaller != '':
-                        larger = int(larger)
-                        smaller = int(smaller)
-                        tmp = []
-                        for user in users:
-                            real = user.accepted_expeditures()
-                            if real >= larger and real <= smaller:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    elif larger != '' and smaller == '':
-                        larger = int(larger)
-                        tmp = []
-                        for user in users:
-                            real = user.accepted_expeditures()
-                            if real >= larger:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    elif larger == '' and smaller != '':
-                        smaller = int(smaller)
-                        tmp = []
-                        for user in users:
-                            real = user.accepted_expeditures()
-                            if real <= smaller:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-
-                    larger = request.POST['users-paid-larger']
-                    smaller = request.POST['users-paid-larger']
-                    if larger != '' and smaller != '':
-                        larger = int(larger)
-                        smaller = int(larger)
-                        tmp = []
-                        for user in users:
-                            real = user.paid_expeditures()
-                            if real >= larger and real <= smaller:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    elif larger != '' and smaller == '':
-                        larger = int(larger)
-                        tmp = []
-                        for user in users:
-                            real = user.paid_expeditures()
-                            if real >= larger:
-                                tmp.append(user)
-                        users = tmp
-                        del(tmp)
-                    elif larger == '' and smaller != '':
-                        smaller = int(smaller)
-                        tmp = []
-                        for user in users:
-                            real = user.paid_expeditures()
-                            if real <= smaller:
-                                tmp.append(user)
-                            users = tmp
-                            del(tmp)
+                    # totals are those of the user list, accepted expeditures rounded per ticket
+                    ledgers = UserLedger.objects.exclude(user_id=None)
+                    ledgers = _range_filter(ledgers, 'ticket_count', request.POST['users-created-larger'], request.POST['users-created-smaller'])
+                    ledgers = _range_filter(ledgers, 'accepted_expeditures', request.POST['users-accepted-larger'], request.POST['users-accepted-smaller'])
+                    ledgers = _range_filter(ledgers, 'paid_expeditures', request.POST['users-paid-larger'], request.POST['users-paid-smaller'])
+                    users = TrackerProfile.objects.filter(user_id__in=ledgers.values('user_id')).select_related('user').order_by('id')
 
                     if 'user-permision' in request.POST:
                         priv = request.POST['user-permision']
-                        tmp = []
                         if priv == 'normal':
-                            for user in users:
-                                if not user.user.is_staff and not user.user.is_superuser:
-                                    tmp.append(user)
+                            users = users.filter(user__is_staff=False, user__is_superuser=False)
                         elif priv == 'staff':
-                            for user in users:
-                                if user.user.is_staff:
-                                    tmp.append(user)
+                            users = users.filter(user__is_staff=True)
                         elif priv == 'superuser':
-                            for user in users:
-                                if user.user.is_superuser:
-                                    tmp.append(user)
+                            users = users.filter(user__is_superuser=True)
                         else:
                             return HttpResponseBadRequest('You must fill the form validly')
-                        users = tmp
-                        del(tmp)
 
-                    response = HttpResponseCsv(['id', 'username', 'first_name', 'last_name', 'email', 'is_active', 'is_staff', 'is_superuser', 'last_login', 'date_joined', 'created_tickets', 'accepted_expeditures', 'paid_expeditures', 'bank_account', 'other_contact', 'other_identification'])
+                    ledgers = dict((ledger.user_id, ledger) for ledger in ledgers)
+                    rows = (
+                        [user.user.id, user.user.username, user.user.first_name, user.user.last_name, user.user.email, user.user.is_active, user.user.is_staff, user.user.is_superuser, user.user.last_login, user.user.date_joined, ledger.ticket_count, ledger.accepted_expeditures, ledger.paid_expeditures, user.bank_account, user.other_contact, user.other_identification]
+                        for user, ledger in ((user, ledgers.get(user.user_id, UserLedger())) for user in iterate_by_id(users))
+                    )
+                    response = StreamingHttpResponseCsv(['id', 'username', 'first_name', 'last_name', 'email', 'is_active', 'is_staff', 'is_superuser', 'last_login', 'date_joined', 'created_tickets', 'accepted_expeditures', 'paid_expeditures', 'bank_account', 'other_contact', 'other_identification'], rows)
                     response['Content-Disposition'] = 'attachment; filename="exported-users.csv"'
-                    for user in users:
-                        response.writerow([user.user.id, user.user.username, user.user.first_name, user.user.last_name, user.user.email, user.user.is_active, user.user.is_staff, user.user.is_superuser, user.user.last_login, user.user.date_joined, user.count_ticket_created(), user.accepted_expeditures(), user.paid_expeditures(), user.bank_account, user.other_contact, user.bank_account])
                     return response
             return HttpResponseForbidden(_('You must be staffer in order to export users'))
 
@@ -1204,139 +1092,203 @@ def export(request):
                 'tickets': Ticket.objects.all(),
             })
 
+class CsvImportRejected(Exception):
+    """ Stops a CSV import, rolling it back; response is returned to the user instead. """
+    def __init__(self, response):
+        super(CsvImportRejected, self).__init__()
+        self.response = response
+
+class CsvImport(object):
+    """
+    Import of CSV rows in chunks: header positions are resolved once, rows of
+    a chunk are converted and checked together, their lookups loaded by one
+    query and the new objects inserted by bulk_create. Side effects the
+    inserts skip (payment status, ticket list, notifications) run once per
+    affected ticket. Meant to run inside deferred_notifications and
+    batched_payment_status.
+    """
+    types = ('ticket', 'topic', 'grant', 'expense', 'preexpense', 'media', 'user')
+    chunk_rows = 500
+    row_limit = 100 # for anyone but superusers
+
+    def __init__(self, request, reader):
+        self.request = request
+        self.reader = reader
+        self.header = next(reader)
+        self.truncated = False
+
+    def chunks(self, columns, optional=()):
+        """ Yields lists of rows as dicts of given columns; optional ones missing from the file are empty. """
+        positions = []
+        for name in columns:
+            if name not in self.header:
+                raise self.invalid(_('Missing column %s') % name)
+            positions.append((name, self.header.index(name)))
+        positions += [(name, self.header.index(name)) for name in optional if name in self.header]
+
+        limit = None if self.request.user.is_superuser else self.row_limit
+        chunk = []
+        for count, line in enumerate(self.reader):
+            if limit is not None and count >= limit:
+                self.truncated = True
+                break
+            row = dict((name, u'') for name in optional)
+            row.update((name, line[position].decode('utf-8')) for name, position in positions)
+            chunk.append(row)
+            if len(chunk) == self.chunk_rows:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def invalid(self, message):
+        messages.error(self.request, message)
+        return CsvImportRejected(render(self.request, 'tracker/import.html', {}))
+
+    def require(self, allowed, message):
+        if not allowed:
+            raise CsvImportRejected(HttpResponseForbidden(message))
+
+    def value(self, model, name, raw):
+        """ Python value of given model field from CSV text; empty text is None for nullable fields. """
+        field = model._meta.get_field(name)
+        if raw == '' and field.null:
+            return None
+        try:
+            return field.to_python(raw)
+        except forms.ValidationError, e:
+            raise self.invalid(u'%s: %s' % (field.verbose_name, u' '.join(e.messages)))
+
+    def lookup(self, queryset, name, keys, label):
+        """ Objects of queryset with given values of field name, keyed by them; unknown or ambiguous values reject the import. """
+        found, ambiguous = {}, set()
+        for o in queryset.filter(**{name + '__in': set(keys)}):
+            key = getattr(o, name)
+            if key in found:
+                ambiguous.add(key) # the field need not be unique, like topic names
+            found[key] = o
+        missing = set(keys) - set(found)
+        if missing:
+            raise self.invalid(u'%s: %s' % (label, u', '.join(sorted(unicode(key) for key in missing))))
+        if ambiguous:
+            raise self.invalid(u'%s: %s (%s)' % (label, u', '.join(sorted(unicode(key) for key in ambiguous)), _('not unique')))
+        return found
+
+    def tickets(self, chunk, forbidden_message):
+        """ Tickets referred to by ticket_id of chunk rows, all of which the importing user must be able to edit. """
+        try:
+            ids = [long(row['ticket_id']) for row in chunk]
+        except ValueError:
+            raise self.invalid(_('Invalid ticket id'))
+        tickets = self.lookup(Ticket.objects.all(), 'id', ids, _('ticket'))
+        if not self.request.user.is_staff:
+            prefetch_cached(tickets.values(), ['ack_set'])
+            self.require(all(t.can_edit(self.request.user) for t in tickets.values()), forbidden_message)
+        return tickets
+
+    def import_ticket(self):
+        for chunk in self.chunks(['event_date', 'summary', 'topic', 'event_url', 'description', 'deposit']):
+            topics = self.lookup(Topic.objects.all(), 'name', [row['topic'] for row in chunk], _('topic'))
+            # saved one by one, as their notifications and ticket list rows need ids
+            for row in chunk:
+                Ticket(
+                    event_date=self.value(Ticket, 'event_date', row['event_date']), summary=row['summary'], topic=topics[row['topic']],
+                    event_url=row['event_url'], description=row['description'], deposit=self.value(Ticket, 'deposit', row['deposit']),
+                    requested_user=self.request.user,
+                ).save()
+
+    def import_topic(self):
+        self.require(self.request.user.is_staff, _('You must be staffer in order to be able import topics.'))
+        for chunk in self.chunks(['name', 'grant', 'new_tickets', 'media', 'preexpenses', 'expenses', 'description', 'form_description']):
+            grants = self.lookup(Grant.objects.all(), 'full_name', [row['grant'] for row in chunk], _('grant'))
+            Topic.objects.bulk_create([Topic(
+                name=row['name'], grant=grants[row['grant']], open_for_tickets=self.value(Topic, 'open_for_tickets', row['new_tickets']),
+                ticket_media=self.value(Topic, 'ticket_media', row['media']), ticket_preexpenses=self.value(Topic, 'ticket_preexpenses', row['preexpenses']),
+                ticket_expenses=self.value(Topic, 'ticket_expenses', row['expenses']), description=row['description'], form_description=row['form_description'],
+            ) for row in chunk])
+        # bulk_create skips post_save; topic summary rows appear with the first ticket
+        topics_changed()
+
+    def import_grant(self):
+        self.require(self.request.user.is_staff, _('You must be staffer in order to be able import grants.'))
+        for chunk in self.chunks(['full_name', 'short_name', 'slug', 'description']):
+            Grant.objects.bulk_create([Grant(**row) for row in chunk])
+
+    def import_expense(self):
+        staff = self.request.user.is_staff
+        affected = {}
+        for chunk in self.chunks(['ticket_id', 'description', 'amount', 'wage'] + (['accounting_info', 'paid'] if staff else [])):
+            tickets = self.tickets(chunk, _("You can't add preexpenses to ticket that you did not created."))
+            expeditures = [Expediture(
+                ticket=tickets[long(row['ticket_id'])], description=row['description'], amount=self.value(Expediture, 'amount', row['amount']),
+                wage=self.value(Expediture, 'wage', row['wage']), accounting_info=row['accounting_info'] if staff else '',
+                paid=self.value(Expediture, 'paid', row['paid']) if staff else False,
+            ) for row in chunk]
+            Expediture.objects.bulk_create(expeditures)
+            notify_items_saved(expeditures, True)
+            affected.update(tickets)
+        for ticket in affected.values():
+            ticket.update_payment_status()
+        update_ticket_summaries(affected)
+
+    def import_preexpense(self):
+        affected = set()
+        for chunk in self.chunks(['ticket_id', 'description', 'amount', 'wage']):
+            tickets = self.tickets(chunk, _("You can't add preexpenses to ticket that you did not created."))
+            preexpeditures = [Preexpediture(
+                ticket=tickets[long(row['ticket_id'])], description=row['description'], amount=self.value(Preexpediture, 'amount', row['amount']),
+                wage=self.value(Preexpediture, 'wage', row['wage']),
+            ) for row in chunk]
+            Preexpediture.objects.bulk_create(preexpeditures)
+            notify_items_saved(preexpeditures, True)
+            affected.update(tickets)
+        if affected:
+            ticket_list_changed(affected)
+            update_ticket_summaries(affected)
+
+    def import_media(self):
+        affected = {}
+        for chunk in self.chunks(['ticket_id', 'url', 'description'], optional=['number']):
+            tickets = self.tickets(chunk, _("You can't add media items to ticket that you did not created."))
+            media = [MediaInfo(
+                ticket=tickets[long(row['ticket_id'])], url=row['url'], description=row['description'], count=self.value(MediaInfo, 'count', row['number']),
+            ) for row in chunk]
+            MediaInfo.objects.bulk_create(media)
+            notify_items_saved(media, True)
+            affected.update(tickets)
+        for ticket in affected.values():
+            ticket.save()
+        update_ticket_summaries(affected)
+
+    def import_user(self):
+        self.require(self.request.user.is_superuser, _('You must be superuser in order to be able import users.'))
+        for chunk in self.chunks(['username', 'password', 'first_name', 'last_name', 'is_superuser', 'is_staff', 'is_active', 'email']):
+            # saved one by one, profiles are created by the post_save handler
+            for row in chunk:
+                user = User(username=row['username'], email=row['email'], first_name=row['first_name'], last_name=row['last_name'])
+                for flag in ('is_superuser', 'is_staff', 'is_active'):
+                    setattr(user, flag, self.value(User, flag, row[flag]))
+                user.set_password(row['password'])
+                user.save()
+
 @login_required
 def importcsv(request):
     if request.method == 'POST' and not request.FILES['csvfile']:
         return render(request, 'tracker/import.html', {})
     elif request.method == 'POST' and request.FILES['csvfile']:
-        imported = 0
         csvfile = request.FILES['csvfile']
-        header = None
         with csvfile:
-            reader = csv.reader(csvfile, delimiter=';', quotechar='"')
-            header = next(reader)
-            imported = 0
-            if request.POST['type'] == 'ticket':
-                for line in reader:
-                    imported += 1
-                    if imported>100 and not request.user.is_superuser:
-                        messages.warning(request, _('You must be superuser in order to be able to import more than 100 rows. First 100 rows has already been imported.'))
-                        break
-                    event_date = line[header.index('event_date')]
-                    summary = line[header.index('summary')]
-                    topic = Topic.objects.get(name=line[header.index('topic')])
-                    event_url = line[header.index('event_url')]
-                    description = line[header.index('description')]
-                    deposit = float(line[header.index('deposit')])
-                    ticket = Ticket.objects.create(event_date=event_date, summary=summary, topic=topic, event_url=event_url, description=description, deposit=deposit)
-                    ticket.requested_user = request.user
-                    ticket.save()
-            elif request.POST['type'] == 'topic':
-                if not request.user.is_staff:
-                    return HttpResponseForbidden(_('You must be staffer in order to be able import topics.'))
-                for line in reader:
-                    imported += 1
-                    if imported>100 and not request.user.is_superuser:
-                        messages.warning(request, _('You must be superuser in order to be able to import more than 100 rows. First 100 rows has already been imported.'))
-                        break
-                    name = line[header.index('name')]
-                    grant = Grant.objects.get(full_name=line[header.index('grant')]).id
-                    new_tickets = line[header.index('new_tickets')]
-                    media = line[header.index('media')]
-                    preexpenses = line[header.index('preexpenses')]
-                    expenses = line[header.index('expenses')]
-                    description = line[header.index('description')]
-                    form_description = line[header.index('form_description')]
-                    topic = Topic.objects.create(name=name, grant_id=grant, open_for_tickets=new_tickets, ticket_media=media, ticket_preexpenses=preexpenses, ticket_expenses=expenses, description=description, form_description=form_description)
-            elif request.POST['type'] == 'grant':
-                if not request.user.is_staff:
-                     return HttpResponseForbidden(_('You must be staffer in order to be able import grants.'))
-                for line in reader:
-                    imported += 1
-                    if imported>100 and not request.user.is_superuser:
-                        messages.warning(request, _('You must be superuser in order to be able to import more than 100 rows. First 100 rows has already been imported.'))
-                        break
-                    full_name = line[header.index('full_name')]
-                    short_name = line[header.index('short_name')]
-                    slug = line[header.index('slug')]
-                    description = line[header.index('description')]
-                    grant = Grant.objects.create(full_name=full_name, short_name=short_name, slug=slug, description=description)
-            elif request.POST['type'] == 'expense':
-                for line in reader:
-                    imported += 1
-                    if imported>100 and not request.user.is_superuser:
-                        messages.warning(request, _('You must be superuser in order to be able to import more than 100 rows. First 100 rows has already been imported.'))
-                        break
-                    ticket = Ticket.objects.get(id=line[header.index('ticket_id')])
-                    description = line[header.index('description')]
-                    amount = line[header.index('amount')]
-                    wage = line[header.index('wage')]
-                    if request.user.is_staff:
-                        accounting_info = line[header.index('accounting_info')]
-                        paid = line[header.index('paid')]
-                    else:
-                        accounting_info = ''
-                        paid = False
-                    if ticket.can_edit(request.user) or request.user.is_staff:
-                        expediture = Expediture.objects.create(ticket=ticket, description=description, amount=amount, wage=wage, accounting_info=accounting_info, paid=paid)
-                    else:
-                        return HttpResponseForbidden(_("You can't add preexpenses to ticket that you did not created."))
-            elif request.POST['type'] == 'preexpense':
-                for line in reader:
-                    imported += 1
-                    if imported>100 and not request.user.is_superuser:
-                        messages.warning(request, _('You must be superuser in order to be able to import more than 100 rows. First 100 rows has already been imported.'))
-                        break
-                    ticket = Ticket.objects.get(id=line[header.index('ticket_id')])
-                    description = line[header.index('description')]
-                    amount = line[header.index('amount')]
-                    wage = line[header.index('wage')]
-                    if ticket.can_edit(request.user) or request.user.is_staff:
-                        expediture = Preexpediture.objects.create(ticket=ticket, description=description, amount=amount, wage=wage)
-                    else:
-                        return HttpResponseForbidden(_("You can't add preexpenses to ticket that you did not created."))
-            elif request.POST['type'] == 'media':
-                for line in reader:
-                    imported += 1
-                    if imported>100 and not request.user.is_superuser:
-                        messages.warning(request, _('You must be superuser in order to be able to import more than 100 rows. First 100 rows has already been imported.'))
-                        break
-                    ticket = Ticket.objects.get(id=line[header.index('ticket_id')])
-                    url = line[header.index('url')]
-                    description = line[header.index('description')]
-		    if 'number' in header:
-                        number = line[header.index('number')]
-                        if number == "":
-                            number = None
-                    else:
-                        number = None
-                    if ticket.can_edit(request.user) or request.user.is_staff:
-                        media = MediaInfo.objects.create(ticket=ticket, url=url, description=description, count=number)
-                        ticket.save()
-                    else:
-                        return HttpResponseForbidden(_("You can't add media items to ticket that you did not created."))
-            elif request.POST['type'] == 'user':
-                if not request.user.is_superuser:
-                    return HttpResponseForbidden(_('You must be superuser in order to be able import users.'))
-                for line in reader:
-                    username = line[header.index('username')]
-                    password = line[header.index('password')]
-                    first_name = line[header.index('first_name')]
-                    last_name = line[header.index('last_name')]
-                    is_superuser = line[header.index('is_superuser')]
-                    is_staff = line[header.index('is_staff')]
-                    is_active = line[header.index('is_active')]
-                    email = line[header.index('email')]
-                    user = User.objects.create_user(username=username, password=password, email=email)
-                    user.first_name = first_name
-                    user.last_name = last_name
-                    user.is_superuser = is_superuser
-                    user.is_staff = is_staff
-                    user.is_active = is_active
-                    user.save()
-            else:
+            csv_import = CsvImport(request, csv.reader(csvfile, delimiter=';', quotechar='"'))
+            if request.POST['type'] not in CsvImport.types:
                 messages.error(request, _('The form have returned strange values. Please contact the systemadmin and tell him what you tried to do. '))
                 return render(request, 'tracker/import.html', {})
+            try:
+                with deferred_notifications(), batched_payment_status():
+                    getattr(csv_import, 'import_' + request.POST['type'])()
+            except CsvImportRejected as e:
+                return e.response
+        if csv_import.truncated:
+            messages.warning(request, _('You must be superuser in order to be able to import more than 100 rows. First 100 rows has already been imported.'))
         messages.success(request, _('Your CSV file was imported. '))
         return HttpResponseRedirect(reverse('index'))
     else:
@@ -1395,9 +1347,11 @@ def copypreexpeditures(request, pk):
     ticket = get_object_or_404(Ticket, id=pk)
     if not ticket.can_edit(request.user) or 'content' in ticket.ack_set():
         return HttpResponseForbidden(_('You cannot edit this'))
-    for e in ticket.expediture_set.all():
-        e.delete()
-    for pe in ticket.preexpediture_set.all():
-        e = Expediture.objects.create(ticket=ticket, description=pe.description, amount=pe.amount, wage=pe.wage)
+    with deferred_notifications(), batched_payment_status():
+        for e in ticket.expediture_set.all():
+            e.delete()
+        for pe in ticket.preexpediture_set.all():
+            e = Expediture.objects.create(ticket=ticket, description=pe.description, amount=pe.amount, wage=pe.wage)
+        ticket.update_payment_status()
     messages.success(request, _('Preexpeditures were copied to expeditures successfuly.'))
     return HttpResponseRedirect(ticket.get_absolute_url())